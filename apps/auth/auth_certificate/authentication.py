@@ -4,8 +4,8 @@ from urllib.parse import unquote
 from rest_framework import authentication, exceptions
 
 from apps.federation.file_transfer.models import DownloadToken
+from apps.federation.inbox import cache
 from apps.node.models import Node
-from apps.utils import get_user_node
 
 
 def get_cn_from_str(s: str) -> str:
@@ -48,10 +48,10 @@ class CertificateAuthentication(authentication.BaseAuthentication):
         try:
             cn = get_cn_from_str(cn)
             logging.debug('Extracted common name: ' + str(cn))
-            n = Node.objects.get(common_name=cn)
+            n = cache.get_node_by_common_name(cn)
         except Node.DoesNotExist:
             logging.error('No node for with cn=[%s]', cn)
             raise exceptions.AuthenticationFailed(f'no user found for common name {cn}')
 
         # TODO return the user for this node
-        return (get_user_node().user, n)  # node is accessible @ request.auth
+        return (cache.get_user_node().user, n)  # node is accessible @ request.auth
@@ -109,14 +109,7 @@ class Dataset(CreatedByMixin, OriginMixin, IdentifieableMixin, Base):
         df = df.drop(columns=['existing'])
 
         # get the origin node id
-        challenge_cache = {}
-
-        def fn_challenge(e):
-            if e not in challenge_cache:
-                challenge_cache[e] = Challenge.objects.get_by_identifier(e).id_as_str
-            return challenge_cache[e]
-
-        df['challenge'] = df['challenge'].apply(fn_challenge)
+        df['challenge'] = df['challenge'].map(Challenge.objects.resolve_identifiers(df['challenge'].unique()))
         df = df.rename(columns={'challenge': 'challenge_id'})
         insert_with_copy_from_and_tmp_table(df, Dataset.objects.model._meta.db_table)
 
@@ -128,27 +121,14 @@ class Dataset(CreatedByMixin, OriginMixin, IdentifieableMixin, Base):
         insert_with_copy_from_and_tmp_table(df_id, Share.datasets.through.objects.model._meta.db_table,
                                             insert_columns='share_id, dataset_id')
 
-        dataset_cache = {}
-
-        def fn_dataset(e):
-            d = e['dataset_id']
-            if d not in dataset_cache:
-                d = Dataset.objects.filter_by_identifier(d).first()
-                if d is not None:  # TODO what to do if dataset not found?
-                    dataset_cache[d] = d.id_as_str
-            return dataset_cache[d]
-
         if datasets_files is not None:
             # add files to dataset
             df = pandas.read_csv(io.StringIO(datasets_files))
             if len(df.index) > 0:
                 df = df.rename(columns={'dataset': 'dataset_id', 'file': 'file_id'})
-                df['dataset_id'] = df.apply(fn_dataset, axis=1)
-
-                def fn_file(e):
-                    return File.objects.get_by_identifier(e['file_id']).id_as_str
-
-                df['file_id'] = df.apply(fn_file, axis=1)
+                # resolve all identifiers of the mapping at once instead of one query per row
+                df['dataset_id'] = df['dataset_id'].map(Dataset.objects.resolve_identifiers(df['dataset_id'].unique()))
+                df['file_id'] = df['file_id'].map(File.objects.resolve_identifiers(df['file_id'].unique()))
                 insert_with_copy_from_and_tmp_table(df, Dataset.files.through.objects.model._meta.db_table,
                                                     insert_columns='dataset_id, file_id')
 
@@ -159,12 +139,8 @@ class Dataset(CreatedByMixin, OriginMixin, IdentifieableMixin, Base):
                 logging.info('No cases for datasets provided.')
             else:
                 df = df.rename(columns={'dataset': 'dataset_id', 'case': 'case_id'})
-                df['dataset_id'] = df.apply(fn_dataset, axis=1)
-
-                def fn_case(e):
-                    return Case.objects.get_by_identifier(e['case_id']).id_as_str
-
-                df['case_id'] = df.apply(fn_case, axis=1)
+                df['dataset_id'] = df['dataset_id'].map(Dataset.objects.resolve_identifiers(df['dataset_id'].unique()))
+                df['case_id'] = df['case_id'].map(Case.objects.resolve_identifiers(df['case_id'].unique()))
                 insert_with_copy_from_and_tmp_table(df, Dataset.cases.through.objects.model._meta.db_table,
                                                     insert_columns='dataset_id, case_id')
         logging.info(f'Updating {len(df_existing)} datasets.')
@@ -186,7 +186,7 @@ def send_results_to_submission_submitter(created_by_pk,
                            created_by=created_by,
                            origin=created_by)
     builder.add_file_handler(data=File.objects.filter(id__in=list(map(lambda e: e.id, files))))
-    builder.add_permission_handler(data=','.join(list(map(lambda e: f'\'{e.identifier}\'', files))))
+    builder.add_permission_handler(data=[f.identifier for f in files])
     computing_definitions = ComputingJobDefinition.objects.filter(pipeline__is_template=False,
                                                                   id__in=submission.computing_job_executions.values_list(
                                                                       'definition', flat=True).distinct())
@@ -202,7 +202,7 @@ def send_results_to_submission_submitter(created_by_pk,
 
     object = SubmissionResultObject(
         content={'submission': str(submission.identifier), 'reference': submission.reference,
-                 'content': json.loads(json.dumps(share.content))},
+                 'content': json.loads(json.dumps(share.get_content()))},
     )
 
     om = OutboxMessage.create(recipient=submission.origin,
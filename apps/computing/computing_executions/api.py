@@ -1,9 +1,7 @@
-import csv
-import io
 import logging
 import uuid
 
-from django.db import transaction, connection
+from django.db import transaction
 from django.http import HttpResponse, JsonResponse
 from django.utils import timezone
 from django.utils.decorators import method_decorator
@@ -13,11 +11,13 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from apps.computing.computing_artifact.models import ComputingJobResult, ComputingJobArtifact
 from apps.computing.computing_executions.models import ComputingJobExecution
 from apps.computing.computing_log.models import ComputingJobLogEntry
 from apps.computing.computing_log.tasks import persist_log
 from apps.computing.tasks import start_stage_from_last
 from apps.core import identifier
+from apps.core.db_utils import BulkWriter
 from apps.storage.storage_importer.tasks import import_computing_job_artefacts
 
 
@@ -99,15 +99,13 @@ class ArtifactView(BaseAPIView):
         job = ComputingJobExecution.objects.get(pk=pk)
         # params = {k: request.GET.get(k) for k in request.GET}
         job_id = job.id_as_str
-        computing_results_memory_file = io.StringIO()
-        computing_results_writer = csv.writer(computing_results_memory_file)
-        computing_results_csv_header = ['id', 'date_created', 'last_modified', 'identifier', 'origin_id']
-        computing_results_writer.writerow(computing_results_csv_header)
-
-        computing_artifact_memory_file = io.StringIO()
-        computing_artifact_writer = csv.writer(computing_artifact_memory_file)
-        computing_artifact_csv_header = ['computingjobresult_ptr_id', 'computing_job_id', 'file_id']
-        computing_artifact_writer.writerow(computing_artifact_csv_header)
+        # both writers flush after the same number of rows, so the artifacts are always flushed after their results
+        computing_results_writer = BulkWriter(ComputingJobResult.objects.model._meta.db_table,
+                                              ['id', 'date_created', 'last_modified', 'identifier', 'origin_id'],
+                                              mode='copy')
+        computing_artifact_writer = BulkWriter(ComputingJobArtifact.objects.model._meta.db_table,
+                                               ['computingjobresult_ptr_id', 'computing_job_id', 'file_id'],
+                                               mode='copy')
 
         now = timezone.now().isoformat()
 
@@ -135,27 +133,11 @@ class ArtifactView(BaseAPIView):
             #     name=f.get('file')
             # )
             artifact_id = str(uuid.uuid4())
-            computing_results_writer.writerow(
+            computing_results_writer.write(
                 [artifact_id, now, now, identifier.create_random('artefact'), origin_id])
-            computing_artifact_writer.writerow([artifact_id, job_id, f])
-        try:
-            with connection.cursor() as cursor:
-                computing_results_memory_file.seek(0)
-                cursor.copy_expert(
-                    f'copy computing_artifact_computingjobresult({",".join(computing_results_csv_header)}) from stdin csv header',
-                    computing_results_memory_file
-                )
-                computing_artifact_memory_file.seek(0)
-                cursor.copy_expert(
-                    f'copy computing_artifact_computingjobartifact({",".join(computing_artifact_csv_header)}) from stdin csv header',
-
-                    computing_artifact_memory_file
-                )
-        except Exception as e:
-            raise e
-        finally:
-            computing_results_memory_file.close()
-            computing_artifact_memory_file.close()
+            computing_artifact_writer.write([artifact_id, job_id, f])
+        computing_results_writer.flush()
+        computing_artifact_writer.flush()
 
         # start importer
         import_computing_job_artefacts.delay(job.id_as_str)
@@ -1,8 +1,6 @@
-import io
 import logging
 import uuid
 
-import pandas
 from django.db import models
 from django.utils import timezone
 
@@ -39,21 +37,16 @@ class ComputingJobLogEntry(IdentifieableMixin, Base):
             logging.warning("No logs to import.")
             return
 
-        df = pandas.read_csv(io.StringIO(entries))
-        now = timezone.now().isoformat()
-        df = df.rename(columns={'computing_job': 'computing_job_id'})
-        job_cache = {}
-
         from apps.computing.computing_executions.models import ComputingJobExecution
-
-        def fn(e):
-            if e not in job_cache:
-                job_cache[e] = ComputingJobExecution.objects.filter(identifier=e, definition__submission_id=submission_id).first().id_as_str
-            return job_cache.get(e)
-
-        df['computing_job_id'] = df['computing_job_id'].apply(fn)
-        df['date_created'] = now
-        df['last_modified'] = now
-        df['id'] = df.apply(lambda e: str(uuid.uuid4()), axis=1)
-
-        db_utils.insert_with_copy_from_and_tmp_table(df, ComputingJobLogEntry.objects.model._meta.db_table)
+        jobs = ComputingJobExecution.objects.filter(definition__submission_id=submission_id)
+
+        for df in db_utils.read_csv_chunks(entries, name='log entries'):
+            now = timezone.now().isoformat()
+            df = df.rename(columns={'computing_job': 'computing_job_id'})
+            df['computing_job_id'] = df['computing_job_id'].map(
+                db_utils.resolve_identifiers(jobs, df['computing_job_id'].unique()))
+            df['date_created'] = now
+            df['last_modified'] = now
+            df['id'] = df.apply(lambda e: str(uuid.uuid4()), axis=1)
+
+            db_utils.insert_with_copy_from_and_tmp_table(df, ComputingJobLogEntry.objects.model._meta.db_table)
@@ -1,70 +1,583 @@
+import csv
 import io
+import json
+import logging
+import math
 import random
 import string
+import threading
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterable, List
 
-from django.db import connection
+import pandas
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import QuerySet
 from psycopg2 import sql
 
+# (staging, step) that the inserts of the current thread are redirected to, see Staging
+_staging: ContextVar[tuple | None] = ContextVar('staging', default=None)
+
 
 def insert_with_copy_from_and_tmp_table(df, table_destination, insert_columns='*'):
     '''
     Uses a temporary table and insert into on conflict do nothing to prevent errors if inserting duplicates.
+    Inserts into a staging table instead of `table_destination` if a Staging is active, see Staging.
     :param df:
     :param table_destination:
+    :param insert_columns: comma separated columns of `df` to insert. defaults to all columns.
     :return:
     '''
-    with connection.cursor() as cursor, io.StringIO() as buffer:
-        df.to_csv(buffer, index=False, na_rep='null')
-        buffer.seek(0)
-        tmp_tbl_name = ''.join(random.choice(string.ascii_uppercase) for _ in range(5))
-        # create tmp table with 1 record from original table and truncate that record again to
-        # so the tmp table has the same schema as the original table.
-        cursor.execute(
-            sql.SQL('create temp table {} as select * from {} limit 1').format(sql.Identifier(tmp_tbl_name),
-                                                                               sql.Identifier(table_destination)))
-        cursor.execute(sql.SQL('truncate table {}').format(sql.Identifier(tmp_tbl_name)))
-        q = 'copy {}(' + (",".join(
-            ['{}' for _ in range(len(df.columns.values.tolist()))])) + ') from stdin csv header NULL as \'null\''
-        cursor.copy_expert(
-            sql.SQL(
-                q).format(sql.Identifier(tmp_tbl_name), *[sql.Identifier(e) for e in df.columns.values.tolist()]),
-            buffer)
-        query = 'insert into {}'
-        if insert_columns != '*':
-            query += ' (' + insert_columns + ') '  # FIXME SQL INJECTION POSSIBLE HERE
-        query += 'select ' + insert_columns + ' from {} on conflict do nothing'
-
-        cursor.execute(
-            sql.SQL(query).format(
-                sql.Identifier(table_destination),
-                sql.Identifier(tmp_tbl_name)))
-        cursor.execute(sql.SQL('drop table {}').format(sql.Identifier(tmp_tbl_name)))
-
-
-def update_from_tmp_table(df, table_destination, update_columns, where_clause):
+    if insert_columns != '*':
+        df = df[[c.strip() for c in insert_columns.split(',')]]
+    with BulkWriter(table_destination, df.columns) as writer:
+        writer.write_df(df)
+
+
+# how null is written into the csv that is copied. an empty string stays an empty string.
+NULL = '\\N'
+
+
+def _csv_value(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return NULL
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+
+class BulkWriter:
     '''
+    Loads rows into `table` with COPY. The rows are buffered as csv and flushed every `batch_size` rows, so they can
+    be streamed from a generator without holding all of them in memory. Flushes the remaining rows on exit if used
+    as context manager.
+    Modes:
+    - 'copy': copies straight into `table`. the fastest mode, but fails on duplicates.
+    - 'insert': copies into a staging table and inserts into `table` on conflict do nothing.
+    - 'upsert': like 'insert', but updates `update_columns` of the rows that conflict on `key`.
+    - 'merge': like 'upsert', but with MERGE, so `key` does not need a unique constraint.
+    - 'update': updates `update_columns` of the rows of `table` that match the staged rows on `key`.
+    The staging table is a temp table that is dropped on commit, so all batches of a transaction share it.
+    If a Staging is active, the rows are staged there instead, see Staging.
 
-    :param df:
-    :param table_destination:
-    :param update_columns: the set part of the update query string. e.g. "field1 = x.field" with x being the temporary table.
-    :return:
+        with BulkWriter(Permission.objects.model._meta.db_table, ['id', 'user_id', ...]) as writer:
+            writer.write_rows([uuid.uuid4(), user_id, ...] for i in identifiers)
+
+    :param columns: the columns of the rows in the order they are written
+    :param key: the columns that identify a row for 'upsert', 'merge' and 'update'
+    :param update_columns: the columns that are updated. defaults to all columns but the key.
+    :param filters: equality conditions on `table` that rows must match to be updated in mode 'update'
+    :param batch_size: defaults to settings.BULK_WRITER_BATCH_SIZE
     '''
+    MODES = ['copy', 'insert', 'upsert', 'merge', 'update']
+
+    def __init__(self, table: str, columns: Iterable[str], mode: str = 'insert', key: List[str] | None = None,
+                 update_columns: List[str] | None = None, filters: Dict[str, Any] | None = None,
+                 batch_size: int | None = None):
+        if mode not in self.MODES:
+            raise ValueError(f'Unknown mode {mode}. Must be one of {", ".join(self.MODES)}.')
+        if mode in ['upsert', 'merge', 'update'] and not key:
+            raise ValueError(f'Mode {mode} requires a key.')
+        if filters and mode != 'update':
+            raise ValueError(f'Mode {mode} does not support filters.')
+        self.table = table
+        self.columns = list(columns)
+        self.mode = mode
+        self.key = key or []
+        self.update_columns = update_columns if update_columns is not None else \
+            [c for c in self.columns if c not in self.key]
+        self.filters = filters or {}
+        self.batch_size = batch_size or settings.BULK_WRITER_BATCH_SIZE
+        # number of flushed rows
+        self.rows = 0
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._pending = 0
+        self._tmp_tbl_name = random_table_name()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.flush()
+        self._buffer.close()
+
+    def write(self, row):
+        '''
+        :param row: the values in the order of `columns`. dicts and lists are written as json.
+        '''
+        self._writer.writerow([_csv_value(v) for v in row])
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.flush()
+
+    def write_rows(self, rows: Iterable):
+        for row in rows:
+            self.write(row)
+
+    def write_df(self, df: pandas.DataFrame):
+        '''
+        Writes the `columns` of the data frame.
+        '''
+        for start in range(0, len(df.index), self.batch_size):
+            chunk = df.iloc[start:start + self.batch_size]
+            chunk.to_csv(self._buffer, columns=self.columns, header=False, index=False, na_rep=NULL)
+            self._pending += len(chunk.index)
+            if self._pending >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        if self._pending == 0:
+            return
+        self._buffer.seek(0)
+        with transaction.atomic(), connection.cursor() as cursor:
+            active = _staging.get()
+            if active is not None:
+                self._stage(cursor, *active)
+            elif self.mode == 'copy':
+                self._copy(cursor, self.table)
+            else:
+                self._merge(cursor)
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self.rows += self._pending
+        self._pending = 0
+
+    def _copy(self, cursor, table: str):
+        cursor.copy_expert(sql.SQL('copy {} ({}) from stdin with (format csv, null {})').format(
+            sql.Identifier(table), self._columns(), sql.Literal(NULL)), self._buffer)
+
+    def _columns(self, columns: List[str] | None = None):
+        return sql.SQL(', ').join(sql.Identifier(c) for c in (columns or self.columns))
+
+    def _assignments(self, source: str):
+        return sql.SQL(', ').join(sql.SQL('{} = {}').format(sql.Identifier(c), sql.Identifier(source, c))
+                                  for c in self.update_columns)
+
+    def _key_matches(self, target: str, source: str):
+        return sql.SQL(' and ').join(sql.SQL('{} = {}').format(sql.Identifier(target, k), sql.Identifier(source, k))
+                                     for k in self.key)
+
+    def statement(self, source: str) -> sql.Composed:
+        '''
+        Returns the statement that applies the rows of the table `source` to `table` according to the mode.
+        '''
+        table, source = sql.Identifier(self.table), sql.Identifier(source)
+        # a row can only be changed once per statement, so only one of the rows with the same key is applied
+        distinct = sql.SQL('select distinct on ({}) {} from {}').format(self._columns(self.key), self._columns(),
+                                                                        source)
+        if self.mode == 'insert':
+            return sql.SQL('insert into {} ({}) select {} from {} on conflict do nothing').format(
+                table, self._columns(), self._columns(), source)
+        if self.mode == 'upsert':
+            action = sql.SQL('do update set {}').format(self._assignments('excluded')) if self.update_columns \
+                else sql.SQL('do nothing')
+            return sql.SQL('insert into {} ({}) {} on conflict ({}) {}').format(
+                table, self._columns(), distinct, self._columns(self.key), action)
+        if self.mode == 'merge':
+            action = sql.SQL('update set {}').format(self._assignments('x')) if self.update_columns \
+                else sql.SQL('do nothing')
+            return sql.SQL('merge into {} t using ({}) x on {} when matched then {} '
+                           'when not matched then insert ({}) values ({})').format(
+                table, distinct, self._key_matches('t', 'x'), action, self._columns(),
+                sql.SQL(', ').join(sql.Identifier('x', c) for c in self.columns))
+        conditions = [self._key_matches(self.table, 'x')]
+        conditions += [sql.SQL('{} = {}').format(sql.Identifier(self.table, c), sql.Literal(v))
+                       for c, v in self.filters.items()]
+        return sql.SQL('update {} set {} from {} x where {}').format(
+            table, self._assignments('x'), source, sql.SQL(' and ').join(conditions))
+
+    def _merge(self, cursor):
+        tmp = sql.Identifier(self._tmp_tbl_name)
+        # the temp table only has the written columns and no constraints. it is reused until the transaction ends.
+        cursor.execute(sql.SQL('create temp table if not exists {} on commit drop as select {} from {} with no data')
+                       .format(tmp, self._columns(), sql.Identifier(self.table)))
+        self._copy(cursor, self._tmp_tbl_name)
+        cursor.execute(self.statement(self._tmp_tbl_name))
+        cursor.execute(sql.SQL('truncate {}').format(tmp))
+
+    def _stage(self, cursor, staging: 'Staging', step: str):
+        if self.mode in ['copy', 'insert']:
+            # staging tables have no unique constraints. conflicts are resolved when the staging is published.
+            table = staging.table_for(step, self.table)
+        else:
+            # the statement is applied to the staged rows when the staging is published
+            table = staging.statement_table_for(step, self.table, self.statement)
+        self._copy(cursor, table)
+
+
+def read_csv_chunks(data, name='rows', chunk_size: int | None = None, **kwargs):
+    '''
+    Yields the csv `data` as data frames of at most `chunk_size` rows. Only one chunk is held in memory at a time if
+    `data` is a stream. Progress is logged after each chunk.
+    :param data: a csv string or an object whose `open()` returns a text stream, e.g. a section of a share package
+    :param name: what is imported. only used for logging.
+    :param chunk_size: defaults to settings.IMPORTER_CHUNK_SIZE
+    :param kwargs: passed to pandas.read_csv
+    '''
+    if data is None or len(data) == 0:
+        return
+    if chunk_size is None:
+        chunk_size = settings.IMPORTER_CHUNK_SIZE
+    stream = io.StringIO(data) if isinstance(data, str) else data.open()
+    rows = 0
+    with stream, pandas.read_csv(stream, chunksize=chunk_size, **kwargs) as chunks:
+        for df in chunks:
+            yield df
+            rows += len(df.index)
+            logging.info('Imported %d %s.', rows, name)
+
+
+def read_csv_values(data, column: str) -> set:
+    '''
+    Returns the distinct values of `column` of the csv `data`, see `read_csv_chunks`. Only the column is read.
+    Returns an empty set if the csv has no such column.
+    '''
+    values = set()
+    for df in read_csv_chunks(data, name=f'{column} values', usecols=lambda c: c == column, dtype=str):
+        if column in df.columns:
+            values.update(df[column].dropna())
+    return values
+
+
+def random_table_name():
+    return 'tmp_' + ''.join(random.choice(string.ascii_lowercase) for _ in range(10))
+
+
+@contextmanager
+def temp_table_from_rows(columns: Dict[str, str], rows: Iterable):
+    '''
+    Loads `rows` with one COPY into a session temp table and yields the name of the table. The table is dropped on
+    exit.
+    :param columns: mapping of column name to postgres type e.g. {'id': 'uuid'}
+    :param rows: iterable of rows (lists or tuples) in the order of `columns`
+    '''
+    tmp_tbl_name = random_table_name()
     with connection.cursor() as cursor, io.StringIO() as buffer:
-        df.to_csv(buffer, index=False, na_rep='null')
-        buffer.seek(0)
-        tmp_tbl_name = ''.join(random.choice(string.ascii_uppercase) for _ in range(5))
-        cursor.execute(
-            sql.SQL('create temp table {} as select * from {} limit 1').format(sql.Identifier(tmp_tbl_name),
-                                                                               sql.Identifier(table_destination)))
-        cursor.execute(sql.SQL('truncate table {}').format(sql.Identifier(tmp_tbl_name)))
-
-        # first insert data into tmp tbl
-        insert_with_copy_from_and_tmp_table(df, tmp_tbl_name)
-
-        query = 'update {} set ' + update_columns + ' from {} x where ' + where_clause  # FIXME SQL INJECTION POSSIBLE HERE
-        q = sql.SQL(query).format(
-            sql.Identifier(table_destination),
+        cursor.execute(sql.SQL('create temp table {} ({})').format(
             sql.Identifier(tmp_tbl_name),
-        )
-        cursor.execute(q)
-        cursor.execute(sql.SQL('drop table {}').format(sql.Identifier(tmp_tbl_name)))
+            sql.SQL(', ').join(sql.SQL('{} {}').format(sql.Identifier(c), sql.SQL(t)) for c, t in columns.items())))
+        writer = csv.writer(buffer)
+        writer.writerows(rows)
+        buffer.seek(0)
+        cursor.copy_expert(sql.SQL('copy {} from stdin csv').format(sql.Identifier(tmp_tbl_name)), buffer)
+        # temp tables have no statistics by default. without them the planner assumes a tiny table.
+        cursor.execute(sql.SQL('analyze {}').format(sql.Identifier(tmp_tbl_name)))
+    try:
+        yield tmp_tbl_name
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute(sql.SQL('drop table if exists {}').format(sql.Identifier(tmp_tbl_name)))
+
+
+@contextmanager
+def temp_table_from_values(values: Iterable, column_type: str = 'uuid'):
+    '''
+    Loads `values` into a temp table with the single column `id`. See `temp_table_from_rows`.
+    '''
+    with temp_table_from_rows({'id': column_type}, ([v] for v in values)) as tmp_tbl_name:
+        yield tmp_tbl_name
+
+
+def queryset_as_sql(queryset: QuerySet, field: str | None = None) -> str:
+    '''
+    Compiles the queryset to sql that can be used as subquery e.g. `where x.id in (...)`.
+    The queryset is not evaluated, so the selection never leaves the database.
+    :param field: the field to select. if None, the queryset must already select a single column e.g. values_list().
+    '''
+    if field is not None:
+        queryset = queryset.values(field)
+    query, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        return cursor.mogrify(query, params).decode()
+
+
+def claim_batch(queryset: QuerySet, size: int, **claim) -> List:
+    '''
+    Claims up to `size` rows of `queryset` for the calling worker and returns them. The rows are locked with
+    select ... for update skip locked, so concurrent workers claim different rows without waiting for each other, and
+    updated with `claim` in the same transaction. `claim` must change the rows so they no longer match `queryset`,
+    e.g. processing=True for a queryset of unprocessed rows that are not processing.
+
+        for message in claim_batch(InboxMessage.pending(), 100, **InboxMessage.claim()):
+            ...
+
+    :param claim: the values the claimed rows are updated with
+    '''
+    with transaction.atomic():
+        # only the rows of the model itself are locked, joined rows are not
+        objects = list(queryset.select_for_update(skip_locked=True, of=('self',))[:size])
+        if len(objects) > 0:
+            queryset.model.objects.filter(pk__in=[o.pk for o in objects]).update(**claim)
+    for o in objects:
+        for field, value in claim.items():
+            setattr(o, field, value)
+    return objects
+
+
+@contextmanager
+def try_advisory_lock(name: str, key: int):
+    '''
+    Tries to take the postgres session advisory lock (`name`, `key`) without waiting and releases it on exit.
+    Yields whether the lock was taken. Only one connection can hold a lock at a time, so it can make sure that only
+    one worker processes something.
+
+        with try_advisory_lock('inbox_shard', 3) as locked:
+            if locked:
+                ...
+    '''
+    with connection.cursor() as cursor:
+        cursor.execute('select pg_try_advisory_lock(hashtext(%s), %s)', [name, key])
+        locked = cursor.fetchone()[0]
+    try:
+        yield locked
+    finally:
+        if locked:
+            with connection.cursor() as cursor:
+                cursor.execute('select pg_advisory_unlock(hashtext(%s), %s)', [name, key])
+
+
+class UnresolvedIdentifiersError(Exception):
+
+    def __init__(self, model, identifiers):
+        self.model = model
+        self.identifiers = identifiers
+        sample = ', '.join(str(i) for i in list(identifiers)[:10])
+        super().__init__(f'{len(identifiers)} {model._meta.verbose_name_plural} could not be resolved: {sample}')
+
+
+def resolve_identifiers(queryset: QuerySet, values: Iterable, fields: str | list[str] = 'identifier',
+                        missing: str = 'raise') -> Dict[Any, str]:
+    '''
+    Resolves `values` of `fields` to the ids of the rows in `queryset`. The values are loaded into a temp table
+    and resolved with one join instead of one query per value.
+    :param fields: a field or a list of fields. for a list, each value is a tuple in the order of `fields`.
+    :param missing: what to do with values that are not found. 'raise' raises UnresolvedIdentifiersError with all of
+    them, 'log' logs them in a single warning and 'ignore' leaves them out of the result silently.
+    :return: dict value -> id as str. null values are skipped.
+    '''
+    if isinstance(fields, str):
+        fields = [fields]
+        keys = {(str(v),): v for v in values if not pandas.isna(v)}
+    else:
+        keys = {tuple(str(e) for e in v): v for v in values if not any(pandas.isna(e) for e in v)}
+    resolved = {}
+    if len(keys) > 0:
+        columns = [f'v{i}' for i in range(len(fields))]
+        subquery = queryset_as_sql(queryset.values_list('pk', *fields))
+        active = _staging.get()
+        if active is not None:
+            # rows that were staged but not published yet are resolved as well. a cte named like the table shadows
+            # the table in the query, so the query reads the union of the live and the staging tables. the staging
+            # tables have the same columns as the live table.
+            staging, step = active
+            db_table = queryset.model._meta.db_table
+            tables = [db_table] + staging.visible_tables(step, db_table)
+            union = ' union all '.join(f'select * from "{table}"' for table in tables)
+            subquery = f'with "{db_table}" as ({union}) {subquery}'
+        select = ', '.join(f'v.{c}' for c in columns)
+        condition = ' and '.join(f'm.{c}::text = v.{c}' for c in columns)
+        with temp_table_from_rows({c: 'text' for c in columns}, keys.keys()) as tmp_tbl_name, \
+                connection.cursor() as cursor:
+            # no params are passed, so % in the subquery is not interpreted
+            cursor.execute(f'''
+                select distinct on ({select}) {select}, m.id::text
+                from {tmp_tbl_name} v join ({subquery}) as m(id, {', '.join(columns)}) on {condition}
+            ''')
+            for row in cursor.fetchall():
+                resolved[keys[row[:-1]]] = row[-1]
+
+    unresolved = [v for v in keys.values() if v not in resolved]
+    if len(unresolved) > 0:
+        if missing == 'raise':
+            raise UnresolvedIdentifiersError(queryset.model, unresolved)
+        if missing == 'log':
+            logging.warning('%d %s could not be resolved: %s', len(unresolved),
+                            queryset.model._meta.verbose_name_plural, ', '.join(map(str, unresolved[:10])))
+    return resolved
+
+
+class Staging:
+    '''
+    Redirects the inserts and updates of BulkWriter (and so of `insert_with_copy_from_and_tmp_table`) into
+    staging tables while it is active on the current thread. The staged rows are invisible to everyone else until
+    `publish` copies them into their destination tables, so sections can be staged in parallel in short transactions
+    and published together in one.
+    Writes through the ORM (e.g. `Model.objects.create`) are not staged. Rows the steps would create that way must be
+    created before the steps run.
+    Every step (e.g. a section of a share) gets its own staging tables. `resolve_identifiers` also resolves the rows
+    staged by completed steps and by the current step.
+    '''
+
+    def __init__(self):
+        # step -> destination table -> staging table
+        self.tables: Dict[str, Dict[str, str]] = {}
+        # step -> list of (staging table, statement that applies the staged rows e.g. a merge)
+        self.statements: Dict[str, list] = {}
+        self.completed = set()
+        self._lock = threading.Lock()
+
+    def state(self) -> dict:
+        '''
+        Returns the staging tables of the completed steps as json, e.g. to checkpoint an import.
+        The staging tables of completed steps were committed, so they survive a failure of a later step.
+        '''
+        with self._lock:
+            return {
+                'tables': {step: dict(self.tables[step]) for step in self.completed if step in self.tables},
+                'statements': {step: [list(u) for u in self.statements[step]] for step in self.completed
+                               if step in self.statements},
+                'completed': sorted(self.completed),
+            }
+
+    @classmethod
+    def from_state(cls, state: dict) -> 'Staging':
+        '''
+        Restores the staging of completed steps from `state`.
+        '''
+        staging = cls()
+        staging.tables = {step: dict(tables) for step, tables in state.get('tables', {}).items()}
+        staging.statements = {step: [tuple(u) for u in statements]
+                              for step, statements in state.get('statements', {}).items()}
+        staging.completed = set(state.get('completed', []))
+        return staging
+
+    @contextmanager
+    def activate(self, step: str):
+        '''
+        Stages everything the current thread writes in the block as part of `step`.
+        '''
+        token = _staging.set((self, step))
+        try:
+            yield self
+        finally:
+            _staging.reset(token)
+
+    def complete(self, step: str):
+        '''
+        Marks `step` as committed, so its staging tables are visible to the following steps.
+        '''
+        with self._lock:
+            self.completed.add(step)
+
+    def discard(self, step: str):
+        '''
+        Forgets the staging tables of a step whose transaction was rolled back, which also dropped the tables.
+        '''
+        with self._lock:
+            self.tables.pop(step, None)
+            self.statements.pop(step, None)
+
+    def _create_table(self, destination: str, constraints: bool = True) -> str:
+        name = 'staging_' + ''.join(random.choice(string.ascii_lowercase) for _ in range(10))
+        with connection.cursor() as cursor:
+            if constraints:
+                cursor.execute(sql.SQL('create table {} (like {} including defaults including identity)').format(
+                    sql.Identifier(name), sql.Identifier(destination)))
+            else:
+                # rows staged for a statement only contain some columns
+                cursor.execute(sql.SQL('create table {} as select * from {} with no data').format(
+                    sql.Identifier(name), sql.Identifier(destination)))
+        return name
+
+    def table_for(self, step: str, destination: str) -> str:
+        # a step only runs on one thread, so only the dict of all steps is shared
+        with self._lock:
+            tables = self.tables.setdefault(step, {})
+        if destination not in tables:
+            tables[destination] = self._create_table(destination)
+        return tables[destination]
+
+    def statement_table_for(self, step: str, destination: str, statement: Callable[[str], sql.Composable]) -> str:
+        '''
+        Returns a new staging table whose rows are applied by `statement` when the staging is published.
+        :param statement: returns the statement for the name of the staging table, see BulkWriter.statement
+        '''
+        table = self._create_table(destination, constraints=False)
+        with connection.cursor() as cursor:
+            query = statement(table).as_string(cursor.cursor)
+        with self._lock:
+            self.statements.setdefault(step, []).append((table, query))
+        return table
+
+    def visible_tables(self, step: str, destination: str):
+        with self._lock:
+            return [tables[destination] for s, tables in self.tables.items()
+                    if (s in self.completed or s == step) and destination in tables]
+
+    def publish(self) -> int:
+        '''
+        Copies all staged rows into their destination tables and then applies the staged statements.
+        Should run in a transaction. Foreign keys are deferred, so the order of the tables does not matter.
+        :return: the number of inserted rows
+        '''
+        rows = 0
+        with connection.cursor() as cursor:
+            for tables in self.tables.values():
+                for destination, table in tables.items():
+                    # identity columns (ids of many-to-many tables) are generated by the destination table
+                    cursor.execute('''
+                        select column_name from information_schema.columns
+                        where table_name = %s and table_schema = current_schema() and is_identity = 'NO'
+                        order by ordinal_position
+                    ''', [destination])
+                    columns = sql.SQL(', ').join(sql.Identifier(r[0]) for r in cursor.fetchall())
+                    cursor.execute(sql.SQL('insert into {} ({}) select {} from {} on conflict do nothing').format(
+                        sql.Identifier(destination), columns, columns, sql.Identifier(table)))
+                    rows += cursor.rowcount
+            for statements in self.statements.values():
+                for table, query in statements:
+                    cursor.execute(query)
+        self.drop()
+        return rows
+
+    def drop(self):
+        with connection.cursor() as cursor:
+            for tables in self.tables.values():
+                for table in tables.values():
+                    cursor.execute(sql.SQL('drop table if exists {}').format(sql.Identifier(table)))
+            for statements in self.statements.values():
+                for table, _ in statements:
+                    cursor.execute(sql.SQL('drop table if exists {}').format(sql.Identifier(table)))
+        self.tables, self.statements = {}, {}
+
+
+def assign_ids(df: pandas.DataFrame, queryset: QuerySet, columns: str | list[str] = 'identifier',
+               fields: str | list[str] | None = None) -> pandas.Series:
+    '''
+    Sets the `id` column of `df` to the ids of the rows of `queryset` that match on `columns` and to new uuids for
+    the rows that do not exist yet, see `resolve_identifiers`.
+    :param columns: a column or a list of columns of `df`
+    :param fields: the fields of the queryset the columns are matched against. defaults to `columns`.
+    :return: a boolean series that is true for the new rows
+    '''
+    if isinstance(columns, str):
+        keys = df[columns]
+    else:
+        keys = pandas.Series(list(zip(*[df[c] for c in columns])), index=df.index, dtype=object)
+    existing = resolve_identifiers(queryset, keys.unique(), fields=fields or columns, missing='ignore')
+    df['id'] = [existing.get(k) for k in keys]
+    new_rows = df['id'].isna()
+    df.loc[new_rows, 'id'] = [str(uuid.uuid4()) for _ in range(new_rows.sum())]
+    return new_rows
+
+
+def set_column_compression(schema_editor, table: str, column: str, method: str = 'lz4'):
+    '''
+    Sets the compression postgres uses for large values of `column` (TOAST) if the server was built with `method`.
+    Otherwise the values stay compressed with the default pglz. Meant to be called from migrations.
+    '''
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("select %s = any(enumvals) from pg_settings where name = 'default_toast_compression'",
+                       [method])
+        row = cursor.fetchone()
+    if row is None or not row[0]:
+        logging.warning('Compression %s is not supported by the database. %s.%s keeps the default.', method, table,
+                        column)
+        return
+    statement = sql.SQL('alter table {} alter column {} set compression {}').format(
+        sql.Identifier(table), sql.Identifier(column), sql.Identifier(method))
+    schema_editor.execute(statement.as_string(schema_editor.connection.connection))
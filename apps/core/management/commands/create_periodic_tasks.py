@@ -36,4 +36,18 @@ class Command(BaseCommand):
             task='apps.computing.computing_executions.backend.k8s.tasks.cleanup_pod_errors'
         )
 
+        # federation
+        PeriodicTask.objects.get_or_create(
+            interval=interval_1_min,
+            name='Send outbox messages',
+            task='apps.federation.outbox.tasks.process_outbox_messages'
+        )
+
+        interval_1_day, _ = IntervalSchedule.objects.get_or_create(period=IntervalSchedule.DAYS, every=1)
+        PeriodicTask.objects.get_or_create(
+            interval=interval_1_day,
+            name='Archive federation messages',
+            task='apps.federation.tasks.archive_messages'
+        )
+
         self.stdout.write('Done.')
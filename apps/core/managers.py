@@ -1,5 +1,6 @@
 from django.db import models
 
+from apps.core import db_utils
 
 
 class BaseManager(models.Manager):
@@ -15,6 +16,13 @@ class BaseManager(models.Manager):
     def filter_by_identifiers(self, identifiers: list[str]):
         return self.filter(identifier__in=identifiers)
 
+    def resolve_identifiers(self, identifiers, missing='raise'):
+        '''
+        Returns a dict identifier -> id (as str) for all `identifiers` with a single query.
+        See db_utils.resolve_identifiers.
+        '''
+        return db_utils.resolve_identifiers(self.get_queryset(), identifiers, missing=missing)
+
     def for_user(self, user):
         '''
 
@@ -0,0 +1,121 @@
+import io
+import json
+import logging
+import uuid
+from datetime import timedelta
+from itertools import groupby
+from pathlib import Path
+from typing import Type
+
+import zstandard
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from apps.core import db_utils
+from apps.federation.models import Message
+
+# the payload fields of a message that are moved into the archive. everything else stays in the table.
+PAYLOAD_FIELDS = ['message', 'extra_data', 'response_body']
+# only one worker archives at a time, see archive_messages
+ARCHIVE_LOCK = 'federation_archive'
+
+
+class ArchivedMessageNotFound(Exception):
+    pass
+
+
+def get_archive_path(name: str) -> Path:
+    return settings.FEDERATION_ARCHIVE_DIR / name
+
+
+def archive_messages(model: Type[Message], days: int | None = None, batch_size: int | None = None) -> int:
+    '''
+    Moves the payload of the processed messages of `model` that are older than `days` into zstd compressed json
+    lines files and keeps only the metadata rows in the table. The files are partitioned by the month the messages
+    were created in (<box>/<yyyy-mm>/<file>.jsonl.zst), so old months can be backed up or removed as a whole.
+    A message keeps the name of its archive file and can be restored from it, see restore_message.
+    :param days: defaults to settings.FEDERATION_MESSAGE_RETENTION_DAYS
+    :param batch_size: number of messages per file, defaults to settings.FEDERATION_ARCHIVE_BATCH_SIZE
+    :return: the number of archived messages
+    '''
+    days = settings.FEDERATION_MESSAGE_RETENTION_DAYS if days is None else days
+    batch_size = batch_size or settings.FEDERATION_ARCHIVE_BATCH_SIZE
+    cutoff = timezone.now() - timedelta(days=days)
+    qs = model.objects.filter(processed=True, archive__isnull=True, date_created__lt=cutoff) \
+        .order_by('date_created').values('id', 'date_created', *PAYLOAD_FIELDS)
+    archived = 0
+    with db_utils.try_advisory_lock(ARCHIVE_LOCK, 0) as locked:
+        if not locked:
+            logging.info('Messages are archived by another worker.')
+            return 0
+        logging.info('[start] archiving %s older than %s', model._meta.verbose_name_plural, cutoff)
+        while True:
+            rows = list(qs[:batch_size])
+            if len(rows) == 0:
+                break
+            for month, month_rows in groupby(rows, key=lambda r: r['date_created'].strftime('%Y-%m')):
+                month_rows = list(month_rows)
+                name = write_archive(f'{model._meta.app_label}/{month}', month_rows)
+                # the payload is only removed once the file is written
+                archived += model.objects.filter(pk__in=[r['id'] for r in month_rows], archive__isnull=True) \
+                    .update(archive=name, message={}, extra_data=None, response_body=None)
+        logging.info('[end] archiving %s: %s messages', model._meta.verbose_name_plural, archived)
+    return archived
+
+
+def write_archive(partition: str, rows) -> str:
+    '''
+    Writes `rows` into a new archive file of `partition`.
+    :return: the name of the file relative to settings.FEDERATION_ARCHIVE_DIR
+    '''
+    name = f'{partition}/{timezone.now():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}.jsonl.zst'
+    path = get_archive_path(name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix('.tmp')
+    with tmp.open('wb') as f:
+        with zstandard.ZstdCompressor().stream_writer(f, closefd=False) as writer:
+            text = io.TextIOWrapper(writer, encoding='utf-8')
+            for row in rows:
+                text.write(json.dumps(row, cls=DjangoJSONEncoder) + '\n')
+            text.flush()
+    # a partially written file is never referenced
+    tmp.rename(path)
+    return name
+
+
+def read_archive(name: str):
+    '''
+    Yields the archived rows of the file `name`.
+    '''
+    with get_archive_path(name).open('rb') as f:
+        reader = io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(f), encoding='utf-8')
+        for line in reader:
+            yield json.loads(line)
+
+
+def read_archived_message(message: Message) -> dict:
+    '''
+    Returns the archived payload fields of `message`.
+    :raises ArchivedMessageNotFound: if the file or the message in the file is missing
+    '''
+    try:
+        row = next((row for row in read_archive(message.archive) if row['id'] == message.id_as_str), None)
+    except FileNotFoundError:
+        row = None
+    if row is None:
+        raise ArchivedMessageNotFound(f'Message {message.pk} not found in archive {message.archive}.')
+    return {field: row[field] for field in PAYLOAD_FIELDS}
+
+
+def restore_message(message: Message):
+    '''
+    Moves the payload of an archived message back into the table, e.g. to replay it. Does nothing if the message is
+    not archived. The archive file is kept.
+    '''
+    if message.archive is None:
+        return
+    for field, value in read_archived_message(message).items():
+        setattr(message, field, value)
+    message.archive = None
+    message.save(update_fields=[*PAYLOAD_FIELDS, 'archive'])
@@ -0,0 +1,85 @@
+import gzip
+import json
+from typing import BinaryIO, Dict, Iterable, List, Tuple
+
+import zstandard
+from django.conf import settings
+
+IDENTITY = 'identity'
+GZIP = 'gzip'
+ZSTD = 'zstd'
+# key of the content encodings a node accepts in Node.capabilities
+CAPABILITY_CONTENT_ENCODINGS = 'content_encodings'
+
+
+class UnsupportedEncodingException(Exception):
+    pass
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == IDENTITY:
+        return data
+    if encoding == GZIP:
+        return gzip.compress(data)
+    if encoding == ZSTD:
+        return zstandard.ZstdCompressor().compress(data)
+    raise UnsupportedEncodingException(encoding)
+
+
+def decompress_stream(stream: BinaryIO, encoding: str) -> BinaryIO:
+    '''
+    Wraps `stream` so it is decompressed while it is read.
+    '''
+    if encoding == IDENTITY:
+        return stream
+    if encoding == GZIP:
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    if encoding == ZSTD:
+        return zstandard.ZstdDecompressor().stream_reader(stream)
+    raise UnsupportedEncodingException(encoding)
+
+
+def accepted_encodings() -> List[str]:
+    '''
+    The encodings this node accepts, in order of preference.
+    '''
+    return [e for e in settings.FEDERATION_CONTENT_ENCODINGS if e in [ZSTD, GZIP]]
+
+
+def parse_accept_encoding(header: str | None) -> List[str]:
+    '''
+    Parses an `Accept-Encoding` header into the list of encodings without weights. Encodings with q=0 are dropped.
+    '''
+    if not header:
+        return []
+    encodings = []
+    for part in header.split(','):
+        name, *params = [p.strip() for p in part.split(';')]
+        if name and not any(p.replace(' ', '') in ['q=0', 'q=0.0'] for p in params):
+            encodings.append(name.lower())
+    return encodings
+
+
+def negotiate(remote_encodings: Iterable[str], size: int) -> str:
+    '''
+    Returns the preferred encoding of this node that the remote node accepts as well. Small bodies are not compressed.
+    :param remote_encodings: the encodings the remote node accepts
+    :param size: the size of the uncompressed body
+    '''
+    if size < settings.FEDERATION_COMPRESS_MIN_SIZE:
+        return IDENTITY
+    remote_encodings = set(remote_encodings)
+    return next((e for e in accepted_encodings() if e in remote_encodings), IDENTITY)
+
+
+def encode_json(payload, remote_encodings: Iterable[str]) -> Tuple[bytes, Dict[str, str]]:
+    '''
+    Serializes `payload` as json and compresses it for a node that accepts `remote_encodings`.
+    :return: the body and the headers to send it with
+    '''
+    data = json.dumps(payload).encode('utf-8')
+    encoding = negotiate(remote_encodings, len(data))
+    headers = {'content-type': 'application/json'}
+    if encoding != IDENTITY:
+        headers['content-encoding'] = encoding
+    return compress(data, encoding), headers
@@ -0,0 +1,22 @@
+# Generated by Django 4.1.9 on 2026-10-18 00:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('file_transfer', '0009_downloadtoken_challenge'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transferitem',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='transferitem',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['date_created'], name='transfer_item_pending_idx'),
+        ),
+    ]
@@ -2,12 +2,21 @@ import urllib
 import uuid
 
 import urllib
+from datetime import timedelta
+
 from django.conf import settings
 from django.db import models
+from django.utils import timezone
 
 from apps.core.models import Base, CreatedByMixin
 
 class TransferItem(CreatedByMixin, Base):
+    class Meta:
+        indexes = [
+            models.Index(name='transfer_item_pending_idx', fields=['date_created'],
+                         condition=models.Q(status='pending')),
+        ]
+
     class Status(models.TextChoices):
         PENDING = 'pending'  # created in this application but not yet created in the downloader
         CREATED = 'created'  # created in the downloader
@@ -24,6 +33,8 @@ class TransferItem(CreatedByMixin, Base):
     file = models.ForeignKey('storage.File', on_delete=models.CASCADE, related_name='transfers')
     status = models.CharField(choices=Status.choices, default=Status.PENDING, max_length=20)
     transfer_job = models.ForeignKey('TransferJob', on_delete=models.CASCADE, related_name='transfer_items')
+    # when a worker claimed the item, see unclaimed
+    claimed_at = models.DateTimeField(null=True, blank=True, default=None)
 
     def __str__(self):
         return f'{self.file} ({self.status})'
@@ -40,6 +51,17 @@ class TransferItem(CreatedByMixin, Base):
     def removed(self):
         return self.status == TransferItem.Status.COMPLETE and self.download_gid is None
 
+    @staticmethod
+    def unclaimed(queryset=None):
+        '''
+        Filters `queryset` for the items that are not claimed by a worker. A claim expires after
+        settings.FILE_TRANSFER_CLAIM_TIMEOUT seconds, so the items of a worker that died are picked up again.
+        '''
+        if queryset is None:
+            queryset = TransferItem.objects.all()
+        expired = timezone.now() - timedelta(seconds=settings.FILE_TRANSFER_CLAIM_TIMEOUT)
+        return queryset.filter(models.Q(claimed_at__isnull=True) | models.Q(claimed_at__lt=expired))
+
 
 class TransferJob(CreatedByMixin, Base):
     project = models.ForeignKey('project.Project', null=True, blank=True, on_delete=models.CASCADE,
@@ -47,7 +69,8 @@ class TransferJob(CreatedByMixin, Base):
     query = models.JSONField(default=dict, blank=True)
 
     def restart(self):
-        self.transfer_items.filter(status=TransferItem.Status.ERROR).update(status=TransferItem.Status.PENDING)
+        self.transfer_items.filter(status=TransferItem.Status.ERROR).update(status=TransferItem.Status.PENDING,
+                                                                           claimed_at=None)
         self.start()
 
     def start(self):
@@ -2,7 +2,9 @@ import logging
 
 import httpx
 from django.conf import settings
+from django.utils import timezone
 
+from apps.core import db_utils
 from apps.federation.file_transfer.backends import get_file_download_backend
 from apps.federation.file_transfer.models import TransferItem, TransferJob
 from apps.storage.storage_importer.tasks import import_single_file
@@ -11,13 +13,29 @@ from config import celery_app
 download_backend = get_file_download_backend()()
 
 
+def claim_transfer_items(queryset):
+    '''
+    Claims the unclaimed items of `queryset` in batches of settings.FILE_TRANSFER_BATCH_SIZE, so several workers can
+    process the same items without processing an item twice.
+    '''
+    queryset = TransferItem.unclaimed(queryset).order_by('date_created')
+    while True:
+        batch = db_utils.claim_batch(queryset, settings.FILE_TRANSFER_BATCH_SIZE, claimed_at=timezone.now())
+        if len(batch) == 0:
+            break
+        yield from batch
+
+
 @celery_app.task
 def create_downloads():
-    for ti in TransferItem.objects.filter(status=TransferItem.Status.PENDING):
+    for ti in claim_transfer_items(TransferItem.objects.filter(status=TransferItem.Status.PENDING)):
         create_download(ti)
 
 
 def create_download(transfer_item: TransferItem) -> None:
+    # the claim is released with the new status, so the completed item can be claimed by
+    # post_process_complete_downloads
+    transfer_item.claimed_at = None
     if transfer_item.file.origin.node.identifier != settings.IDENTIFIER:
         download_backend.download_file(transfer_item)
     else:
@@ -25,12 +43,12 @@ def create_download(transfer_item: TransferItem) -> None:
         file = transfer_item.file
         project.files.through.objects.filter(user=transfer_item.created_by, file=file).update(imported=True)
         transfer_item.status = TransferItem.Status.COMPLETE
-        transfer_item.save(update_fields=["status"])
+        transfer_item.save(update_fields=["status", "claimed_at"])
 
 @celery_app.task
 def start_transfer_job(job_pk):
     tj = TransferJob.objects.get(pk=job_pk)
-    for i in tj.transfer_items.all():  # TODO filter for pending?
+    for i in claim_transfer_items(tj.transfer_items.filter(status=TransferItem.Status.PENDING)):
         create_download(i)
 
 
@@ -110,8 +128,10 @@ def purge_downloads_from_aria2():
 
 @celery_app.task
 def post_process_complete_downloads():
+    # the file is imported asynchronously. the claim keeps the next runs from importing it again in the meantime.
     # remove from aria2 to prevent re-downloading after aria2 restart
-    for ti in TransferItem.objects.filter(status__in=[TransferItem.Status.COMPLETE], file__imported=False):
+    for ti in claim_transfer_items(TransferItem.objects.filter(status=TransferItem.Status.COMPLETE,
+                                                               file__imported=False)):
         import_completed_downloads(transfer_item_pk=ti.id_as_str)
         if not ti.removed:
             # remove download and import file
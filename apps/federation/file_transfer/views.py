@@ -2,7 +2,7 @@ import logging
 from urllib.parse import unquote
 
 from django.core.cache import cache
-from django.http import HttpResponse, FileResponse
+from django.http import HttpResponse, FileResponse, StreamingHttpResponse
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.views import APIView
 
@@ -12,7 +12,11 @@ from apps.blockchain.models import Log
 from apps.core import identifier
 from apps.federation.file_transfer.backends import get_file_serve_backend, BaseFileServeBackend
 from apps.federation.file_transfer.models import DownloadToken
+from apps.federation.outbox.models import OutboxMessage
+from apps.federation.payload import get_payload_path, get_payload_name
 from apps.permission.models import Permission
+from apps.share.package import get_package_path
+from apps.share.share_token.models import ShareToken
 from apps.storage.models import File
 from apps.user.user_profile.models import Profile
 
@@ -41,6 +45,13 @@ class FileServeView(APIView):
             Log.send_broadcast(DownloadMessage(actor=user.to_actor(), object=Object(model="file", value=[file_identifier])), send_async=True)
 
     def get(self, request, **kwargs):
+        package_hash = request.GET.get('package', None)
+        if package_hash is not None:
+            return self.get_package(request, package_hash)
+        payload_hash = request.GET.get('payload', None)
+        if payload_hash is not None:
+            return self.get_payload(request, payload_hash)
+
         # TODO cache if the user is permitted to download a file and then serve the download directly to avoid a high server load
         file_identifier = request.GET.get('id', None)
         if file_identifier is None:
@@ -89,27 +100,81 @@ class FileServeView(APIView):
                                     filename=file_name)
             else:
                 file_size = self.backend.get_file_size(file_identifier)
-                range_header = request.headers['Range']
-                start, end = range_header.split('=')[1].split('-')
-                start = int(start.strip())
-                end = int(end.strip()) if end else file_size - 1
-
-                logging.info(f'Range {start} - {end} requested for file {file_identifier}.')
-
-
-                # Validate the range
-                if start >= file_size or end >= file_size or start > end:
-                    return HttpResponse("Requested range not satisfiable", status=416)
-                # Open the file and seek to the requested position
-                file_handle.seek(start)
-                content = file_handle.read(end - start + 1)
-
-                # Create the response
-                response = HttpResponse(content, status=206)
-                response['Content-Type'] = 'application/octet-stream'
-                response['Content-Length'] = str(len(content))
-                response['Content-Range'] = f'bytes {start}-{end}/{file_size}'
-                response["Content-Disposition"] = f"attachment; filename=\"{file_name}\""
-                self.log_to_blockchain(user, download_token, file_identifier)
+                response = self.range_response(request, file_handle, file_size, file_name)
+                if response.status_code == 206:
+                    self.log_to_blockchain(user, download_token, file_identifier)
                 return response
         return HttpResponse(status=403)
+
+    def range_response(self, request, file_handle, file_size, file_name):
+        range_header = request.headers['Range']
+        start, end = range_header.split('=')[1].split('-')
+        start = int(start.strip())
+        end = int(end.strip()) if end else file_size - 1
+
+        logging.info(f'Range {start} - {end} requested for file {file_name}.')
+
+        # Validate the range
+        if start >= file_size or end >= file_size or start > end:
+            file_handle.close()
+            return HttpResponse("Requested range not satisfiable", status=416)
+        # Open the file and seek to the requested position
+        file_handle.seek(start)
+
+        # Create the response. the range is streamed, so a large range is not read into memory.
+        response = StreamingHttpResponse(self.read_range(file_handle, end - start + 1), status=206)
+        response['Content-Type'] = 'application/octet-stream'
+        response['Content-Length'] = str(end - start + 1)
+        response['Content-Range'] = f'bytes {start}-{end}/{file_size}'
+        response["Content-Disposition"] = f"attachment; filename=\"{file_name}\""
+        return response
+
+    @staticmethod
+    def read_range(file_handle, length, chunk_size=1024 * 1024):
+        try:
+            while length > 0:
+                chunk = file_handle.read(min(chunk_size, length))
+                if not chunk:
+                    break
+                length -= len(chunk)
+                yield chunk
+        finally:
+            file_handle.close()
+
+    def get_package(self, request, package_hash):
+        '''
+        Serves a share package by its hash to nodes that received a share token for a share with this package.
+        '''
+        package_hash = unquote(package_hash)
+        node = request.auth
+        if not ShareToken.objects.filter(recipient__node=node, share__package__sha256=package_hash).exists():
+            logging.warning('Node %s requested package %s without a share token.', node, package_hash)
+            return HttpResponse(status=403)
+
+        path = get_package_path(f'{package_hash}.pkg')
+        # the hash is user input so make sure it does not point outside the package dir
+        if path.parent != get_package_path('') or not path.exists():
+            return HttpResponse(status=404)
+        return self.serve_path(request, path)
+
+    def get_payload(self, request, payload_hash):
+        '''
+        Serves the payload file of a large federation message to the node the message was sent to, see
+        apps.federation.payload. The node resumes an interrupted download with a range request.
+        '''
+        payload_hash = unquote(payload_hash)
+        node = request.auth
+        if not OutboxMessage.objects.filter(recipient__node=node, payload=payload_hash).exists():
+            logging.warning('Node %s requested payload %s that was not sent to it.', node, payload_hash)
+            return HttpResponse(status=403)
+
+        path = get_payload_path(get_payload_name(payload_hash))
+        # the hash is user input so make sure it does not point outside the payload dir
+        if path.parent != get_payload_path('') or not path.exists():
+            return HttpResponse(status=404)
+        return self.serve_path(request, path)
+
+    def serve_path(self, request, path):
+        if 'Range' not in request.headers:
+            return FileResponse(path.open('rb'), as_attachment=True, filename=path.name)
+        return self.range_response(request, path.open('rb'), path.stat().st_size, path.name)
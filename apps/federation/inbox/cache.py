@@ -0,0 +1,52 @@
+from django.conf import settings
+
+from apps.core.cache import TTLCache
+from apps.node.models import Node
+from apps.user.user_profile.models import Profile
+
+# (profile identifier, node identifier) -> Profile, see get_profile
+profiles = TTLCache(settings.FEDERATION_INBOX_CACHE_TTL, settings.FEDERATION_INBOX_CACHE_SIZE)
+# common name -> Node, see get_node_by_common_name
+nodes = TTLCache(settings.FEDERATION_INBOX_CACHE_TTL, settings.FEDERATION_INBOX_CACHE_SIZE)
+NODE_USER = 'node'
+
+
+def get_profile(identifier: str, node_identifier: str) -> Profile:
+    '''
+    Returns the profile `identifier` of the node `node_identifier`. The profiles are cached for
+    settings.FEDERATION_INBOX_CACHE_TTL seconds and dropped from the cache of this process when a profile or node is
+    saved or deleted.
+    :raises Profile.DoesNotExist:
+    '''
+    profile = profiles.get_or_set((identifier, node_identifier), lambda: Profile.objects.select_related('node').filter(
+        identifier=identifier, node__identifier=node_identifier).first())
+    if profile is None:
+        raise Profile.DoesNotExist(f'Profile {identifier} of node {node_identifier} does not exist.')
+    return profile
+
+
+def get_node_by_common_name(common_name: str) -> Node:
+    '''
+    Returns the node with the certificate `common_name`, cached like get_profile.
+    :raises Node.DoesNotExist:
+    '''
+    node = nodes.get_or_set(common_name, lambda: Node.objects.filter(common_name=common_name).first())
+    if node is None:
+        raise Node.DoesNotExist(f'Node with common name {common_name} does not exist.')
+    return node
+
+
+def get_user_node() -> Profile:
+    '''
+    apps.utils.get_user_node with its user, cached like get_profile.
+    '''
+    profile = profiles.get_or_set(NODE_USER, lambda: Profile.objects.select_related('user', 'node').filter(
+        user__username=NODE_USER).first())
+    if profile is None:
+        raise Profile.DoesNotExist('The profile of this node does not exist.')
+    return profile
+
+
+def clear():
+    profiles.clear()
+    nodes.clear()
@@ -0,0 +1,41 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count, Min, Q
+from django.utils import timezone
+from psycopg2 import sql
+
+from apps.federation.inbox.models import InboxMessage
+
+
+def inbox_metrics():
+    '''
+    Returns the depth of every shard and lane of the inbox and the processing latency (seconds from receiving to
+    processing a message) of the messages processed in the last settings.FEDERATION_INBOX_METRICS_WINDOW seconds.
+    '''
+    now = timezone.now()
+    pending = InboxMessage.objects.filter(processed=False)
+
+    def depth(field):
+        rows = pending.values(field).annotate(pending=Count('id'), processing=Count('id', filter=Q(processing=True)),
+                                              oldest=Min('date_created')).order_by(field)
+        return [{field: row[field], 'pending': row['pending'], 'processing': row['processing'],
+                 'oldest_pending_age': round((now - row['oldest']).total_seconds(), 3)} for row in rows]
+
+    since = now - timedelta(seconds=settings.FEDERATION_INBOX_METRICS_WINDOW)
+    with connection.cursor() as cursor:
+        cursor.execute(sql.SQL('''
+            select priority, count(*), avg(latency), percentile_cont(0.5) within group (order by latency),
+                percentile_cont(0.95) within group (order by latency), max(latency)
+            from (select priority, extract(epoch from processed_at - date_created) as latency
+                  from {} where processed_at >= %s) processed
+            group by priority order by priority''').format(sql.Identifier(InboxMessage._meta.db_table)), [since])
+        latency = [{'priority': row[0], 'processed': row[1],
+                    **{k: round(float(v), 3) for k, v in zip(['avg', 'p50', 'p95', 'max'], row[2:])}}
+                   for row in cursor.fetchall()]
+    return {
+        'shards': depth('shard'),
+        'lanes': depth('priority'),
+        'latency': {'window': settings.FEDERATION_INBOX_METRICS_WINDOW, 'lanes': latency},
+    }
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.9 on 2026-10-17 23:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inbox', '0010_alter_inboxmessage_recipient'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='inboxmessage',
+            name='checkpoint',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.1.9 on 2026-10-18 00:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inbox', '0012_inboxmessage_message_compression'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='inboxmessage',
+            name='priority',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'Control'), (1, 'Default'), (2, 'Bulk')], default=1),
+        ),
+        migrations.AddField(
+            model_name='inboxmessage',
+            name='size',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
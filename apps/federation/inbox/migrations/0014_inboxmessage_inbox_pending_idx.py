@@ -0,0 +1,17 @@
+# Generated by Django 4.1.9 on 2026-10-18 00:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inbox', '0013_inboxmessage_priority_inboxmessage_size'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='inboxmessage',
+            index=models.Index(condition=models.Q(('processed', False), ('processing', False)), fields=['priority', 'size', 'date_created'], name='inbox_pending_idx'),
+        ),
+    ]
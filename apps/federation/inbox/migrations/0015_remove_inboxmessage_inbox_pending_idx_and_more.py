@@ -0,0 +1,35 @@
+# Generated by Django 4.1.9 on 2026-10-18 00:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inbox', '0014_inboxmessage_inbox_pending_idx'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='inboxmessage',
+            name='inbox_pending_idx',
+        ),
+        migrations.AddField(
+            model_name='inboxmessage',
+            name='processed_at',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='inboxmessage',
+            name='shard',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='inboxmessage',
+            index=models.Index(condition=models.Q(('processed', False), ('processing', False)), fields=['shard', 'date_created'], name='inbox_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='inboxmessage',
+            index=models.Index(fields=['processed_at'], name='inbox_processed_at_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.9 on 2026-10-18 00:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inbox', '0016_inboxmessage_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='inboxmessage',
+            name='message_id',
+            field=models.CharField(blank=True, default=None, max_length=100, null=True, unique=True),
+        ),
+    ]
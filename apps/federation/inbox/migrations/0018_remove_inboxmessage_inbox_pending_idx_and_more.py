@@ -0,0 +1,26 @@
+# Generated by Django 4.1.9 on 2026-10-18 00:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inbox', '0017_inboxmessage_message_id'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='inboxmessage',
+            name='inbox_pending_idx',
+        ),
+        migrations.AddField(
+            model_name='inboxmessage',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='inboxmessage',
+            index=models.Index(condition=models.Q(('processed', False)), fields=['shard', 'date_created'], name='inbox_pending_idx'),
+        ),
+    ]
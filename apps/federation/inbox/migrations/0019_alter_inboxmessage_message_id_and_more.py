@@ -0,0 +1,22 @@
+# Generated by Django 4.1.9 on 2026-10-18 01:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inbox', '0018_remove_inboxmessage_inbox_pending_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='inboxmessage',
+            name='message_id',
+            field=models.CharField(blank=True, default=None, max_length=100, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='inboxmessage',
+            constraint=models.UniqueConstraint(fields=('sender', 'message_id'), name='inbox_sender_message_id_uniq'),
+        ),
+    ]
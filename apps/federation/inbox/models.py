@@ -1,9 +1,13 @@
 import logging
 import typing
+import zlib
+from functools import partial
 from typing import Any
 
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 
 from apps.core.models import Base
 from apps.federation.models import Message
@@ -13,13 +17,84 @@ from apps.user.user_profile.models import Profile
 
 
 class InboxMessage(Message):
+    class Meta:
+        indexes = [
+            # the pending messages of a shard in the order process_inbox_shard claims them
+            models.Index(name='inbox_pending_idx', fields=['shard', 'date_created'],
+                         condition=models.Q(processed=False)),
+            models.Index(name='inbox_processed_at_idx', fields=['processed_at']),
+        ]
+        constraints = [
+            # the ids are only unique per sender, so a sender cannot suppress the messages of another sender
+            models.UniqueConstraint(name='inbox_sender_message_id_uniq', fields=['sender', 'message_id']),
+        ]
+
     # business key for correlation
     business_key = models.CharField(max_length=100, blank=True, null=True, default=None)
+    # progress of a long running import. is kept if the import fails so a retry can resume from it.
+    checkpoint = models.JSONField(default=dict, blank=True)
+    # size of the received message in bytes as uncompressed json, see Message.get_size
+    size = models.PositiveIntegerField(default=0)
+    # the messages of a sender are processed in order by the worker of their shard, see get_shard
+    shard = models.PositiveSmallIntegerField(default=0)
+    processed_at = models.DateTimeField(null=True, blank=True, default=None)
+    # the id the sender gave the message, see apps.federation.messages.Message.id. a message is only stored once per
+    # sender.
+    message_id = models.CharField(max_length=100, null=True, blank=True, default=None)
 
     def save(self, *args, **kwargs):
         self.box = Message.Box.INBOX
+        if self._state.adding:
+            self.shard = InboxMessage.get_shard(self.sender_id)
         return super(InboxMessage, self).save(*args, **kwargs)
 
+    @classmethod
+    def pending(cls, claim_timeout=None, max_tries=None):
+        '''
+        Message.pending with settings.FEDERATION_INBOX_CLAIM_TIMEOUT and settings.FEDERATION_INBOX_MAX_TRIES.
+        '''
+        return super().pending(claim_timeout or settings.FEDERATION_INBOX_CLAIM_TIMEOUT,
+                               max_tries or settings.FEDERATION_INBOX_MAX_TRIES)
+
+    @staticmethod
+    def get_shard(sender_id) -> int:
+        '''
+        Returns the shard of the messages of the sender profile `sender_id`, one of settings.FEDERATION_INBOX_SHARDS.
+        '''
+        return zlib.crc32(str(sender_id).encode()) % settings.FEDERATION_INBOX_SHARDS
+
+    @staticmethod
+    def get_message_id(message) -> str | None:
+        '''
+        Returns the id the sender gave the received `message` or None if the sender does not set ids.
+        '''
+        message_id = message.get('id') if isinstance(message, dict) else None
+        return str(message_id)[:100] if message_id else None
+
+    @staticmethod
+    def get_received(sender: Profile, message_id: str | None) -> typing.Optional['InboxMessage']:
+        '''
+        Returns the message with the id `message_id` of `sender` if it was already received.
+        '''
+        if not message_id:
+            return None
+        return InboxMessage.objects.only('id').filter(sender=sender, message_id=message_id).first()
+
+    def process(self):
+        '''
+        Processes the shard of the message in the celery queue of its lane after the current transaction is committed.
+        '''
+        from apps.federation.inbox.tasks import process_inbox_shard
+        transaction.on_commit(partial(process_inbox_shard.apply_async, (self.shard,), queue=self.queue))
+
+    def save_checkpoint(self, **values):
+        '''
+        Merges `values` into the checkpoint and saves it. Without values, the checkpoint is cleared.
+        Uses an update query so it can be called from the threads of a concurrent import.
+        '''
+        self.checkpoint = {**self.checkpoint, **values} if values else {}
+        InboxMessage.objects.filter(pk=self.pk).update(checkpoint=self.checkpoint)
+
     @staticmethod
     def get_model(model):
         from apps.share.models import Share
@@ -48,6 +123,15 @@ class InboxMessage(Message):
         default = (InboxMessage.process_message, {})
         return lookup.get(model, default)
 
+    @staticmethod
+    def get_streamed_keys(model) -> list:
+        '''
+        Returns the keys of the content of a large message (see apps.federation.payload) that the method for `model`
+        reads as a stream instead of a string.
+        '''
+        from apps.share.models import STREAMED_SECTIONS
+        return STREAMED_SECTIONS if model == 'share' else []
+
     @staticmethod
     def process_message(**kwargs):
         # TODO extract this method into a MessageRouter class?
@@ -65,3 +149,10 @@ class InboxMessage(Message):
         if destination_url is None:
             logging.error('No application defined for message type %s', message_type)
             return
+
+
+@receiver([post_save, post_delete], sender=Profile)
+@receiver([post_save, post_delete], sender=Node)
+def clear_inbox_cache(**kwargs):
+    from apps.federation.inbox import cache
+    cache.clear()
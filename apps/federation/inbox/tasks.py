@@ -1,36 +1,136 @@
 import logging
 
 from celery import shared_task
-import logging
+from celery.exceptions import SoftTimeLimitExceeded
+from django.conf import settings
+from django.db.models import Exists, Min, OuterRef, Q
+from django.utils import timezone
 
+from apps.core import db_utils
+from apps.federation import payload
 from apps.federation.inbox.models import InboxMessage
 from apps.federation.messages import Message
+from apps.federation.outbox.backends import get_client
 
+# advisory lock that the worker of a shard holds, see process_inbox_shard
+SHARD_LOCK = 'inbox_shard'
 
-@shared_task
+
+@shared_task(soft_time_limit=settings.FEDERATION_INBOX_TIME_LIMIT - 60,
+             time_limit=settings.FEDERATION_INBOX_TIME_LIMIT)
 def process_inbox_message(message_id):
-    persisted_message = InboxMessage.objects.get(pk=message_id)
-    message = Message(**persisted_message.message)
-    object = message.object
-    model = id if isinstance(object, str) else object.type
+    claimed = db_utils.claim_batch(InboxMessage.pending().filter(pk=message_id), 1, **InboxMessage.claim())
+    if len(claimed) == 0:
+        logging.warning('Inbox message %s is already processed or being processed.', message_id)
+        return
+    process_claimed_inbox_message(claimed[0])
 
+
+def process_claimed_inbox_message(persisted_message: InboxMessage) -> bool:
+    '''
+    Processes a message that was claimed with processing=True.
+    :return: False if processing failed
+    '''
     try:
-        persisted_message.processing = True
-        persisted_message.save(update_fields=['processing'])
+        message = Message(**persisted_message.message)
+        object = message.object
+        model = id if isinstance(object, str) else object.type
+
+        received = None
+        if payload.is_offloaded(persisted_message.message):
+            # the content of a large message is downloaded from the sender node. the message stays the envelope and
+            # the sections the handler streams are not read into memory.
+            received = payload.fetch_payload(persisted_message.message, get_client(persisted_message.sender.node))
+            object.content = received.to_dict(streamed=InboxMessage.get_streamed_keys(model))
+
         m, kwargs = InboxMessage.get_model(model)
         logging.info('Processing inbox message %s with %s', model, m)
         kwargs.update(dict(inbox_message=persisted_message, message=message))
         m(**kwargs)
+        if received is not None:
+            received.path.unlink(missing_ok=True)
         persisted_message.processed = True
         persisted_message.processing = False
-        persisted_message.save(update_fields=['processed', 'processing'])
+        persisted_message.processed_at = timezone.now()
+        persisted_message.save(update_fields=['processed', 'processing', 'processed_at'])
     except Exception as e:
         logging.exception(e)
+        # the message is picked up again by process_inbox_messages until it failed settings.FEDERATION_INBOX_MAX_TRIES
+        # times. imports resume from the checkpoint of the message.
+        persisted_message.processing = False
+        persisted_message.tries += 1
+        persisted_message.error = str(e)
+        persisted_message.save(update_fields=['processing', 'tries', 'error'])
+        if persisted_message.tries >= settings.FEDERATION_INBOX_MAX_TRIES:
+            logging.error('Giving up on inbox message %s after %s tries. The following messages of its sender are '
+                          'processed without it.', persisted_message.pk, persisted_message.tries)
+        if isinstance(e, SoftTimeLimitExceeded):
+            raise
         # TODO send a message with the exception
+        return False
+    return True
 
 
 @shared_task
 def process_inbox_messages():
-    for message in InboxMessage.objects.filter(processed=False):
-        process_inbox_message(message.id_as_str)
+    '''
+    Queues a process_inbox_shard task for every shard with pending messages, in the lane of its most urgent message.
+    '''
+    pending = InboxMessage.pending().values('shard') \
+        .annotate(priority=Min('priority')).order_by('priority')
+    for row in pending:
+        process_inbox_shard.apply_async((row['shard'],), queue=InboxMessage.get_queue(row['priority']))
+
+
+@shared_task(soft_time_limit=settings.FEDERATION_INBOX_TIME_LIMIT - 60,
+             time_limit=settings.FEDERATION_INBOX_TIME_LIMIT)
+def process_inbox_shard(shard):
+    '''
+    Processes the pending messages of `shard` in the order they were received, so the messages of a sender are
+    processed in order. Only one worker processes a shard at a time, the workers of other shards run concurrently.
+    A message that fails blocks the following messages of its sender until it is processed, e.g. by the next run or a
+    replay, so an update is never applied before the message it refers to. The messages of other senders go on.
+    Once the failed message is given up on after settings.FEDERATION_INBOX_MAX_TRIES tries, the following messages of
+    its sender are processed again.
+    '''
+    failed, blocked = [], set()
+    qs = InboxMessage.pending().filter(shard=shard).exclude(Exists(get_blocking_messages(shard))) \
+        .order_by('date_created', 'id')
+    while True:
+        with db_utils.try_advisory_lock(SHARD_LOCK, shard) as locked:
+            if not locked:
+                logging.info('Inbox shard %s is processed by another worker.', shard)
+                return
+            while True:
+                batch = db_utils.claim_batch(qs.exclude(pk__in=failed).exclude(sender_id__in=blocked),
+                                             settings.FEDERATION_INBOX_BATCH_SIZE, **InboxMessage.claim())
+                if len(batch) == 0:
+                    break
+                try:
+                    for message in batch:
+                        if message.sender_id in blocked:
+                            continue
+                        if not process_claimed_inbox_message(message):
+                            failed.append(message.pk)
+                            if message.tries < settings.FEDERATION_INBOX_MAX_TRIES:
+                                blocked.add(message.sender_id)
+                finally:
+                    # the skipped messages and, if the time limit is hit, the rest of the batch are released
+                    InboxMessage.objects.filter(pk__in=[m.pk for m in batch], processed=False, processing=True) \
+                        .update(processing=False)
+        # a message received while the lock was released was not processed by the worker that holds the lock then
+        if not qs.exclude(pk__in=failed).exclude(sender_id__in=blocked).exists():
+            return
+
 
+def get_blocking_messages(shard):
+    '''
+    The unprocessed messages of the same sender that were received before the outer message and failed before or are
+    being processed. The outer message has to wait for them. Messages that were given up on do not block, otherwise a
+    single poison message would block its sender forever.
+    '''
+    return InboxMessage.objects.filter(shard=shard, sender_id=OuterRef('sender_id'), processed=False,
+                                       tries__lt=settings.FEDERATION_INBOX_MAX_TRIES) \
+        .filter(Q(date_created__lt=OuterRef('date_created')) |
+                Q(date_created=OuterRef('date_created'), id__lt=OuterRef('id'))) \
+        .filter(Q(tries__gt=0) | Q(processing=True))
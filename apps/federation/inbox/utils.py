@@ -5,6 +5,7 @@ from django.conf import settings
 from django.urls import reverse
 from rest_framework.authtoken.models import Token
 
+from apps.federation import encoding
 from apps.utils import get_user_node
 
 
@@ -13,7 +14,12 @@ def send_message_to_inbox(payload):
     url = settings.EXTERNAL_ADDRESS[:-1] + reverse('inbox')
     # get a token from drf
     token, _ = Token.objects.get_or_create(user=get_user_node().user)
-    response = httpx.post(url, json=payload, headers={'Authorization': f'Token {token.key}'})
+    # this node accepts its own encodings
+    content, headers = encoding.encode_json(payload, encoding.accepted_encodings())
+    headers['Authorization'] = f'Token {token.key}'
+    if payload.get('id') is not None:
+        headers['X-Message-Id'] = payload['id']
+    response = httpx.post(url, content=content, headers=headers)
     if response.status_code != 201:
         logging.error('Failed to send message to internal inbox. response code: [%s] response: [%s]',
                       response.status_code, response.text)
@@ -1,51 +1,262 @@
 import logging
-from functools import partial
 
 from django.conf import settings
-from django.db import transaction
+from django.db import IntegrityError, transaction
 from django.http import JsonResponse
 from rest_framework import status
+from rest_framework.exceptions import UnsupportedMediaType
+from rest_framework.parsers import JSONParser
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from apps.federation.inbox import tasks
+from apps.federation import encoding
+from apps.federation.inbox import cache
+from apps.federation.inbox.metrics import inbox_metrics
 from apps.federation.inbox.models import InboxMessage
+from apps.federation.models import Message
+from apps.node.models import Node
 from apps.user.user_profile.models import Profile
 
+# set on the response to a message that was already received
+REPLAYED_HEADER = 'Idempotent-Replayed'
+
+
+class EncodedJSONParser(JSONParser):
+    '''
+    Parses json bodies that are compressed with one of the encodings this node accepts.
+    '''
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        content_encoding = parser_context['request'].META.get('HTTP_CONTENT_ENCODING', encoding.IDENTITY).lower()
+        if content_encoding != encoding.IDENTITY:
+            if content_encoding not in encoding.accepted_encodings():
+                raise UnsupportedMediaType(media_type, detail=f'Unsupported content encoding {content_encoding}.')
+            stream = encoding.decompress_stream(stream, content_encoding)
+        return super().parse(stream, media_type, parser_context)
+
+
+def resolve_profiles(data):
+    '''
+    Returns the recipient and sender profiles of the received message `data`. The recipient is None for broadcasts.
+    :raises Profile.DoesNotExist:
+    '''
+    # TODO do some validation
+    # TODO use message object here
+    recipient = data.get('to', None)
+    sender = data.get('from', None)
+    object = data.get('object', None)
+    identifier_recipient = object.get('recipient')
+    identifier_sender = object.get('sender')
+    user_recipient = None
+    logging.info('Receiving message from [%s] to [%s]', identifier_sender, identifier_recipient)
+    if identifier_recipient is not None:
+        user_recipient = cache.get_profile(identifier_recipient, recipient)
+    # for user publish message the user will not be found here. that is why this message is handled in blockchain listener.
+    user_sender = cache.get_profile(identifier_sender, sender)
+    return user_recipient, user_sender
+
+
+def is_sent_by(request, sender: Profile) -> bool:
+    '''
+    Returns whether the node that authenticated with its certificate is the node of `sender`. Requests that were not
+    authenticated by a node, e.g. of an admin, are not checked.
+    '''
+    return not isinstance(request.auth, Node) or sender.node_id == request.auth.pk
+
+
+def message_location(request, message: InboxMessage):
+    location = request.build_absolute_uri(f'/message/{message.id_as_str}')
+    if not settings.DEBUG:  # the other side needs https instead of http for message correlation
+        location = location.replace('http://', 'https://')
+    return location
+
+
+def replayed_response(request, message: InboxMessage):
+    '''
+    The response to a message that was already received. It repeats the response to the first delivery, so the sender
+    treats the message as delivered, and nothing is stored or processed again.
+    '''
+    logging.info('Message %s was already received.', message.id_as_str)
+    return Response(status=status.HTTP_201_CREATED,
+                    headers={'Location': message_location(request, message), REPLAYED_HEADER: 'true'})
+
 
 class InboxView(APIView):
+    parser_classes = [EncodedJSONParser]
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        # the sender records the encodings and compresses the next messages to this node
+        response['Accept-Encoding'] = ', '.join(encoding.accepted_encodings()) or encoding.IDENTITY
+        return response
+
     def post(self, request):
         data = request.data
         business_key = request.META.get('HTTP_X_BUSINESS_KEY')
+        message_id = InboxMessage.get_message_id(data)
+        header_id = request.META.get('HTTP_X_MESSAGE_ID')
+        if header_id is not None and header_id[:100] != message_id:
+            return JsonResponse(status=status.HTTP_400_BAD_REQUEST,
+                                data={'message': 'X-Message-Id does not match the id of the message.'})
 
-        # TODO do some validation
-        # TODO use message object here
-        recipient = data.get('to', None)
-        sender = data.get('from', None)
-        object = data.get('object', None)
-        identifier_recipient = object.get('recipient')
-        identifier_sender = object.get('sender')
-        user_recipient = None
-        logging.info('Receiving message from [%s] to [%s]', identifier_sender, identifier_recipient)
         try:
-            if identifier_recipient is not None:
-                user_recipient = Profile.objects.get(identifier=identifier_recipient, node__identifier=recipient)
-            # for user publish message the user will not be found here. that is why this message is handled in blockchain listener.
-            user_sender = Profile.objects.get(identifier=identifier_sender, node__identifier=sender)
+            user_recipient, user_sender = resolve_profiles(data)
         except Profile.DoesNotExist as e:
             logging.error('User recipient or sender does not exist on this server.')
             logging.exception(e)
             return JsonResponse(status=status.HTTP_404_NOT_FOUND,
                                 data={'message': 'User recipient or sender not found.'})
+        if not is_sent_by(request, user_sender):
+            return JsonResponse(status=status.HTTP_403_FORBIDDEN,
+                                data={'message': 'The sender does not belong to the requesting node.'})
+
+        received = InboxMessage.get_received(user_sender, message_id)
+        if received is not None:
+            return replayed_response(request, received)
 
-        message = InboxMessage.objects.create(message=data,
-                                              recipient=user_recipient,
-                                              sender=user_sender,
-                                              business_key=business_key)
-        transaction.on_commit(partial(tasks.process_inbox_message.delay, message.id_as_str))
+        # not the content length, which is the compressed size if the body is encoded
+        size = InboxMessage.get_size(data)
+        try:
+            with transaction.atomic():
+                message = InboxMessage.objects.create(message=data,
+                                                      message_id=message_id,
+                                                      recipient=user_recipient,
+                                                      sender=user_sender,
+                                                      business_key=business_key,
+                                                      size=size,
+                                                      priority=InboxMessage.get_priority(data, size))
+        except IntegrityError:
+            # the same message was received concurrently
+            received = InboxMessage.get_received(user_sender, message_id)
+            if received is None:
+                raise
+            return replayed_response(request, received)
+        message.process()
 
-        message_location = request.build_absolute_uri(f'/message/{message.id_as_str}')
-        if not settings.DEBUG:  # the other side needs https instead of http for message correlation
-            message_location = message_location.replace('http://', 'https://')
         return Response(status=status.HTTP_201_CREATED,
-                        headers={'Location': message_location})
+                        headers={'Location': message_location(request, message)})
+
+
+class InboxBatchView(InboxView):
+    '''
+    Receives a list of messages in one request and stores them with a single insert. Meant for bursts of small
+    messages. The response lists the location of every stored message or the error of a message that was not
+    stored, in the order of the request. Messages that were already received are not stored again and are marked as
+    replayed, see replayed_response.
+    '''
+
+    def post(self, request):
+        data = request.data
+        if not isinstance(data, list):
+            return JsonResponse(status=status.HTTP_400_BAD_REQUEST, data={'message': 'Expected a list of messages.'})
+        if len(data) > settings.FEDERATION_INBOX_MAX_BATCH:
+            message = f'At most {settings.FEDERATION_INBOX_MAX_BATCH} messages per request.'
+            return JsonResponse(status=status.HTTP_400_BAD_REQUEST, data={'message': message})
+        business_key = request.META.get('HTTP_X_BUSINESS_KEY')
+
+        # (message, replayed) or the error of a message
+        results, messages = [], []
+        for item in data:
+            try:
+                user_recipient, user_sender = resolve_profiles(item)
+            except Profile.DoesNotExist as e:
+                logging.error('User recipient or sender of batch message does not exist on this server: %s', e)
+                results.append({'status': status.HTTP_404_NOT_FOUND,
+                                'message': 'User recipient or sender not found.'})
+                continue
+            except AttributeError:
+                results.append({'status': status.HTTP_400_BAD_REQUEST, 'message': 'Not a message.'})
+                continue
+            if not is_sent_by(request, user_sender):
+                results.append({'status': status.HTTP_403_FORBIDDEN,
+                                'message': 'The sender does not belong to the requesting node.'})
+                continue
+            size = InboxMessage.get_size(item)
+            # bulk_create does not call save, so the box is set here
+            message = InboxMessage(message=item, message_id=InboxMessage.get_message_id(item),
+                                   recipient=user_recipient, sender=user_sender, box=Message.Box.INBOX,
+                                   business_key=business_key, size=size, shard=InboxMessage.get_shard(user_sender.pk),
+                                   priority=InboxMessage.get_priority(item, size))
+            messages.append(message)
+            results.append((message, False))
+
+        received = self.get_received(messages)
+        new = []
+        for i, result in enumerate(results):
+            if isinstance(result, dict):
+                continue
+            message = result[0]
+            key = self.get_key(message)
+            if key in received:
+                results[i] = (received[key], True)
+                continue
+            if key is not None:
+                # a message that is repeated within the batch is stored once
+                received[key] = message
+            new.append(message)
+
+        # a message that was received concurrently in the meantime is skipped because of its unique id
+        InboxMessage.objects.bulk_create(new, ignore_conflicts=True)
+        skipped = self.get_skipped(new)
+        if len(skipped) > 0:
+            received.update(self.get_received([m for m in new if self.get_key(m) in skipped]))
+            new = [m for m in new if self.get_key(m) not in skipped]
+        # one task per shard and lane is enough
+        for message in {(m.shard, m.priority): m for m in new}.values():
+            message.process()
+
+        def to_result(result):
+            if isinstance(result, dict):
+                return result
+            message, replayed = result
+            if self.get_key(message) in skipped:
+                message, replayed = received[self.get_key(message)], True
+            return {'status': status.HTTP_201_CREATED, 'location': message_location(request, message),
+                    **({'replayed': True} if replayed else {})}
+
+        results = [to_result(r) for r in results]
+        created = any(r['status'] == status.HTTP_201_CREATED for r in results)
+        return Response(status=status.HTTP_201_CREATED if created else status.HTTP_404_NOT_FOUND,
+                        data={'messages': results})
+
+    @staticmethod
+    def get_key(message: InboxMessage):
+        '''
+        Returns the (sender, id) a message is stored once for or None if the sender does not set ids.
+        '''
+        return (message.sender_id, message.message_id) if message.message_id is not None else None
+
+    @staticmethod
+    def get_received(messages) -> dict:
+        '''
+        Returns the stored messages with the same sender and id as one of `messages` by their key, see get_key.
+        '''
+        keys = {InboxBatchView.get_key(m) for m in messages} - {None}
+        if len(keys) == 0:
+            return {}
+        qs = InboxMessage.objects.only('id', 'sender_id', 'message_id') \
+            .filter(message_id__in={k[1] for k in keys}, sender_id__in={k[0] for k in keys})
+        return {InboxBatchView.get_key(m): m for m in qs if InboxBatchView.get_key(m) in keys}
+
+    @staticmethod
+    def get_skipped(messages) -> set[tuple]:
+        '''
+        Returns the keys (see get_key) of the messages that bulk_create skipped because a message with the same sender
+        and id already exists.
+        '''
+        messages = [m for m in messages if m.message_id is not None]
+        if len(messages) == 0:
+            return set()
+        inserted = set(InboxMessage.objects.filter(pk__in=[m.pk for m in messages]).values_list('pk', flat=True))
+        return {InboxBatchView.get_key(m) for m in messages if m.pk not in inserted}
+
+
+class InboxMetricsView(APIView):
+    '''
+    Depth and processing latency of the inbox shards and lanes, see inbox_metrics.
+    '''
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(inbox_metrics())
@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.federation.tasks import archive_messages
+
+
+class Command(BaseCommand):
+    help = 'Moves the payload of processed inbox and outbox messages older than --days into the archive.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.FEDERATION_MESSAGE_RETENTION_DAYS)
+
+    def handle(self, *args, **options):
+        for model, archived in archive_messages(days=options['days']).items():
+            self.stdout.write(f'{model}: {archived} messages archived')
@@ -29,7 +29,10 @@ class Command(BaseCommand):
             m = process_inbox_message
 
         obj = qs.first()
+        obj.restore()
         obj.processed = False
         obj.processing = False
+        # a message that was given up on is tried again
+        obj.tries = 0
         obj.save()
         m(obj.id_as_str)
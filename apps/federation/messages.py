@@ -173,6 +173,11 @@ class Message(BaseModel):
     class Config:
         populate_by_name = True
 
+    '''
+    Stable id of the message, set once by the sender. A message that is sent again keeps its id, so the receiving
+    inbox can detect duplicates.
+    '''
+    id: str | None = Field(None)
     type: str = Field(None)
     object: MessageObject|Dict[str,Any] = Field(None)
     from_: str = Field(alias='from')
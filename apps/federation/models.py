@@ -1,4 +1,9 @@
+import json
+from datetime import timedelta
+
+from django.conf import settings
 from django.db import models
+from django.utils import timezone
 
 from apps.core.models import Base
 
@@ -11,6 +16,12 @@ class Message(Base):
         INBOX = 'inbox'
         OUTBOX = 'outbox'
 
+    class Priority(models.IntegerChoices):
+        # lower values are sent and processed first
+        CONTROL = 0
+        DEFAULT = 1
+        BULK = 2
+
     # objects = MessageManager()
 
     message = models.JSONField(default=dict)
@@ -29,7 +40,90 @@ class Message(Base):
     error = models.TextField(null=True, blank=True, default=None)
     # any extra data that could be necessary for sending e.g. data for DSF.
     extra_data = models.JSONField(blank=True, default=None, null=True)
+    # lane of the message, see get_priority
+    priority = models.PositiveSmallIntegerField(choices=Priority.choices, default=Priority.DEFAULT)
+    # the archive file that holds the payload of the message, see apps.federation.archive
+    archive = models.CharField(max_length=200, null=True, blank=True, default=None)
+    # when a worker claimed the message, see pending
+    claimed_at = models.DateTimeField(null=True, blank=True, default=None)
+
+    @classmethod
+    def pending(cls, claim_timeout: int, max_tries: int):
+        '''
+        Returns the messages that are not processed and not claimed by a worker. A claim expires after `claim_timeout`
+        seconds, so the messages of a worker that was killed are picked up again. Messages that failed `max_tries`
+        times are given up on.
+        '''
+        expired = timezone.now() - timedelta(seconds=claim_timeout)
+        return cls.objects.filter(processed=False, tries__lt=max_tries) \
+            .filter(models.Q(processing=False) | models.Q(claimed_at__isnull=True) | models.Q(claimed_at__lt=expired))
+
+    @staticmethod
+    def claim():
+        '''
+        The values a message is claimed with, see db_utils.claim_batch and pending.
+        '''
+        return {'processing': True, 'claimed_at': timezone.now()}
 
     @property
     def get_object(self):
         return self.message['object']
+
+    @property
+    def is_archived(self):
+        return self.archive is not None
+
+    def restore(self):
+        '''
+        Moves the payload back from the archive, see apps.federation.archive.restore_message.
+        '''
+        from apps.federation.archive import restore_message
+        restore_message(self)
+
+    @property
+    def message_type(self):
+        return Message.get_message_type(self.message)
+
+    @property
+    def queue(self):
+        return Message.get_queue(self.priority)
+
+    @staticmethod
+    def get_message_type(message):
+        object = message.get('object')
+        return object if isinstance(object, str) else (object or {}).get('type')
+
+    @staticmethod
+    def get_size(message) -> int:
+        '''
+        Returns the size of `message` in bytes as uncompressed json, which is the decoded body it was sent as (see
+        encoding.encode_json). The size does not depend on the content encoding or on the message being sent alone or
+        in a batch.
+        '''
+        return len(json.dumps(message).encode('utf-8'))
+
+    @staticmethod
+    def get_priority(message, size=0) -> 'Message.Priority':
+        '''
+        Returns the lane of `message`. Small control messages like acks and invitation responses must not wait behind
+        shares, so they have their own lane. Messages of the bulk types or larger than
+        settings.FEDERATION_BULK_MIN_SIZE go into the bulk lane.
+        :param size: the size of the message in bytes if known, see get_size
+        '''
+        message_type = Message.get_message_type(message)
+        if message_type in settings.FEDERATION_BULK_MESSAGE_TYPES or size >= settings.FEDERATION_BULK_MIN_SIZE:
+            return Message.Priority.BULK
+        if message_type in settings.FEDERATION_CONTROL_MESSAGE_TYPES:
+            return Message.Priority.CONTROL
+        return Message.Priority.DEFAULT
+
+    @staticmethod
+    def get_queue(priority) -> str:
+        '''
+        Returns the celery queue of the lane `priority`.
+        '''
+        return {
+            Message.Priority.CONTROL: settings.FEDERATION_QUEUE_CONTROL,
+            Message.Priority.DEFAULT: settings.FEDERATION_QUEUE_DEFAULT,
+            Message.Priority.BULK: settings.FEDERATION_QUEUE_BULK,
+        }[priority]
@@ -1,27 +1,27 @@
-from functools import partial
-
 from django.contrib import admin
-from django.db import transaction
 from django.shortcuts import redirect
 from django.urls import path
 
 from apps.federation.outbox.models import OutboxMessage
-from apps.federation.outbox.tasks import send_outbox_message
 
 
 class OutboxMessageAdmin(admin.ModelAdmin):
     list_display = ('pk', 'date_created', 'recipient', 'sender', 'processing', 'processed', 'tries')
+    list_select_related = ('recipient', 'sender')
     ordering = ('-date_created',)
     change_form_template = 'admin/federation/outbox/change_form.html'
 
     def replay(self, request, object_id):
         obj = self.get_object(request, object_id)
 
+        obj.restore()
         obj.processed = False
         obj.processing = False
+        # a message that was given up on is tried again
+        obj.tries = 0
         obj.save()
 
-        transaction.on_commit(partial(send_outbox_message.delay, obj.id_as_str))
+        obj.send()
 
         self.message_user(request, "Replaying inbox message!")
         return redirect('admin:outbox_outboxmessage_change', object_id)
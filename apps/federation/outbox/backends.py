@@ -1,22 +1,28 @@
 from __future__ import annotations
 
 import logging
+import threading
 from importlib import import_module
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Dict, List
 
 import httpx
 from django.conf import settings
 from httpx import Response
-from tenacity import retry, stop_after_attempt, wait_exponential
 
 from apps.blockchain.tasks import send_private_message, send_broadcast_message_wrapper
 from apps.dsf.client import send_bundle, send, update
 from apps.dsf.tasks import create_bundle, create_bundle_for_questionnaire
+from apps.federation import encoding, payload
 from apps.federation.inbox.utils import send_message_to_inbox
 from apps.federation.outbox.exceptions import MessageSendException
 
 if TYPE_CHECKING:
     from apps.federation.outbox.models import OutboxMessage
+    from apps.node.models import Node
+
+# http clients per node id, see get_client
+_clients: Dict[str, httpx.Client] = {}
+_clients_lock = threading.Lock()
 
 
 # backend and adapter pattern: https://charlesleifer.com/blog/django-patterns-pluggable-backends/
@@ -39,20 +45,91 @@ def get_broadcast_backend():
     return MessageBackend(adapter)
 
 
+def get_client(node: Node) -> httpx.Client:
+    '''
+    Returns the http client for `node`. The client is kept for the lifetime of the worker process, so all messages to
+    the node reuse its connections and the client certificate is only loaded once.
+    '''
+    with _clients_lock:
+        client = _clients.get(node.id_as_str)
+        if client is None:
+            client = httpx.Client(verify=settings.VERIFY_TLS,
+                                  cert=(settings.DSF_CERTIFICATE, settings.DSF_CERTIFICATE_PRIVATE_KEY),
+                                  http2=settings.FEDERATION_OUTBOX_HTTP2,
+                                  limits=httpx.Limits(max_connections=settings.FEDERATION_OUTBOX_MAX_CONNECTIONS))
+            _clients[node.id_as_str] = client
+        return client
+
+
+def close_clients():
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
 class MessageBackend(object):
+    UPDATE_FIELDS = ['processing', 'processed', 'status_code', 'response_body', 'error', 'tries', 'next_attempt_at',
+                     'payload']
+    # responses of a proxy in front of a node that is down
+    UNREACHABLE_STATUS_CODES = [502, 503, 504]
 
     def __init__(self, adapter):
         self.adapter = adapter
 
     def send_message(self, outbox_message: OutboxMessage):
         logging.info(f"USING ADAPTER {self.adapter}")
+        if not outbox_message.is_broadcast and outbox_message.recipient.node.is_paused:
+            node = outbox_message.recipient.node
+            logging.info('Delivery to %s is paused until %s.', node, node.paused_until)
+            outbox_message.next_attempt_at = node.paused_until
+            outbox_message.processing = False
+            outbox_message.save(update_fields=['processing', 'next_attempt_at'])
+            return
+        outbox_message.processing = True
+        outbox_message.save(update_fields=['processing'])
+        try:
+            self._send(outbox_message)
+        finally:
+            outbox_message.save(update_fields=self.UPDATE_FIELDS)
+
+    def send_messages(self, outbox_messages: List[OutboxMessage]) -> bool:
+        '''
+        Sends a batch of messages to the same node one after another and writes their status back with a single query.
+        The messages must have been claimed with processing=True, see db_utils.claim_batch.
+        Stops at the first message that cannot reach the node. The remaining messages stay pending.
+        :return: False if the node was not reachable
+        '''
+        from apps.federation.outbox.models import OutboxMessage
+        logging.info('Sending %s messages with adapter %s', len(outbox_messages), self.adapter)
+        reachable = True
+        try:
+            for outbox_message in outbox_messages:
+                try:
+                    reachable = self._send(outbox_message)
+                except Exception as e:
+                    logging.exception(e)
+                    outbox_message.schedule_retry(str(e))
+                if not reachable:
+                    break
+        finally:
+            for outbox_message in outbox_messages:
+                outbox_message.processing = False
+            OutboxMessage.objects.bulk_update(outbox_messages, self.UPDATE_FIELDS)
+        return reachable
+
+    def _send(self, outbox_message: OutboxMessage) -> bool:
+        '''
+        Sends the message once and sets its status. A failed attempt is scheduled to be retried and counts against the
+        circuit breaker of the recipient node if the node was not reachable. Does not save the message.
+        :return: False if the recipient node was not reachable
+        '''
+        node = None if outbox_message.is_broadcast else outbox_message.recipient.node
         try:
             if outbox_message.is_broadcast:
                 logging.info('Sending broadcast message.')
             else:
-                logging.info('Sending message to %s @ %s', outbox_message.recipient, outbox_message.recipient.node)
-            outbox_message.processing = True
-            outbox_message.save(update_fields=['processing'])
+                logging.info('Sending message to %s @ %s', outbox_message.recipient, node)
             response: Response = self.adapter.send_message(outbox_message)
             # response can be None if sending a message via firefly adapter and Besu as broadcast
             if response is not None:
@@ -61,17 +138,26 @@ class MessageBackend(object):
 
             outbox_message.processing = False
             outbox_message.processed = True
+            outbox_message.next_attempt_at = None
+            if node is not None:
+                node.record_success()
+            return True
         except MessageSendException as e:
             logging.exception(e)
             logging.error('Request to %s yields to status code %s', e.address, e.status_code)
             # logging.error(response.content)
-            outbox_message.processing = False
-            outbox_message.processed = False
             outbox_message.status_code = e.response.status_code
-            outbox_message.error = e.error
             outbox_message.response_body = e.response.text
-        finally:
-            outbox_message.save(update_fields=['processing', 'processed', 'status_code', 'response_body', 'error'])
+            error, reachable = e.error, e.status_code not in self.UNREACHABLE_STATUS_CODES
+        except httpx.TransportError as e:
+            logging.error('Node %s is not reachable: %s', node, e)
+            error, reachable = str(e), False
+        not_before = None
+        if not reachable and node is not None:
+            node.record_failure()
+            not_before = node.paused_until
+        outbox_message.schedule_retry(error, not_before=not_before)
+        return reachable
 
 
 class BaseAdapter:
@@ -158,30 +244,53 @@ class DSFBackend:
 class CentauronBackend:
 
     def send_message(self, message: OutboxMessage):
-        headers = {'accept': 'application/json', 'content-type': 'application/json'}
+        node = message.recipient.node
         # if settings.DEBUG:
         #     headers.update(settings.MY_DEV_CREDENTIALS(message.sender.authentication.common_name))
-        json = message.message
-        cert_file = settings.DSF_CERTIFICATE
-        key_file = settings.DSF_CERTIFICATE_PRIVATE_KEY
-        url = message.recipient.node.api_address
-        return self._send(url, json, headers, cert_file, key_file)
-
-    @retry(
-        stop=stop_after_attempt(5),  # Retry up to 5 times
-        wait=wait_exponential(multiplier=1, max=60)  # Wait fixed intervals (300/5 seconds = 60 seconds)
-    )
-    def _send(self, url, json, headers, cert_file, key_file):
-        with httpx.Client(verify=settings.VERIFY_TLS, cert=(cert_file, key_file)) as client:
-            response = client.post(url,
-                                   json=json,
-                                   headers=headers,
-                                   timeout=30)
-            response.raise_for_status()
+        remote_encodings = node.capabilities.get(encoding.CAPABILITY_CONTENT_ENCODINGS, [])
+        # large messages are sent as an envelope and their payload is downloaded by the node
+        body = payload.offload(message)
+        content, headers = encoding.encode_json(body, remote_encodings)
+        headers.update(self.get_headers(message))
+        url = node.api_address
+        try:
+            response = self._send(get_client(node), url, content, headers)
+        except MessageSendException as e:
+            if e.status_code != 415 or 'content-encoding' not in headers:
+                raise
+            # the node does not accept the encoding (anymore). it is sent uncompressed instead.
+            logging.warning('Node %s does not accept content encoding %s.', node, headers['content-encoding'])
+            node.set_capability(encoding.CAPABILITY_CONTENT_ENCODINGS,
+                                encoding.parse_accept_encoding(e.response.headers.get('accept-encoding')))
+            content, headers = encoding.encode_json(body, [])
+            headers.update(self.get_headers(message))
+            response = self._send(get_client(node), url, content, headers)
+        node.set_capability(encoding.CAPABILITY_CONTENT_ENCODINGS,
+                            encoding.parse_accept_encoding(response.headers.get('accept-encoding')))
+        if response.headers.get('idempotent-replayed') == 'true':
+            logging.info('Message %s was already received by node %s.', message.id_as_str, node)
+        return response
+
+    @staticmethod
+    def get_headers(message: OutboxMessage):
+        headers = {'accept': 'application/json'}
+        # the inbox checks that it matches the id in the body
+        message_id = message.message.get('id')
+        if message_id is not None:
+            headers['x-message-id'] = message_id
+        return headers
+
+    def _send(self, client: httpx.Client, url, content: bytes, headers):
+        # sent once. failed messages are retried later by process_outbox_messages, see MessageBackend._send
+        response = client.post(url,
+                               content=content,
+                               headers=headers,
+                               timeout=30)
         if response.status_code != 201:
             raise MessageSendException(url, response.status_code, response.text, response)
         return response
 
+
 class LocalBackend:
 
     def send_message(self, message: OutboxMessage):
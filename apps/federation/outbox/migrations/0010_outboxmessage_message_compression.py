@@ -0,0 +1,18 @@
+from django.db import migrations
+
+from apps.core.db_utils import set_column_compression
+
+
+def compress_messages(apps, schema_editor):
+    # share messages embed large csv sections. new rows are compressed with lz4 instead of pglz.
+    set_column_compression(schema_editor, apps.get_model('outbox', 'OutboxMessage')._meta.db_table, 'message')
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('outbox', '0009_alter_outboxmessage_recipient'),
+    ]
+
+    operations = [
+        migrations.RunPython(compress_messages, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.9 on 2026-10-18 00:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('outbox', '0010_outboxmessage_message_compression'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+    ]
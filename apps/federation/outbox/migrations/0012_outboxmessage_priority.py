@@ -0,0 +1,18 @@
+# Generated by Django 4.1.9 on 2026-10-18 00:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('outbox', '0011_outboxmessage_next_attempt_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='priority',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'Control'), (1, 'Default'), (2, 'Bulk')], default=1),
+        ),
+    ]
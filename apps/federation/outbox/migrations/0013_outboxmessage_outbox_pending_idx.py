@@ -0,0 +1,17 @@
+# Generated by Django 4.1.9 on 2026-10-18 00:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('outbox', '0012_outboxmessage_priority'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='outboxmessage',
+            index=models.Index(condition=models.Q(('processed', False), ('processing', False)), fields=['recipient', 'priority', 'date_created'], name='outbox_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.9 on 2026-10-18 00:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('outbox', '0013_outboxmessage_outbox_pending_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='archive',
+            field=models.CharField(blank=True, default=None, max_length=200, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.9 on 2026-10-18 00:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('outbox', '0014_outboxmessage_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='payload',
+            field=models.CharField(blank=True, db_index=True, default=None, max_length=64, null=True),
+        ),
+    ]
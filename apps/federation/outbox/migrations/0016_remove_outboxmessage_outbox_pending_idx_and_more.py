@@ -0,0 +1,26 @@
+# Generated by Django 4.1.9 on 2026-10-18 00:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('outbox', '0015_outboxmessage_payload'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='outboxmessage',
+            name='outbox_pending_idx',
+        ),
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='outboxmessage',
+            index=models.Index(condition=models.Q(('processed', False)), fields=['recipient', 'priority', 'date_created'], name='outbox_pending_idx'),
+        ),
+    ]
@@ -1,8 +1,13 @@
 import json
+import logging
+import uuid
+from datetime import timedelta
 from functools import partial
 from typing import Any, Dict
 
+from django.conf import settings
 from django.db import models, transaction
+from django.utils import timezone
 
 from apps.federation.messages import MessageObject, CreateMessage
 from apps.federation.models import Message
@@ -11,16 +16,55 @@ from apps.user.user_profile.models import Profile
 
 
 class OutboxMessage(Message):
+    class Meta:
+        indexes = [
+            # the pending messages that process_outbox_messages and send_outbox_messages_to_node claim
+            models.Index(name='outbox_pending_idx', fields=['recipient', 'priority', 'date_created'],
+                         condition=models.Q(processed=False)),
+        ]
+
     remote_location = models.URLField()
+    # when a failed message is sent again, see schedule_retry
+    next_attempt_at = models.DateTimeField(null=True, blank=True, default=None)
+    # sha256 of the payload file of a large message that the recipient node downloads, see apps.federation.payload
+    payload = models.CharField(max_length=64, null=True, blank=True, default=None, db_index=True)
 
     def save(self, *args, **kwargs):
         self.box = Message.Box.OUTBOX
         return super(OutboxMessage, self).save(*args, **kwargs)
 
+    @classmethod
+    def pending(cls, claim_timeout=None, max_tries=None):
+        '''
+        Message.pending with settings.FEDERATION_OUTBOX_CLAIM_TIMEOUT and settings.FEDERATION_OUTBOX_MAX_TRIES.
+        '''
+        return super().pending(claim_timeout or settings.FEDERATION_OUTBOX_CLAIM_TIMEOUT,
+                               max_tries or settings.FEDERATION_OUTBOX_MAX_TRIES)
+
     @property
     def is_broadcast(self):
         return self.recipient is None
 
+    def schedule_retry(self, error: str, not_before=None):
+        '''
+        Records a failed attempt. process_outbox_messages sends the message again at `next_attempt_at`, which backs off
+        exponentially, until settings.FEDERATION_OUTBOX_MAX_TRIES attempts failed. Does not save the message.
+        :param not_before: do not send again before, e.g. while delivery to the recipient node is paused
+        '''
+        self.tries += 1
+        self.error = error
+        self.processing = False
+        self.processed = False
+        if self.tries >= settings.FEDERATION_OUTBOX_MAX_TRIES:
+            logging.error('Giving up on message %s after %s attempts.', self.pk, self.tries)
+            self.next_attempt_at = None
+            return
+        delay = min(settings.FEDERATION_OUTBOX_RETRY_DELAY * 2 ** (self.tries - 1),
+                    settings.FEDERATION_OUTBOX_RETRY_MAX_DELAY)
+        self.next_attempt_at = timezone.now() + timedelta(seconds=delay)
+        if not_before is not None and not_before > self.next_attempt_at:
+            self.next_attempt_at = not_before
+
     @staticmethod
     def _build_message_header(message_object: MessageObject):
         pass
@@ -34,18 +78,24 @@ class OutboxMessage(Message):
             message_object.recipient = recipient.identifier if recipient is not None else None
             message_object.sender = sender.identifier
 
-        message = message_type(object=message_object,
+        # the id of the outbox message is the id of the message, so it stays the same for every retry
+        message_id = uuid.uuid4()
+        message = message_type(id=str(message_id),
+                               object=message_object,
                                from_=sender.node.identifier,
                                to=recipient.node.identifier if recipient is not None else None)
-        message= json.loads(message.model_dump_json(by_alias=True))
-        return OutboxMessage.objects.create(sender=sender,
+        data = message.model_dump_json(by_alias=True)
+        message = json.loads(data)
+        return OutboxMessage.objects.create(id=message_id,
+                                            sender=sender,
                                             recipient=recipient,
                                             message=message,
-                                            extra_data=extra_data)
+                                            extra_data=extra_data,
+                                            priority=OutboxMessage.get_priority(message, len(data)))
 
     def send(self, send_async=True):
         from apps.federation.outbox.tasks import send_outbox_message
         if send_async:
-            transaction.on_commit(partial(send_outbox_message.delay, self.id_as_str))
+            transaction.on_commit(partial(send_outbox_message.apply_async, (self.id_as_str,), queue=self.queue))
         else:
             send_outbox_message(self.id_as_str)
@@ -1,29 +1,92 @@
 import logging
 
-from apps.federation.outbox.backends import get_backend, LocalBackend, get_broadcast_backend
+from celery.signals import worker_process_shutdown
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+
+from apps.core import db_utils
+from apps.federation.outbox.backends import get_backend, LocalBackend, get_broadcast_backend, close_clients
 from apps.federation.outbox.models import OutboxMessage
+from apps.node.models import Node
 from config import celery_app
 
 
 @celery_app.task
 def process_outbox_messages():
-    for message in OutboxMessage.objects.filter(processed=False):
-        send_outbox_message.delay(message.id_as_str)
+    '''
+    Sends all pending messages that are due. Messages to other nodes are sent in batches per recipient node and lane,
+    broadcasts and messages to this node one by one. Every task is queued in the celery queue of its lane, so control
+    messages are not queued behind shares. Nodes whose delivery is paused are skipped.
+    '''
+    now = timezone.now()
+    pending = OutboxMessage.pending().filter(Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now))
+    remote = pending.filter(recipient__isnull=False).exclude(recipient__node_id=F('sender__node_id'))
+    nodes = remote.exclude(recipient__node__paused_until__gt=now)
+    for node_pk, priority in nodes.values_list('recipient__node_id', 'priority').distinct().order_by('priority'):
+        send_outbox_messages_to_node.apply_async((str(node_pk), priority),
+                                                 queue=OutboxMessage.get_queue(priority))
+    for message in pending.exclude(pk__in=remote.values('pk')).only('id', 'priority').order_by('priority'):
+        send_outbox_message.apply_async((message.id_as_str,), queue=message.queue)
+
+
+@celery_app.task
+def send_outbox_messages_to_node(node_pk, priority=None):
+    '''
+    Sends the due messages to the node `node_pk` oldest first in batches of settings.FEDERATION_OUTBOX_BATCH_SIZE.
+    With `priority`, only the messages of this lane are sent.
+    The batches are claimed, so several workers can send to the same node without sending a message twice.
+    All batches share the pooled http client of the node. Stops if the node is not reachable, the remaining messages
+    are sent by the next run of process_outbox_messages.
+    '''
+    node = Node.objects.get(pk=node_pk)
+    if node.is_paused:
+        logging.info('Delivery to %s is paused until %s.', node, node.paused_until)
+        return
+    logging.info('[start] sending outbox messages to node %s', node_pk)
+    backend = get_backend()
+    # messages that are being sent by another worker are skipped
+    qs = OutboxMessage.pending().filter(recipient__node_id=node_pk) \
+        .filter(Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=timezone.now())) \
+        .select_related('sender__node', 'recipient').order_by('date_created', 'id')
+    if priority is not None:
+        qs = qs.filter(priority=priority)
+    while True:
+        # messages that failed are not due until their next attempt, so they are not claimed again
+        batch = db_utils.claim_batch(qs, settings.FEDERATION_OUTBOX_BATCH_SIZE, **OutboxMessage.claim())
+        if len(batch) == 0:
+            break
+        # the messages share one node, so capabilities and failures recorded on a response apply to the whole batch
+        for message in batch:
+            message.recipient.node = node
+        if not backend.send_messages(batch):
+            break
+    logging.info('[end] sending outbox messages to node %s', node_pk)
 
 
 @celery_app.task(bind=True)
 def send_outbox_message(self, outboxmessage_pk):
-    message = OutboxMessage.objects.get(pk=outboxmessage_pk)
-
-    if message.processed:
-        logging.warning('Message %s already processed.', message.pk)
+    claimed = db_utils.claim_batch(OutboxMessage.pending().filter(pk=outboxmessage_pk), 1, **OutboxMessage.claim())
+    if len(claimed) == 0:
+        logging.warning('Message %s already processed or being sent.', outboxmessage_pk)
         return
+    message = claimed[0]
 
     # if the receiving and sending node are the same, take a shortcut and do not use any external component to send the message.
     if not message.is_broadcast and message.sender.node_id == message.recipient.node_id:
-        LocalBackend().send_message(message)
+        try:
+            LocalBackend().send_message(message)
+            message.processed = True
+        finally:
+            message.processing = False
+            message.save(update_fields=['processing', 'processed'])
     else:
         if message.is_broadcast:
             return get_broadcast_backend().send_message(message)
         else:
             return get_backend().send_message(message)
+
+
+@worker_process_shutdown.connect
+def close_http_clients(**kwargs):
+    close_clients()
@@ -0,0 +1,154 @@
+import json
+import logging
+import uuid
+from datetime import timedelta
+from pathlib import Path
+
+import httpx
+from django.conf import settings
+from django.utils import timezone
+
+from apps.share.package import PackageReader, PackageWriter, get_file_sha256
+
+# key of the envelope that references the payload of a large message instead of embedding it
+PAYLOAD_REFERENCE_KEY = 'payload-reference'
+CHUNK_SIZE = 1024 * 1024
+# partial downloads of the recipient node, see fetch_payload
+RECEIVED_DIR = 'received'
+
+
+class PayloadException(Exception):
+    pass
+
+
+def get_payload_path(name: str) -> Path:
+    return settings.FEDERATION_PAYLOAD_DIR / name
+
+
+def get_payload_name(sha256: str) -> str:
+    return f'{sha256}.pkg'
+
+
+def is_offloaded(message) -> bool:
+    return isinstance(message, dict) and PAYLOAD_REFERENCE_KEY in message
+
+
+def offload(outbox_message) -> dict:
+    '''
+    Returns the body that is sent for `outbox_message`. If the body of a message is at least
+    settings.FEDERATION_PAYLOAD_MIN_SIZE bytes, the content of its object is written into a package (see
+    apps.share.package) named by its hash. An envelope is sent instead. The envelope is the message without the content
+    and references the package, which the recipient node downloads from FileServeView, see fetch_payload.
+    Sets the hash as payload of the outbox message, so the recipient node is allowed to download the package. Does not
+    save the message.
+    '''
+    message = outbox_message.message
+    if not isinstance(message.get('object'), dict) or not isinstance(message['object'].get('content'), dict):
+        return message
+    size = len(json.dumps(message).encode('utf-8'))
+    if size < settings.FEDERATION_PAYLOAD_MIN_SIZE:
+        return message
+
+    tmp = get_payload_path(f'{uuid.uuid4().hex}.tmp')
+    with PackageWriter(tmp) as package:
+        for key, value in message['object']['content'].items():
+            if isinstance(value, str):
+                # strings, e.g. the csv sections of a share, can be read as a stream by the recipient
+                with package.section(key) as sink:
+                    sink.write(value)
+            else:
+                package[key] = value
+    manifest = package.manifest
+    sha256 = manifest['sha256']
+    path = get_payload_path(get_payload_name(sha256))
+    if path.exists():
+        # a retry or an identical message. the file is kept for the retention period from now on, see remove_payloads
+        path.touch()
+        tmp.unlink()
+    else:
+        tmp.rename(path)
+    logging.info('Sending message %s of %s bytes as payload %s.', outbox_message.id_as_str, size, sha256)
+    outbox_message.payload = sha256
+    return {
+        **message,
+        'object': {k: v for k, v in message['object'].items() if k != 'content'},
+        PAYLOAD_REFERENCE_KEY: {
+            'sha256': sha256,
+            'size': manifest['size'],
+            'sections': manifest['sections'],
+            'url': f'{settings.CDN_ADDRESS}?payload={sha256}',
+        },
+    }
+
+
+def fetch_payload(message: dict, client: httpx.Client) -> PackageReader:
+    '''
+    Downloads the payload that the envelope `message` references and returns it as package, whose sections are read
+    as streams. The download is written into a file and resumed with a range request after an interruption, also by
+    the next try of the message. The file is only renamed to the name of the payload after its hash was verified, so a
+    payload that is already stored under that name is not downloaded again.
+    :param client: the http client for the sender node
+    :raises PayloadException: if the payload does not match the envelope
+    '''
+    reference = message[PAYLOAD_REFERENCE_KEY]
+    sha256 = reference['sha256']
+    path = get_payload_path(f'{RECEIVED_DIR}/{get_payload_name(sha256)}')
+    manifest = {'path': path.name, 'size': reference['size'], 'sha256': sha256, 'sections': reference['sections']}
+    if path.exists():
+        logging.info('Payload %s is already downloaded.', sha256)
+        return PackageReader(path, manifest)
+
+    download = path.with_name(f'{path.name}.download')
+    download.parent.mkdir(parents=True, exist_ok=True)
+    logging.info('[start] downloading payload %s from %s', sha256, reference['url'])
+    for attempt in range(1, settings.FEDERATION_PAYLOAD_DOWNLOAD_TRIES + 1):
+        try:
+            download_range(client, reference['url'], download, reference['size'])
+            break
+        except httpx.TransportError as e:
+            if attempt == settings.FEDERATION_PAYLOAD_DOWNLOAD_TRIES:
+                raise
+            logging.warning('Download of payload %s interrupted at %s bytes: %s', sha256,
+                            download.stat().st_size if download.exists() else 0, e)
+
+    if get_file_sha256(download) != sha256:
+        download.unlink()
+        raise PayloadException(f'Checksum mismatch for downloaded payload {sha256}.')
+    download.replace(path)
+    logging.info('[end] downloading payload %s', sha256)
+    return PackageReader(path, manifest)
+
+
+def download_range(client: httpx.Client, url: str, path: Path, size: int):
+    '''
+    Downloads the bytes of `url` that are missing in `path`, which holds the first bytes of a file of `size` bytes.
+    '''
+    offset = path.stat().st_size if path.exists() else 0
+    if offset >= size:
+        return
+    headers = {'Range': f'bytes={offset}-'} if offset > 0 else {}
+    if settings.DOWNLOADER_DEBUG:
+        headers.update(settings.MY_DEV_CREDENTIALS)
+    with client.stream('GET', url, headers=headers, timeout=30) as response:
+        response.raise_for_status()
+        # a server that ignores the range sends the whole file
+        with path.open('ab' if response.status_code == 206 else 'wb') as f:
+            for chunk in response.iter_bytes(CHUNK_SIZE):
+                f.write(chunk)
+
+
+def remove_payloads(days: int | None = None) -> int:
+    '''
+    Removes the payload files and partial downloads that were not used for `days` days.
+    :param days: defaults to settings.FEDERATION_MESSAGE_RETENTION_DAYS
+    :return: the number of removed files
+    '''
+    days = settings.FEDERATION_MESSAGE_RETENTION_DAYS if days is None else days
+    cutoff = (timezone.now() - timedelta(days=days)).timestamp()
+    removed = 0
+    for path in settings.FEDERATION_PAYLOAD_DIR.rglob('*'):
+        if path.is_file() and path.stat().st_mtime < cutoff:
+            path.unlink()
+            removed += 1
+    logging.info('Removed %s payload files older than %s days.', removed, days)
+    return removed
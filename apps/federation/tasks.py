@@ -0,0 +1,15 @@
+from apps.federation.archive import archive_messages as archive
+from apps.federation.payload import remove_payloads
+from apps.federation.inbox.models import InboxMessage
+from apps.federation.outbox.models import OutboxMessage
+from config import celery_app
+
+
+@celery_app.task(soft_time_limit=60 * 60 * 6, time_limit=60 * 60 * 6 + 60)
+def archive_messages(days=None):
+    '''
+    Moves the payload of old processed inbox and outbox messages into the archive, see apps.federation.archive, and
+    removes old payload files of large messages, see apps.federation.payload.
+    '''
+    archived = {model._meta.label: archive(model, days=days) for model in [InboxMessage, OutboxMessage]}
+    return {**archived, 'payloads': remove_payloads(days)}
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.9 on 2026-10-18 00:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('node', '0009_node_api_address'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='node',
+            name='capabilities',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.1.9 on 2026-10-18 00:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('node', '0010_node_capabilities'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='node',
+            name='delivery_failures',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='node',
+            name='paused_until',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+    ]
@@ -1,7 +1,10 @@
 import logging
+from datetime import timedelta
 
 from django.conf import settings
 from django.db import models
+from django.db.models import F
+from django.utils import timezone
 
 from apps.core.managers import BaseManager
 from apps.core.models import IdentifieableMixin, Base, CreatedByMixin
@@ -34,10 +37,49 @@ class Node(IdentifieableMixin, CreatedByMixin, Base):
     did = models.CharField(max_length=100, unique=True)
     common_name = models.CharField(max_length=200)
     api_address = models.CharField(max_length=250, null=True, default=None, blank=True)
+    # what the node supports, learned from its responses. e.g. the content encodings of its inbox.
+    capabilities = models.JSONField(default=dict, blank=True)
+    # failed deliveries in a row and until when delivery to the node is paused, see record_failure
+    delivery_failures = models.IntegerField(default=0)
+    paused_until = models.DateTimeField(null=True, blank=True, default=None)
 
     def __str__(self):
         return self.human_readable
 
+    def set_capability(self, key, value):
+        if self.capabilities.get(key) == value:
+            return
+        self.capabilities = {**self.capabilities, key: value}
+        Node.objects.filter(pk=self.pk).update(capabilities=self.capabilities)
+
+    @property
+    def is_paused(self):
+        return self.paused_until is not None and self.paused_until > timezone.now()
+
+    def record_success(self):
+        if self.delivery_failures == 0 and self.paused_until is None:
+            return
+        self.delivery_failures = 0
+        self.paused_until = None
+        Node.objects.filter(pk=self.pk).update(delivery_failures=0, paused_until=None)
+
+    def record_failure(self):
+        '''
+        Counts a delivery that failed because the node was not reachable. After
+        settings.FEDERATION_NODE_FAILURE_THRESHOLD failures in a row, delivery to the node is paused (circuit breaker).
+        The pause doubles with every further failure. The first delivery after the pause closes the circuit again
+        if it succeeds.
+        '''
+        Node.objects.filter(pk=self.pk).update(delivery_failures=F('delivery_failures') + 1)
+        self.refresh_from_db(fields=['delivery_failures'])
+        exceeded = self.delivery_failures - settings.FEDERATION_NODE_FAILURE_THRESHOLD
+        if exceeded < 0:
+            return
+        pause = min(settings.FEDERATION_NODE_PAUSE * 2 ** exceeded, settings.FEDERATION_OUTBOX_RETRY_MAX_DELAY)
+        self.paused_until = timezone.now() + timedelta(seconds=pause)
+        Node.objects.filter(pk=self.pk).update(paused_until=self.paused_until)
+        logging.warning('Node %s is not reachable. Delivery is paused until %s.', self, self.paused_until)
+
     @staticmethod
     def import_node(current_user: 'Profile', message: UserMessage, **kwargs):
 
@@ -1,14 +1,11 @@
-import csv
-import io
-import random
-import string
 import uuid
 from typing import List
 
-from django.db import models, connection
+from django.db import models
 from django.db.models import UniqueConstraint
 from django.utils import timezone
 
+from apps.core.db_utils import BulkWriter
 from apps.core.models import Base, CreatedByMixin
 from apps.permission.managers import PermissionManager
 
@@ -47,30 +44,12 @@ class Permission(CreatedByMixin, Base):
     @staticmethod
     def create_permissions(*, identifiers: List[str], permission: Permission, action: Action,
                            user_id: str, created_by_id: str | None, group_id: str | None = None):
-        with io.StringIO() as buffer:
-            writer = csv.writer(buffer)
-            csv_header = ['date_created', 'last_modified', 'id',
-                          'object_identifier', 'permission', 'action',
-                          'group_id', 'user_id', 'created_by_id']
-            writer.writerow(csv_header)
-            now = timezone.now().isoformat()
-            group_id = 'null' if group_id is None else group_id
-            writer.writerows([now, now, str(uuid.uuid4()), i, permission, action, group_id,
-                              user_id, created_by_id] for i in identifiers)
-
-            # the strategy is to ensure no duplicated permissions is:
-            # insert into temp table first, then do an upsert into the permission table and do nothing on conflict (ignore duplicates).
-            with connection.cursor() as cursor:
-                buffer.seek(0)
-                tmp_tbl_name = ''.join(random.choice(string.ascii_uppercase) for _ in range(5))
-                # create tmp table from permission_permission with 1 record and truncate afterward
-                # so the table structure is equal to the permission table, but it's truncated
-                tbl_name = Permission.objects.model._meta.db_table
-                cursor.execute(f'create temp table {tmp_tbl_name} as select * from {tbl_name} limit 1')
-                cursor.execute(f'truncate table {tmp_tbl_name}')
-                cursor.copy_expert(f'copy {tmp_tbl_name}({",".join(csv_header)}) from stdin csv header NULL as \'null\'',
-                                   buffer)
-                # insert into and on conflict do nothing
-                cursor.execute(f'insert into {tbl_name} select * from {tmp_tbl_name} on conflict do nothing')
-                cursor.execute(f'drop table {tmp_tbl_name}')
+        csv_header = ['date_created', 'last_modified', 'id',
+                      'object_identifier', 'permission', 'action',
+                      'group_id', 'user_id', 'created_by_id']
+        now = timezone.now().isoformat()
+        # duplicated permissions are ignored by inserting on conflict do nothing.
+        with BulkWriter(Permission.objects.model._meta.db_table, csv_header) as writer:
+            writer.write_rows([now, now, str(uuid.uuid4()), i, permission, action, group_id,
+                               user_id, created_by_id] for i in identifiers)
 
@@ -38,6 +38,7 @@ from apps.project.models import Project, DataView
 from apps.project.project_ground_truth.models import GroundTruth
 from apps.project.tasks import create_transfer_items_for_share, create_transfer_job_and_start
 from apps.share.models import Share
+from apps.share.planner import check_plan, PlanTimeout
 from apps.share.tasks import create_share, retract_share
 from apps.storage.models import File
 from apps.terminology.models import CodeSet, Code
@@ -309,6 +310,36 @@ class CreateShareActionView(LoginRequiredMixin, ProjectContextMixin, View):
             gt = project.latest_ground_truth_schema.ground_truths.first()
         else:
             gt = None
+        share_kwargs = dict(valid_from=valid_from,
+                            valid_until=valid_until,
+                            created_by_pk=current_user.id_as_str,
+                            target_nodes_pk=nodes,
+                            query=query,
+                            percentage=percentage,
+                            allowed_actions=checked_actions,
+                            share_name=share_name,
+                            file_pks=files,
+                            project_pk=self.get_project_id(),
+                            term_pks=terms,
+                            extra_data_applications=extra_data_applications,
+                            initial_file_list_id=initial_file_id_list,
+                            ground_truth_pk=gt.id_as_str if gt is not None else None)
+
+        # estimate the share before the long running task is queued. the queries of the plan are bounded by
+        # settings.SHARE_PLAN_STATEMENT_TIMEOUT. a share that cannot be estimated in time is queued anyway.
+        try:
+            plan = create_share('file', project.identifier, dry_run=True, **share_kwargs)
+            errors, warnings = check_plan(plan)
+        except PlanTimeout:
+            logging.warning('Planning share %s timed out.', share_name, exc_info=True)
+            errors, warnings = [], ['The size of the share could not be estimated. It may take a while to be created.']
+        if len(errors) > 0:
+            for error in errors:
+                messages.error(request, error)
+            return redirect('project:create-share-query', pk=project.pk)
+        for warning in warnings:
+            messages.warning(request, warning)
+
         share = Share.objects.create(origin=current_user, created_by=current_user, name=share_name, project=project)
 
         # first execute retract share and then create share
@@ -319,21 +350,8 @@ class CreateShareActionView(LoginRequiredMixin, ProjectContextMixin, View):
 
         celery_task_chain.append(create_share.s('file',
                                                 project.identifier,
-                                                valid_from=valid_from,
-                                                valid_until=valid_until,
-                                                created_by_pk=current_user.id_as_str,
-                                                target_nodes_pk=nodes,
-                                                query=query,
-                                                percentage=percentage,
-                                                allowed_actions=checked_actions,
-                                                share_name=share_name,
-                                                file_pks=files,
-                                                project_pk=self.get_project_id(),
-                                                term_pks=terms,
                                                 share_pk=share.id_as_str,
-                                                extra_data_applications=extra_data_applications,
-                                                initial_file_list_id=initial_file_id_list,
-                                                ground_truth_pk=gt.id_as_str if gt is not None else None))
+                                                **share_kwargs))
         transaction.on_commit(lambda: chain(*celery_task_chain)())
 
         messages.success(request, 'Share will be sent to selected nodes.')
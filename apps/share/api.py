@@ -1,13 +1,12 @@
 import abc
-import csv
-import io
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from typing import Any, Dict
 
-import pandas
-import pandas as pd
 from django.conf import settings
-from django.db import connection
+from django.db import connection, transaction
+from django.db import models
 from django.db.models import QuerySet
 
 from apps.challenge.challenge_dataset.models import Dataset
@@ -27,12 +26,15 @@ from apps.computing.computing_log.serializers import ComputingJobLogEntrySeriali
 from apps.computing.models import ComputingJobDefinition
 from apps.computing.serializers import ComputingJobDefinitionSerializer, ComputingPipelineFullSerializer
 from apps.core import identifier, db_utils
-from apps.core.db_utils import insert_with_copy_from_and_tmp_table
 from apps.permission.models import Permission
 from apps.project.models import Project
 from apps.project.project_case.models import Case
 from apps.project.project_case.serializers import CaseSerializer
 from apps.share.models import Share
+from apps.share.delta import write_delta
+from apps.share.metrics import Metrics, count_sections
+from apps.share.package import PackageWriter, PackageReader, get_package_path, store_content_addressed
+from apps.share.planner import PackagePlan, estimate_duration, statement_timeout
 from apps.storage.extra_data.models import ExtraData
 from apps.storage.models import File
 from apps.storage.serializers import FileSerializer
@@ -172,6 +174,8 @@ def create_share(name: str,
 
 
 class Handler:
+    # handlers whose `handle` only reads from the database can run in a separate thread, see ShareBuilder.build
+    concurrent = False
 
     def __init__(self, **kwargs):
         for k, v in kwargs.items():
@@ -197,67 +201,95 @@ class Handler:
         '''
         pass
 
+    def copy_to_package(self, package: PackageWriter, key, sql):
+        '''
+        Streams the result of `sql` as csv into the section `key` of the package.
+        If the share is only planned, the section is estimated from the query plan of `sql` instead.
+        '''
+        if isinstance(package, PackagePlan):
+            package.estimate(key, sql)
+            return
+        with connection.cursor() as cursor, package.section(key) as section:
+            cursor.copy_expert(f'copy ({sql}) to stdout with csv header', section)
+            rows = cursor.rowcount
+        package.sections[key]['rows'] = rows
+
+    @staticmethod
+    def is_empty(data):
+        if data is None:
+            return True
+        if isinstance(data, QuerySet):
+            return not data.exists()
+        return len(data) == 0
+
+    def link(self, share, field, data):
+        '''
+        Adds all items in `data` to the many-to-many field `field` of the share with a single `insert ... select`.
+        The ids never leave the database if `data` is a queryset.
+        :param field: the name of the many-to-many field on Share e.g. 'files'
+        :param data: queryset, list of ids or list of model instances
+        '''
+        if self.is_empty(data):
+            return
+        m2m = Share._meta.get_field(field)
+        through = m2m.remote_field.through._meta.db_table
+        with self.selection(data) as ids, connection.cursor() as cursor:
+            # share.id is a uuid so it can be inlined. no params are passed, so % in the subquery is not interpreted.
+            cursor.execute(f'''
+                insert into {through} ({m2m.m2m_column_name()}, {m2m.m2m_reverse_name()})
+                select '{share.id_as_str}'::uuid, s.id from ({ids}) as s(id)
+                on conflict do nothing
+            ''')
+
+    @contextmanager
+    def selection(self, data, field='id', column_type='uuid'):
+        '''
+        Yields a sql subquery that selects `field` of all items in `data` to be used as `where x.id in (...)`.
+        A queryset is compiled into a subquery and never evaluated. Everything else (ids, identifiers or model
+        instances) is loaded once into a temp table that is dropped afterwards.
+        '''
+        if isinstance(data, QuerySet):
+            # querysets from values_list() with a single field already select the right column
+            single_column = data._fields is not None and len(data._fields) == 1
+            yield db_utils.queryset_as_sql(data, None if single_column else field)
+        else:
+            values = {getattr(e, field, e) if isinstance(e, models.Model) else e for e in data}
+            with db_utils.temp_table_from_values(values, column_type) as tmp_tbl_name:
+                yield f'select id from {tmp_tbl_name}'
+
 
 class FileHandler(Handler):
     __name__ = 'file'
 
     def handle(self, package, share, data):
         # assume a list of uuids or a queryset
-        if isinstance(data, list):
-            file_ids = set(data)
-        else:
-            file_ids = data.values_list('id', flat=True)
-
-        if len(file_ids) == 0:
+        if self.is_empty(data):
             return
 
-        ids = ','.join(list(map(lambda e: f'\'{e}\'', file_ids)))
-        with connection.cursor() as cursor, io.StringIO() as buffer:
-            sql_1 = f'''select
-                            upp.identifier as origin,
-                            pcc.identifier as
-                            case,
-                            sf.identifier,
-                            sf.name,
-                            sf.content_type,
-                            sf.size,
-                            sf.original_filename,
-                            sf.original_path
-                        from
-                            {File.objects.model._meta.db_table} sf
-                        left join {Case.objects.model._meta.db_table} pcc on
-                            sf.case_id = pcc.id
-                        left join {Profile.objects.model._meta.db_table} upp on
-                            sf.origin_id = upp.id
-                        where sf.id in ({ids})'''
-            sql = f'copy ({sql_1}) to stdout with csv header'
-            cursor.copy_expert(sql, buffer)
-            buffer.seek(0)
-            csv = buffer.read()
-            package['files'] = csv
+        with self.selection(data) as ids:
+            sql = f'''select
+                                upp.identifier as origin,
+                                pcc.identifier as
+                                case,
+                                sf.identifier,
+                                sf.name,
+                                sf.content_type,
+                                sf.size,
+                                sf.original_filename,
+                                sf.original_path
+                            from
+                                {File.objects.model._meta.db_table} sf
+                            left join {Case.objects.model._meta.db_table} pcc on
+                                sf.case_id = pcc.id
+                            left join {Profile.objects.model._meta.db_table} upp on
+                                sf.origin_id = upp.id
+                            where sf.id in ({ids})'''
+            self.copy_to_package(package, 'files', sql)
 
     def set(self, share, data):
         assert share is not None
         logging.debug('Adding files to share.')
-        ids = data.values_list('id', flat=True)
-        with io.StringIO() as buffer:
-            writer = csv.writer(buffer)
-            header = ['share_id', 'file_id']
-            writer.writerow(header)
-            writer.writerows([[share.id_as_str, str(i)] for i in ids])
-
-            buffer.seek(0)
-            df = pandas.read_csv(buffer)
-            db_utils.insert_with_copy_from_and_tmp_table(df, Share.files.through.objects.model._meta.db_table,
-                                                         ','.join(header))
-
-            # tmp_tbl_name = ''.join(random.choice(string.ascii_uppercase) for _ in range(5))
-            # cursor.execute(f'create temp table {tmp_tbl_name} as {sql} limit 1')
-            # cursor.execute(f'truncate table {tmp_tbl_name}')
-            #
-            # cursor.copy_expert(
-            #     f'copy {Share.files.through.objects.model._meta.db_table}({",".join(header)}) from stdin csv header',
-            #     buffer)
+        self.link(share, 'files', data)
         logging.debug('Done adding files to share.')
     # TODO add csv now to package. the question remains how to actually sort those files by dataset or case or whatever.
     # TODO maybe this can be done via some sql generator
@@ -265,37 +297,30 @@ class FileHandler(Handler):
 
 class PermissionHandler(Handler):
     __name__ = 'permissions'
+    concurrent = True
 
     def handle(self, package, share, data):
-        if isinstance(data, QuerySet):
-            data = list(data)
-
-        if len(data) == 0:
+        '''
+        :param data: the object identifiers as queryset (e.g. values_list('identifier', flat=True)) or list.
+        '''
+        if self.is_empty(data):
             return
 
-        # data already in the required format
-        if not isinstance(data, str):
-            # TODO sql injection possible here
-            data = ','.join(list(map(lambda e: f'\'{e}\'', data)))
-
-        sql = f'''
-                select
-                    object_identifier,
-                    permission,
-                    action
---                     string_agg(action, ',') as permission
-                from
-                    {Permission.objects.model._meta.db_table}
-                where
-                    object_identifier in ({data})
-        '''
+        with self.selection(data, field='identifier', column_type='text') as identifiers:
+            sql = f'''
+                    select
+                        object_identifier,
+                        permission,
+                        action
+    --                     string_agg(action, ',') as permission
+                    from
+                        {Permission.objects.model._meta.db_table}
+                    where
+                        object_identifier in ({identifiers})
+            '''
 
-        with connection.cursor() as cursor, io.StringIO() as buffer:
-            cursor.copy_expert(f'copy ({sql}) to stdout with csv header', buffer)
-            buffer.seek(0)
-            csv = buffer.read()
-            package['permissions'] = csv
-            # permissions are not stored as part of the share. they are just part of the shared "package" --> no share.permissions exists.
+            self.copy_to_package(package, 'permissions', sql)
+        # permissions are not stored as part of the share. they are just part of the shared "package" --> no share.permissions exists.
 
 
 class SubmissionHandler(Handler):
@@ -305,10 +330,11 @@ class SubmissionHandler(Handler):
         package['submission'] = SubmissionSerializer(data['submission']).data
         data_files = data.get('data_files')
         if data_files is not None:
-            package['data_files'] = {}
+            files = {}
             for stage_identifier, data_file_name in data_files.items():
                 with (settings.STORAGE_DATA_DIR / data_file_name).open('r') as f:
-                    package['data_files'][stage_identifier] = f.read()
+                    files[stage_identifier] = f.read()
+            package['data_files'] = files
 
     def set(self, share, data):
         share.submissions.add(data['submission'])
@@ -323,6 +349,7 @@ class TilesetHandler(Handler):
 
 class CodeSystemHandler(Handler):
     __name__ = 'codesystem'
+    concurrent = True
 
     def handle(self, package, share, data):
         '''
@@ -332,42 +359,28 @@ class CodeSystemHandler(Handler):
         :param data: A QuerySet containing all the CodeSystems that should be shared.
         :return:
         '''
-        vals = data.values_list('id', flat=True).distinct()
-        if len(vals) == 0:
+        if self.is_empty(data):
             return
 
-        ids = ','.join(list(map(lambda e: f'\'{e}\'', vals)))
-        sql = f'''
-            select cs.name, cs.uri, o.identifier as origin from {CodeSystem.objects.model._meta.db_table} cs
-            left join {Profile.objects.model._meta.db_table} o on o.id = cs.origin_id
-            where cs.id in ({ids})
-            '''
+        with self.selection(data) as ids:
+            sql = f'''
+                select cs.name, cs.uri, o.identifier as origin from {CodeSystem.objects.model._meta.db_table} cs
+                left join {Profile.objects.model._meta.db_table} o on o.id = cs.origin_id
+                where cs.id in ({ids})
+                '''
 
-        with connection.cursor() as cursor, io.StringIO() as buffer:
-            cursor.copy_expert(f'copy ({sql} )to stdout with csv header', buffer)
-            buffer.seek(0)
-            package['codesystems'] = buffer.read()
+            self.copy_to_package(package, 'codesystems', sql)
 
     def set(self, share, data):
         assert share is not None
         logging.debug('Adding codesystems to share.')
-        with connection.cursor() as cursor, io.StringIO() as buffer:
-            writer = csv.writer(buffer)
-            header = ['share_id', 'codesystem_id']
-            # remove duplicated codes
-            unique_data = {(share.id, i.id_as_str) for i in data}
-            writer.writerow(header)
-            writer.writerows([[i[0], i[1]] for i in unique_data])
-            # no need for escaping sql params. this is only inserting ids.
-            buffer.seek(0)
-            cursor.copy_expert(
-                f'copy {Share.codesystem.through.objects.model._meta.db_table}({",".join(header)}) from stdin csv header',
-                buffer)
+        self.link(share, 'codesystem', data)
         logging.debug('Done adding codesystems to share.')
 
 
 class CodesHandler(Handler):
     __name__ = 'codes'
+    concurrent = True
     name_files = 'codes-file'
     name_cases = 'codes'
 
@@ -386,90 +399,77 @@ class CodesHandler(Handler):
         # TODO check if both f.id in and c.id in are actually correct and select no more data than necessary
         # if isinstance(data, list):
         #     ids = [[r]]
-        ids = [[r.id, r.codes] for r in data if r.codes is not None]
-        if len(ids) == 0:
+        if self.is_empty(data):
             return
-        # TODO copy to temp table first
-        f_ids = ','.join([f'\'{r[0]}\'' for r in ids])
-        c_ids = {r[1] for r in ids}  # unique ids for codes
-        c_ids = ','.join([f'\'{r}\'' for r in c_ids])
-        # FIXME this query is not working
-        sql = f'''
-                    select f.identifier as file, u.identifier as origin, c.code as code, cs.uri as codesystem from {table} sfc
-                    join {File.objects.model._meta.db_table} f on sfc.file_id = f.id
-                    join {Code.objects.model._meta.db_table} c on sfc.code_id = c.id
-                    left join {Profile.objects.model._meta.db_table} u on c.origin_id = u.id
-                    join {CodeSystem.objects.model._meta.db_table} cs on c.codesystem_id = cs.id
-                    where f.id in ({f_ids}) and c.id in ({c_ids})
-                '''
-        #
-        #
-        # sql = f'select * from {table}'
-        #
-        #                 ,    join terminology_codesystem cs on c.codesystem_id = cs.id
-
-        with connection.cursor() as cursor, io.StringIO() as buffer:
-            cursor.copy_expert(f'copy ({sql}) to stdout with csv header', buffer)
-            buffer.seek(0)
-            csv = buffer.read()
-            package['codes'] = csv
+        # join against the (file, code) pairs instead of two literal id lists
+        with self.pairs(data) as pairs:
+            if pairs is None:
+                return
+            sql = f'''
+                        select f.identifier as file, u.identifier as origin, c.code as code, cs.uri as codesystem from {table} sfc
+                        join ({pairs}) p on p.file_id = sfc.file_id and p.code_id = sfc.code_id
+                        join {File.objects.model._meta.db_table} f on sfc.file_id = f.id
+                        join {Code.objects.model._meta.db_table} c on sfc.code_id = c.id
+                        left join {Profile.objects.model._meta.db_table} u on c.origin_id = u.id
+                        join {CodeSystem.objects.model._meta.db_table} cs on c.codesystem_id = cs.id
+                    '''
+
+            self.copy_to_package(package, 'codes', sql)
 
     def set(self, share, data):
         # data is a list/queryset of named tuples (id, codes) with id being the file_id and codes being the code_id
         assert share is not None
         logging.debug('Adding codes to share.')
-        with connection.cursor() as cursor, io.StringIO() as buffer:
-            writer = csv.writer(buffer)
-            header = ['share_id', 'code_id']
-            # remove duplicated codes
-            unique_data = {(share.id, i.codes) for i in data if i.codes is not None}
-            writer.writerow(header)
-            writer.writerows([[i[0], i[1]] for i in unique_data])
-            # no need for escaping sql params. this is only inserting ids.
-            buffer.seek(0)
-            cursor.copy_expert(
-                f'copy {Share.codes.through.objects.model._meta.db_table}({",".join(header)}) from stdin csv header',
-                buffer)
+        # files share codes and the share may already be linked to some of them, so duplicates are skipped by link
+        if isinstance(data, QuerySet):
+            codes = Code.objects.filter(pk__in=data.values_list('codes', flat=True))
+        else:
+            codes = {i.codes for i in data if i.codes is not None}
+        self.link(share, 'codes', codes)
         logging.debug('Done adding codes to share.')
 
+    @contextmanager
+    def pairs(self, data):
+        '''
+        Yields a sql subquery that selects the (file_id, code_id) pairs of `data` that have a code, or None if there
+        are none. A queryset is compiled into a subquery and never evaluated, a list is loaded into a temp table.
+        '''
+        if isinstance(data, QuerySet):
+            # the fields are selected again, since querysets select (id, codes) and (codes, id)
+            pairs = db_utils.queryset_as_sql(data.values_list('id', 'codes'))
+            yield f'select * from ({pairs}) as s(file_id, code_id) where s.code_id is not null'
+            return
+        rows = {(r.id, r.codes) for r in data if r.codes is not None}
+        if len(rows) == 0:
+            yield None
+            return
+        with db_utils.temp_table_from_rows({'file_id': 'uuid', 'code_id': 'uuid'}, rows) as tmp_tbl_name:
+            yield f'select file_id, code_id from {tmp_tbl_name}'
+
 
 class CaseHandler(Handler):
     __name__ = 'case'
+    concurrent = True
 
     def handle(self, package, share, data):
-        if isinstance(data, list):
-            data = set(data)
-        else:
-            # else assume the data is already a list of uuids
-            data = data.values_list('id', flat=True).distinct()
-        if len(data) == 0:
+        # a list of uuids or a queryset
+        if self.is_empty(data):
             return
-        ids = ','.join(list(map(lambda e: f'\'{e}\'', data)))
-        sql = f'''
-            select c.name, c.identifier, n.identifier as origin from {Case.objects.model._meta.db_table} c
-            join {Profile.objects.model._meta.db_table} n on n.id = c.origin_id
-            where c.id in ({ids})
-        '''
 
-        with connection.cursor() as cursor, io.StringIO() as buffer:
-            cursor.copy_expert(f'copy ({sql}) to stdout with csv header', buffer)
-            buffer.seek(0)
-            package['cases'] = buffer.read()
+        with self.selection(data) as ids:
+            sql = f'''
+                select c.name, c.identifier, n.identifier as origin from {Case.objects.model._meta.db_table} c
+                join {Profile.objects.model._meta.db_table} n on n.id = c.origin_id
+                where c.id in ({ids})
+            '''
+
+            self.copy_to_package(package, 'cases', sql)
 
     def set(self, share, data):
         assert share is not None
         logging.debug('Adding cases to share.')
-        with connection.cursor() as cursor, io.StringIO() as buffer:
-            writer = csv.writer(buffer)
-            header = ['share_id', 'case_id']
-            writer.writerow(header)
-            writer.writerows([[share.id_as_str, i.id] for i in data])
-            # no need for escaping sql params. this is only inserting ids.
-            buffer.seek(0)
-            cursor.copy_expert(
-                f'copy {Share.cases.through.objects.model._meta.db_table}({",".join(header)}) from stdin csv header',
-                buffer)
-        logging.debug('Done adding codes to share.')
+        self.link(share, 'cases', data)
+        logging.debug('Done adding cases to share.')
 
 
 class EvaluationCodeHandler(Handler):
@@ -505,55 +505,52 @@ class ChallengeHandler(Handler):
             return
 
         def query(sql, key):
-            with connection.cursor() as cursor, io.StringIO() as buffer:
-                cursor.copy_expert(f'copy ({sql}) to stdout with csv header', buffer)
-                buffer.seek(0)
-                package[key] = buffer.read()
+            self.copy_to_package(package, key, sql)
 
         sql = f'''
                     select c.identifier, c.name, c.open_from, c.open_until, c.description, p.identifier as project, n.identifier as origin
                      from {Challenge.objects.model._meta.db_table} c
                      left join {Profile.objects.model._meta.db_table} n on n.id = c.origin_id
                      left join {Project.objects.model._meta.db_table} p on p.id = c.project_id
-                     where c.identifier = '{challenge.identifier}'
+                     where c.id = '{challenge.id_as_str}'
                 '''
         query(sql, 'challenge')
 
         datasets = data.get('datasets', [])
-        if len(datasets) > 0:
-            ids = ','.join(list(map(lambda e: f'\'{e}\'', datasets)))
-            sql = f'''
-                    select d.identifier, d.name, d.type, d.description, c.identifier as challenge from {Dataset.objects.model._meta.db_table} d
-                    left join {Challenge.objects.model._meta.db_table} c on c.id = d.challenge_id
-                    where d.id in ({ids})
-            '''
-            query(sql, 'datasets')
-
-            sql = f'''
-                    select d.identifier as dataset, f.identifier as file from {Dataset.files.through.objects.model._meta.db_table} df
-                    left join {Dataset.objects.model._meta.db_table} d on d.id = df.dataset_id
-                    left join {File.objects.model._meta.db_table} f on f.id = df.file_id
-                    where df.dataset_id in ({ids})
-                    '''
-            query(sql, 'datasets_files')
-
-            sql = f'''
-                    select d.identifier as dataset, c.identifier as case from {Dataset.cases.through.objects.model._meta.db_table} dc
-                    left join {Dataset.objects.model._meta.db_table} d on d.id = dc.dataset_id
-                    left join {Case.objects.model._meta.db_table} c on c.id = dc.case_id
-                    where dc.dataset_id in ({ids})
-                            '''
-            query(sql, 'datasets_cases')
+        if not self.is_empty(datasets):
+            with self.selection(datasets) as ids:
+                sql = f'''
+                        select d.identifier, d.name, d.type, d.description, c.identifier as challenge from {Dataset.objects.model._meta.db_table} d
+                        left join {Challenge.objects.model._meta.db_table} c on c.id = d.challenge_id
+                        where d.id in ({ids})
+                '''
+                query(sql, 'datasets')
+
+                sql = f'''
+                        select d.identifier as dataset, f.identifier as file from {Dataset.files.through.objects.model._meta.db_table} df
+                        left join {Dataset.objects.model._meta.db_table} d on d.id = df.dataset_id
+                        left join {File.objects.model._meta.db_table} f on f.id = df.file_id
+                        where df.dataset_id in ({ids})
+                        '''
+                query(sql, 'datasets_files')
+
+                sql = f'''
+                        select d.identifier as dataset, c.identifier as case from {Dataset.cases.through.objects.model._meta.db_table} dc
+                        left join {Dataset.objects.model._meta.db_table} d on d.id = dc.dataset_id
+                        left join {Case.objects.model._meta.db_table} c on c.id = dc.case_id
+                        where dc.dataset_id in ({ids})
+                                '''
+                query(sql, 'datasets_cases')
 
         target_metrics = data.get('target_metrics', [])
-        if len(target_metrics) > 0:
-            ids = ','.join(list(map(lambda e: f'\'{e}\'', target_metrics)))
-            sql = f'''
-                    select d.identifier, d.sort, d.key, d.dtype, d.filename, c.identifier as challenge from {TargetMetric.objects.model._meta.db_table} d
-                    left join {Challenge.objects.model._meta.db_table} c on c.id = d.challenge_id
-                    where d.id in ({ids})
-            '''
-            query(sql, 'target_metrics')
+        if not self.is_empty(target_metrics):
+            with self.selection(target_metrics) as ids:
+                sql = f'''
+                        select d.identifier, d.sort, d.key, d.dtype, d.filename, c.identifier as challenge from {TargetMetric.objects.model._meta.db_table} d
+                        left join {Challenge.objects.model._meta.db_table} c on c.id = d.challenge_id
+                        where d.id in ({ids})
+                '''
+                query(sql, 'target_metrics')
 
         # serializer computingpipeline that is connected with
         # however, the pipeline is not that huge so serialize it as json
@@ -568,28 +565,13 @@ class ChallengeHandler(Handler):
         package['challenge_pipeline'] = computing_pipeline_serializer(challenge.pipeline).data
 
     def set(self, share, data):
-
-        def set(buffer, header, table):
-            buffer.seek(0)
-            insert_with_copy_from_and_tmp_table(pd.read_csv(buffer), table, insert_columns=', '.join(header))
-
-        with io.StringIO() as buffer:
-            writer = csv.writer(buffer)
-            header = ['share_id', 'challenge_id']
-            writer.writerow(header)
-            writer.writerows([[share.id_as_str, data['challenge'].id_as_str]])
-            # no need for escaping sql params. this is only inserting ids.
-            set(buffer, header, Share.challenges.through.objects.model._meta.db_table)
-
+        assert share is not None
+        logging.debug('Adding challenge to share.')
+        self.link(share, 'challenges', [data['challenge'].id])
         if 'datasets' in data:
-            with io.StringIO() as buffer:
-                writer = csv.writer(buffer)
-                header = ['share_id', 'dataset_id']
-                writer.writerow(header)
-                writer.writerows([[share.id_as_str, str(i)] for i in data['datasets']])
-                set(buffer, header, Share.datasets.through.objects.model._meta.db_table)
-
+            self.link(share, 'datasets', data['datasets'])
         # TODO also set target metric
+        logging.debug('Done adding challenge to share.')
 
 
 class ComputingJobDefinitionHandler(Handler):
@@ -600,7 +582,9 @@ class ComputingJobDefinitionHandler(Handler):
         super().__init__(**kwargs)
 
     def handle(self, package, share, data):
-        ids = ','.join(list(map(lambda e: f'\'{e.id_as_str}\'', data)))
+        if self.is_empty(data):
+            return
+
         default_fields = {'cjd.identifier', 'cjd.name', 'cjd.batch_size', 'cjd.total_batches',
                           's.identifier as submission', 'cjd.execution_type'}
         if self.fields is not None:
@@ -609,28 +593,17 @@ class ComputingJobDefinitionHandler(Handler):
             fields = default_fields
 
         fields = ','.join(f for f in fields)
-        sql = f'select {fields} from {ComputingJobDefinition.objects.model._meta.db_table} cjd ' \
-              f'left join {Submission.objects.model._meta.db_table} s on s.computing_pipeline_id = cjd.pipeline_id ' \
-              f'where cjd.id in ({ids})'
+        with self.selection(data) as ids:
+            sql = f'select {fields} from {ComputingJobDefinition.objects.model._meta.db_table} cjd ' \
+                  f'left join {Submission.objects.model._meta.db_table} s on s.computing_pipeline_id = cjd.pipeline_id ' \
+                  f'where cjd.id in ({ids})'
 
-        with connection.cursor() as cursor, io.StringIO() as buffer:
-            cursor.copy_expert(f'copy ({sql}) to stdout with csv header', buffer)
-            buffer.seek(0)
-            package['computing_job_definitions'] = buffer.read()
+            self.copy_to_package(package, 'computing_job_definitions', sql)
 
     def set(self, share, data):
         assert share is not None
         logging.debug('Adding computing job definitions to share.')
-        with connection.cursor() as cursor, io.StringIO() as buffer:
-            writer = csv.writer(buffer)
-            header = ['share_id', 'computingjobdefinition_id']
-            writer.writerow(header)
-            writer.writerows([[share.id_as_str, i.id] for i in data])
-            # no need for escaping sql params. this is only inserting ids.
-            buffer.seek(0)
-            cursor.copy_expert(
-                f'copy {Share.computing_job_definitions.through.objects.model._meta.db_table}({",".join(header)}) from stdin csv header',
-                buffer)
+        self.link(share, 'computing_job_definitions', data)
         logging.debug('Done adding computing job definitions to share.')
 
 
@@ -638,29 +611,20 @@ class ComputingJobExecutionHandler(Handler):
     __name__ = 'computing-job-execution'
 
     def handle(self, package, share, data):
-        ids = ','.join(list(map(lambda e: f'\'{e.id_as_str}\'', data)))
-        sql = f'select cje.identifier, cje.status, cje.started_at, cje.finished_at, cje.batch_number, cjd.identifier as definition from {ComputingJobExecution.objects.model._meta.db_table} cje ' \
-              f'left join {ComputingJobDefinition.objects.model._meta.db_table} cjd on cjd.id = cje.definition_id ' \
-              f'where cje.id in ({ids})'
+        if self.is_empty(data):
+            return
 
-        with connection.cursor() as cursor, io.StringIO() as buffer:
-            cursor.copy_expert(f'copy ({sql}) to stdout with csv header', buffer)
-            buffer.seek(0)
-            package['computing_job_executions'] = buffer.read()
+        with self.selection(data) as ids:
+            sql = f'select cje.identifier, cje.status, cje.started_at, cje.finished_at, cje.batch_number, cjd.identifier as definition from {ComputingJobExecution.objects.model._meta.db_table} cje ' \
+                  f'left join {ComputingJobDefinition.objects.model._meta.db_table} cjd on cjd.id = cje.definition_id ' \
+                  f'where cje.id in ({ids})'
+
+            self.copy_to_package(package, 'computing_job_executions', sql)
 
     def set(self, share, data):
         assert share is not None
         logging.debug('Adding computing job executions to share.')
-        with connection.cursor() as cursor, io.StringIO() as buffer:
-            writer = csv.writer(buffer)
-            header = ['share_id', 'computingjobexecution_id']
-            writer.writerow(header)
-            writer.writerows([[share.id_as_str, i.id] for i in data])
-            # no need for escaping sql params. this is only inserting ids.
-            buffer.seek(0)
-            cursor.copy_expert(
-                f'copy {Share.computing_job_executions.through.objects.model._meta.db_table}({",".join(header)}) from stdin csv header',
-                buffer)
+        self.link(share, 'computing_job_executions', data)
         logging.debug('Done adding computing job executions to share.')
 
 
@@ -668,33 +632,21 @@ class ComputingJobLogHandler(Handler):
     __name__ = 'computing-job-log'
 
     def handle(self, package, share, data):
-        ids = ','.join(list(map(lambda e: f'\'{e.id_as_str}\'', data)))
-        if len(ids) == 0:
+        if self.is_empty(data):
             package['logs'] = ''
             return
 
-        sql = f'select cjl.type, cjl.content, cjl.position, cjl.logged_at, cjl.identifier as identifier, cje.identifier as computing_job from {ComputingJobLogEntry.objects.model._meta.db_table} cjl ' \
-              f'left join {ComputingJobExecution.objects.model._meta.db_table} cje on cje.id = cjl.computing_job_id ' \
-              f'where cjl.id in ({ids})'
+        with self.selection(data) as ids:
+            sql = f'select cjl.type, cjl.content, cjl.position, cjl.logged_at, cjl.identifier as identifier, cje.identifier as computing_job from {ComputingJobLogEntry.objects.model._meta.db_table} cjl ' \
+                  f'left join {ComputingJobExecution.objects.model._meta.db_table} cje on cje.id = cjl.computing_job_id ' \
+                  f'where cjl.id in ({ids})'
 
-        with connection.cursor() as cursor, io.StringIO() as buffer:
-            cursor.copy_expert(f'copy ({sql}) to stdout with csv header', buffer)
-            buffer.seek(0)
-            package['logs'] = buffer.read()
+            self.copy_to_package(package, 'logs', sql)
 
     def set(self, share, data):
         assert share is not None
         logging.debug('Adding computing job log entries to share.')
-        with connection.cursor() as cursor, io.StringIO() as buffer:
-            writer = csv.writer(buffer)
-            header = ['share_id', 'computingjoblogentry_id']
-            writer.writerow(header)
-            writer.writerows([[share.id_as_str, i.id] for i in data])
-            # no need for escaping sql params. this is only inserting ids.
-            buffer.seek(0)
-            cursor.copy_expert(
-                f'copy {Share.computing_job_logs.through.objects.model._meta.db_table}({",".join(header)}) from stdin csv header',
-                buffer)
+        self.link(share, 'computing_job_logs', data)
         logging.debug('Done adding computing job log entries to share.')
 
 
@@ -702,35 +654,23 @@ class ComputingJobArtifactHandler(Handler):
     __name__ = 'computing-job-artifact'
 
     def handle(self, package, share, data):
-        if len(data) == 0:
+        if self.is_empty(data):
             return
 
-        ids = ','.join(list(map(lambda e: f'\'{e.id_as_str}\'', data)))
-        sql = f'select cjr.identifier as identifier, cjr.date_created, f.identifier as file, cje.identifier as computing_job from {ComputingJobArtifact.objects.model._meta.db_table} cja ' \
-              f'left join {ComputingJobExecution.objects.model._meta.db_table} cje on cje.id = cja.computing_job_id ' \
-              f'left join {ComputingJobResult.objects.model._meta.db_table} cjr on cjr.id = cja.computingjobresult_ptr_id ' \
-              f'left join {File.objects.model._meta.db_table} f on f.id = cja.file_id ' \
-              f'where cjr.id in ({ids})'
+        with self.selection(data) as ids:
+            sql = f'select cjr.identifier as identifier, cjr.date_created, f.identifier as file, cje.identifier as computing_job from {ComputingJobArtifact.objects.model._meta.db_table} cja ' \
+                  f'left join {ComputingJobExecution.objects.model._meta.db_table} cje on cje.id = cja.computing_job_id ' \
+                  f'left join {ComputingJobResult.objects.model._meta.db_table} cjr on cjr.id = cja.computingjobresult_ptr_id ' \
+                  f'left join {File.objects.model._meta.db_table} f on f.id = cja.file_id ' \
+                  f'where cjr.id in ({ids})'
 
-        with connection.cursor() as cursor, io.StringIO() as buffer:
-            cursor.copy_expert(f'copy ({sql}) to stdout with csv header', buffer)
-            buffer.seek(0)
-            package['artefacts'] = buffer.read()
+            self.copy_to_package(package, 'artefacts', sql)
 
     def set(self, share, data):
         assert share is not None
         logging.debug('Adding computing job artefacts to share.')
-        with connection.cursor() as cursor, io.StringIO() as buffer:
-            writer = csv.writer(buffer)
-            header = ['share_id', 'computingjobartifact_id']
-            writer.writerow(header)
-            writer.writerows([[share.id_as_str, i.id] for i in data])
-            # no need for escaping sql params. this is only inserting ids.
-            buffer.seek(0)
-            cursor.copy_expert(
-                f'copy {Share.computing_job_artefacts.through.objects.model._meta.db_table}({",".join(header)}) from stdin csv header',
-                buffer)
-        logging.debug('Done adding computing artefacts entries to share.')
+        self.link(share, 'computing_job_artefacts', data)
+        logging.debug('Done adding computing job artefacts to share.')
 
 
 class TypeHandler(Handler):
@@ -744,47 +684,39 @@ class PreviousIdentifierHandler(Handler):
     __name__ = 'previous-identifier'
 
     def handle(self, package, share, data):
-        package['previous-identifier'] = data
+        package.metadata['previous-identifier'] = data
 
 
 class ExtraDataHandler(Handler):
     __name__ = 'extra-data'
+    concurrent = True
 
     def handle(self, package, share, data):
         extra_data = data  # data.get('extra-data')
         if extra_data is None:
             return
 
-        if isinstance(extra_data, QuerySet) and extra_data.count() == 0:
+        if self.is_empty(extra_data):
             return
 
-        ids = ','.join(list(map(lambda e: f'\'{e.id}\'', extra_data)))
-        sql = f'''
-            select f.identifier as file, c.identifier, c.data, c.application_identifier,
-            c.description, p.identifier as created_by, n.identifier as origin
-             from {ExtraData.objects.model._meta.db_table} c
-             left join {Profile.objects.model._meta.db_table} n on n.id = c.origin_id
-             left join {File.objects.model._meta.db_table} f on f.id = c.file_id
-             left join {Profile.objects.model._meta.db_table} p on p.id = c.created_by_id
-             where c.id in ({ids})
-             '''
-
-        with connection.cursor() as cursor, io.StringIO() as buffer:
-            cursor.copy_expert(f'copy ({sql}) to stdout with csv header', buffer)
-            buffer.seek(0)
-            package['extra-data'] = buffer.read()
+        with self.selection(extra_data) as ids:
+            sql = f'''
+                select f.identifier as file, c.identifier, c.data, c.application_identifier,
+                c.description, p.identifier as created_by, n.identifier as origin
+                 from {ExtraData.objects.model._meta.db_table} c
+                 left join {Profile.objects.model._meta.db_table} n on n.id = c.origin_id
+                 left join {File.objects.model._meta.db_table} f on f.id = c.file_id
+                 left join {Profile.objects.model._meta.db_table} p on p.id = c.created_by_id
+                 where c.id in ({ids})
+                 '''
+
+            self.copy_to_package(package, 'extra-data', sql)
 
     def set(self, share, data):
-        with io.StringIO() as buffer:
-            writer = csv.writer(buffer)
-            header = ['share_id', 'extradata_id']
-            writer.writerow(header)
-            writer.writerows([[share.id_as_str, i.id] for i in data])
-            # no need for escaping sql params. this is only inserting ids.
-            buffer.seek(0)
-            insert_with_copy_from_and_tmp_table(pd.read_csv(buffer),
-                                                Share.extra_data.through.objects.model._meta.db_table,
-                                                insert_columns=', '.join(header))
+        assert share is not None
+        logging.debug('Adding extra data to share.')
+        self.link(share, 'extra_data', data)
+        logging.debug('Done adding extra data to share.')
 
 
 class ShareBuilder:
@@ -809,6 +741,7 @@ class ShareBuilder:
         self.project = project
         self.challenge = challenge
         self.ground_truth = None
+        self.previous_share = None
         self.identifier = None
 
     def add_handler(self, *, handler, data, handler_init_kwargs=None):
@@ -870,8 +803,38 @@ class ShareBuilder:
         self.ground_truth = gt
         return self
 
-    def build(self, project_identifier=None):
+    def set_previous_share(self, previous: Share, recipients=None):
+        '''
+        Builds the share as delta against `previous`. Only rows that were added, changed or removed since `previous`
+        are sent. The full package is kept as snapshot so the next share can be built against this one.
+        :param recipients: the profiles the share is sent to. a full share is built if `previous` was not sent to
+        all of them, because a recipient without `previous` cannot import the delta.
+        '''
+        if not previous.has_package:
+            logging.warning('Share %s has no package. Building a full share instead of a delta.', previous)
+            return self
+        if recipients is not None:
+            missing = {r.pk for r in recipients} - set(previous.tokens.values_list('recipient_id', flat=True))
+            if len(missing) > 0:
+                logging.warning('Share %s was not sent to %s recipients. Building a full share instead of a delta.',
+                                previous, len(missing))
+                return self
+        self.previous_share = previous
+        return self.add_previous_identifier_handler(data=str(previous.identifier))
+
+    def build(self, project_identifier=None, concurrent: bool | None = None):
+        '''
+        :param concurrent: run the exports of concurrent handlers in a thread pool. defaults to
+        settings.SHARE_BUILD_CONCURRENT.
+        '''
+        if concurrent is None:
+            concurrent = settings.SHARE_BUILD_CONCURRENT
+        if concurrent and connection.in_atomic_block:
+            # other connections would not see the uncommitted rows of the caller
+            logging.warning('Cannot export share handlers concurrently inside a transaction. Exporting sequentially.')
+            concurrent = False
         logging.info('[start] building share')
+        self.metrics = Metrics()
         if self.identifier is None:
             self.identifier = identifier.create_random('share')
         if self.pk is None:
@@ -899,24 +862,152 @@ class ShareBuilder:
         if self.challenge is not None:
             self.share.challenges.add(self.challenge)
 
-        package = {'identifier': str(self.share.identifier)}
-        if self.type is not None:
-            package['type'] = self.type
-        if project_identifier is not None:
-            package['project'] = project_identifier
-        if self.ground_truth is not None:
-            package['ground_truth_schema'] = self.ground_truth.schema.identifier
-            package['ground_truth'] = self.ground_truth.identifier
+        # the package is streamed into a file. the share itself only keeps the manifest of the package.
+        with PackageWriter(get_package_path(f'{self.share.id_as_str}.pkg')) as package:
+            # the identifier differs for every share, so it is kept out of the content of the package
+            package.metadata['identifier'] = str(self.share.identifier)
+            if self.type is not None:
+                package['type'] = self.type
+            if project_identifier is not None:
+                package['project'] = project_identifier
+            if self.ground_truth is not None:
+                package['ground_truth_schema'] = self.ground_truth.schema.identifier
+                package['ground_truth'] = self.ground_truth.identifier
 
-        for handler in self.handlers:
-            logging.info('[start] Handler %s', handler.__name__)
-            handler.handle(package, self.share, self.handlers_data.get(handler.__name__))
-            handler.set(self.share, self.handlers_data.get(handler.__name__))
-            logging.info('[end] Handler %s', handler.__name__)
+            if concurrent:
+                self._run_handlers_concurrently(package)
+            else:
+                self._run_handlers(package)
 
         logging.debug('Handlers finished.')
-        self.share.content = package
-        self.share.save(update_fields=['content'])
+        manifest = store_content_addressed(package.manifest)
+        if self.previous_share is not None:
+            with self.metrics.measure('delta') as step:
+                manifest = self._write_delta(manifest)
+                count_sections(step, {}, manifest['sections'])
+        self.share.content = {}
+        self.share.package = manifest
+        self.share.metrics = {'build': self.metrics.as_dict()}
+        self.share.save(update_fields=['content', 'package', 'metrics'])
 
         logging.info('[end] building share')
         return self.share
+
+    def plan(self):
+        '''
+        Estimates the package of the share without building it. The handlers run their export queries in EXPLAIN
+        mode, nothing is written and no share is created. A delta share is estimated as full share.
+        :return: dict with the estimated rows and bytes per section and handler, the totals and the expected build
+        duration in seconds (None if there are no metrics of previous shares)
+        :raises PlanTimeout: if a query of a handler exceeds settings.SHARE_PLAN_STATEMENT_TIMEOUT
+        '''
+        logging.info('[start] planning share')
+        package = PackagePlan()
+        handlers = {}
+        with statement_timeout():
+            for handler in self.handlers:
+                step = {'rows': 0, 'bytes': 0}
+                sections = dict(package.sections)
+                handler.handle(package, None, self.handlers_data.get(handler.__name__))
+                count_sections(step, sections, package.sections)
+                handlers[handler.__name__] = step
+        logging.info('[end] planning share')
+        return {
+            'sections': package.sections,
+            'handlers': handlers,
+            'rows': sum(s['rows'] for s in handlers.values()),
+            'bytes': sum(s['bytes'] for s in handlers.values()),
+            'duration': estimate_duration(handlers),
+        }
+
+    def _write_delta(self, manifest):
+        current = PackageReader(get_package_path(manifest['path']), manifest)
+        with PackageWriter(get_package_path(f'{self.share.id_as_str}.delta.pkg')) as package:
+            package.metadata.update(manifest['metadata'])
+            write_delta(package, current, self.previous_share.open_snapshot(), str(self.previous_share.identifier))
+        return {**store_content_addressed(package.manifest), 'snapshot': manifest}
+
+    def _run_handlers(self, package: PackageWriter):
+        for handler in self.handlers:
+            logging.info('[start] Handler %s', handler.__name__)
+            with self.metrics.measure(handler.__name__) as step:
+                sections = dict(package.sections)
+                handler.handle(package, self.share, self.handlers_data.get(handler.__name__))
+                handler.set(self.share, self.handlers_data.get(handler.__name__))
+                count_sections(step, sections, package.sections)
+            logging.info('[end] Handler %s', handler.__name__)
+
+    def _run_handlers_concurrently(self, package: PackageWriter):
+        '''
+        Exports of concurrent handlers run in a thread pool, each on its own connection and into its own part file.
+        All of them import the snapshot of the build transaction so they see the same state of the database.
+        The remaining handlers and all `set` calls run in order in the build transaction, which is repeatable read so
+        it keeps reading that snapshot. Must not be called inside a transaction, see build.
+        The part files are appended to the package in handler order once all exports are done.
+        '''
+        parts = {}
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    # read committed would take a new snapshot for every statement of the build transaction
+                    cursor.execute('set transaction isolation level repeatable read')
+                    cursor.execute('select pg_export_snapshot()')
+                    snapshot_id = cursor.fetchone()[0]
+
+                with ThreadPoolExecutor(max_workers=settings.SHARE_BUILD_MAX_WORKERS) as executor:
+                    futures = {}
+                    for handler in filter(lambda h: h.concurrent, self.handlers):
+                        parts[handler.__name__] = package.path.with_name(
+                            f'{package.path.name}.{handler.__name__}.part')
+                        futures[handler.__name__] = executor.submit(_handle_in_snapshot, handler, self.share,
+                                                                    _clone(self.handlers_data.get(handler.__name__)),
+                                                                    snapshot_id, parts[handler.__name__])
+
+                    for handler in self.handlers:
+                        logging.info('[start] Handler %s', handler.__name__)
+                        with self.metrics.measure(handler.__name__) as step:
+                            sections = dict(package.sections)
+                            if not handler.concurrent:
+                                handler.handle(package, self.share, self.handlers_data.get(handler.__name__))
+                            handler.set(self.share, self.handlers_data.get(handler.__name__))
+                            count_sections(step, sections, package.sections)
+                        logging.info('[end] Handler %s', handler.__name__)
+
+                    for name, future in futures.items():
+                        manifest, step = future.result()
+                        package.append(parts[name], manifest)
+                        # the export ran in another thread, so it is measured separately from `set`
+                        self.metrics.add(f'{name}-export', step)
+                        logging.info('[end] Handler %s export', name)
+        finally:
+            for path in parts.values():
+                path.unlink(missing_ok=True)
+
+
+def _clone(data):
+    # querysets cache their results and must not be shared between threads
+    if isinstance(data, QuerySet):
+        return data.all()
+    return data
+
+
+def _handle_in_snapshot(handler: Handler, share, data, snapshot_id: str, path):
+    '''
+    Runs `handler.handle` on the connection of the current thread in the snapshot `snapshot_id` and writes its
+    sections into a part package at `path`.
+    :return: the manifest of the part package and the metrics of the export
+    '''
+    logging.info('[start] Handler %s export', handler.__name__)
+    metrics = Metrics()
+    try:
+        with transaction.atomic(), metrics.measure(handler.__name__) as step:
+            with connection.cursor() as cursor:
+                cursor.execute('set transaction isolation level repeatable read')
+                cursor.execute('set transaction snapshot %s', [snapshot_id])
+            with PackageWriter(path) as part:
+                handler.handle(part, share, data)
+            count_sections(step, {}, part.sections)
+        return part.manifest, step
+    finally:
+        # connections are per thread and are not closed by django outside the request cycle
+        connection.close()
@@ -0,0 +1,244 @@
+import json
+import logging
+import math
+import random
+import resource
+import uuid
+from contextlib import ExitStack, contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from apps.core import db_utils, identifier
+from apps.federation.inbox.models import InboxMessage
+from apps.federation.messages import Message, ShareObject
+from apps.node.models import Node
+from apps.permission.models import Permission
+from apps.project.models import Project
+from apps.project.project_case.models import Case
+from apps.share.api import CodesHandler, ShareBuilder
+from apps.share.metrics import Metrics
+from apps.share.models import Share
+from apps.share.package import PACKAGE_REFERENCE_KEY, PackageReader, PackageWriter, build_reference, \
+    get_package_path, store_content_addressed
+from apps.share.tasks import create_share
+from apps.storage.extra_data.models import ExtraData
+from apps.storage.models import File
+from apps.terminology.models import Code, CodeSystem
+from apps.user.user_profile.models import Profile
+from apps.utils import get_user_node
+
+SIZES = [10_000, 100_000, 1_000_000]
+FILES_PER_CASE = 10
+CODES = 20
+EXTRA_DATA_APPLICATION = 'benchmark'
+
+
+def peak_rss_mb():
+    '''
+    Peak resident set size of this process in MB. ru_maxrss never decreases, so it is the peak up to the end of a
+    step and not of the step alone.
+    '''
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+class ShareBenchmark:
+    '''
+    Generates a project with `files` files and measures building, creating and importing a share of it.
+    The data is copied straight into the tables and is not removed afterwards, so only run it against a throwaway
+    database. No federation services are needed: `create_share` creates the share tokens but sends nothing
+    and the share is imported from its package on the same node.
+    Each step records duration, queries and the peak rss. Queries are counted on the connection of the current thread
+    only, so the exports of a concurrent build are not included.
+    '''
+
+    def __init__(self, files: int, files_per_case: int = FILES_PER_CASE, codes: int = CODES):
+        self.files = files
+        self.files_per_case = files_per_case
+        self.codes = codes
+        self.cases = math.ceil(files / files_per_case)
+        self.metrics = Metrics()
+        self.created_by = None
+        self.recipient = None
+        self.project = None
+
+    @contextmanager
+    def measure(self, name):
+        with self.metrics.measure(name) as step:
+            yield step
+        step['peak_rss_mb'] = peak_rss_mb()
+
+    def run(self):
+        '''
+        :return: dict with the size of the project, the measured steps and the metrics the share build and import
+        collected themselves
+        '''
+        logging.info('[start] share benchmark with %s files', self.files)
+        with self.measure('generate') as step:
+            step['rows'] = self.generate()
+        with self.measure('build') as step:
+            built = self.builder().build(self.project.identifier)
+            step['bytes'] = built.package['size']
+        with self.measure('create_share') as step:
+            created = self.create_share()
+            step['bytes'] = created.package['size']
+        with self.measure('import_share') as step:
+            imported = self.import_share(created)
+            step['bytes'] = imported.package['size']
+        logging.info('[end] share benchmark with %s files', self.files)
+        return {
+            'files': self.files,
+            'cases': self.cases,
+            'codes': self.codes,
+            'steps': self.metrics.steps,
+            'build': built.metrics.get('build'),
+            'create_share': created.metrics.get('build'),
+            'import_share': imported.metrics.get('import'),
+        }
+
+    def generate(self):
+        '''
+        Creates the project with one case per `files_per_case` files. Every file has a code, a permission and an
+        extra data row. Everything is copied in one transaction since the foreign keys are checked on commit.
+        :return: the number of copied rows
+        '''
+        self.created_by = get_user_node()
+        # nothing is sent to the recipient
+        self.recipient = create_node_profile(f'benchmark-{uuid.uuid4().hex[:8]}')
+        self.project = Project.objects.create(created_by=self.created_by, origin=self.created_by,
+                                              name=f'Benchmark {self.files}',
+                                              identifier=identifier.create_random('project'))
+        self.project.add_member(self.recipient)
+        codesystem = CodeSystem.objects.create(project=self.project, name=uuid.uuid4().hex,
+                                               uri=f'https://benchmark.centauron/{uuid.uuid4().hex}')
+        codes = [Code.objects.create(codesystem=codesystem, code=f'code-{i}', origin=self.created_by).id_as_str
+                 for i in range(self.codes)]
+
+        now = timezone.now()
+        user_id = self.created_by.id_as_str
+        project_id = self.project.id_as_str
+        with transaction.atomic(), ExitStack() as stack:
+            def writer(model, columns):
+                return stack.enter_context(db_utils.BulkWriter(model._meta.db_table, columns, mode='copy'))
+
+            cases = writer(Case, ['id', 'date_created', 'last_modified', 'identifier', 'name', 'created_by_id',
+                                  'origin_id'])
+            project_cases = writer(Case.projects.through, ['case_id', 'project_id'])
+            files = writer(File, ['id', 'date_created', 'last_modified', 'identifier', 'name', 'imported', 'case_id',
+                                  'original_filename', 'original_path', 'size', 'created_by_id', 'origin_id'])
+            file_codes = writer(File.codes.through, ['file_id', 'code_id'])
+            permissions = writer(Project.files.through, ['id', 'date_created', 'last_modified', 'project_id',
+                                                         'user_id', 'file_id', 'imported'])
+            extra_data = writer(ExtraData, ['id', 'date_created', 'last_modified', 'identifier', 'file_id', 'data',
+                                            'application_identifier', 'created_by_id', 'origin_id'])
+            project_extra_data = writer(Project.extra_data.through, ['id', 'date_created', 'last_modified',
+                                                                     'project_id', 'user_id', 'extra_data_id',
+                                                                     'imported'])
+            writers = [cases, project_cases, files, file_codes, permissions, extra_data, project_extra_data]
+
+            case_id = None
+            for i in range(self.files):
+                if i % self.files_per_case == 0:
+                    case_id = uuid.uuid4()
+                    cases.write([case_id, now, now, identifier.create_random('case'), f'case-{i}', user_id, user_id])
+                    project_cases.write([case_id, project_id])
+                file_id = uuid.uuid4()
+                files.write([file_id, now, now, identifier.create_random('file'), f'file-{i}.svs', True, case_id,
+                             f'file-{i}.svs', f'/benchmark/file-{i}.svs', 1024 * 1024, user_id, user_id])
+                file_codes.write([file_id, codes[i % len(codes)]])
+                permissions.write([uuid.uuid4(), now, now, project_id, user_id, file_id, True])
+                extra_data_id = uuid.uuid4()
+                extra_data.write([extra_data_id, now, now, identifier.create_random('extra-data'), file_id,
+                                  {'index': i, 'score': random.random()}, EXTRA_DATA_APPLICATION, user_id, user_id])
+                project_extra_data.write([uuid.uuid4(), now, now, project_id, user_id, extra_data_id, True])
+        return sum(w.rows for w in writers)
+
+    def builder(self, share_pk=None):
+        '''
+        Returns a ShareBuilder with the handlers `create_share` adds for all files of the project.
+        '''
+        file_qs = self.project.files_for_user(self.created_by)
+        builder = ShareBuilder(share_pk, f'Benchmark {self.files}', created_by=self.created_by,
+                               origin=self.created_by, project=self.project, file_query='{}')
+        builder.add_type_handler(data='data-release')
+        builder.add_file_handler(data=file_qs)
+        builder.add_case_handler(data=Case.objects.filter(projects=self.project))
+        builder.add_codesystem_handler(data=CodeSystem.objects.filter(project=self.project))
+        builder.add_codes_handler(data=file_qs.values_list('codes', 'id', named=True),
+                                  handler_init_kwargs={'__name__': CodesHandler.name_files})
+        builder.add_permission_handler(data=file_qs.values_list('identifier', flat=True))
+        builder.add_extra_data_handler(data=self.project.extra_data_for_user(self.created_by))
+        return builder
+
+    def create_share(self):
+        '''
+        Runs the `create_share` task like the create share view does, with all files, codes and extra data selected.
+        '''
+        share = Share.objects.create(origin=self.created_by, created_by=self.created_by,
+                                     name=f'Benchmark {self.files}', project=self.project)
+        file_pks = [str(pk) for pk in self.project.files_for_user(self.created_by).values_list('id', flat=True)]
+        # the share tokens are created, but the share is not sent
+        create_share('file', self.project.identifier,
+                     valid_from=timezone.now(),
+                     valid_until=timezone.now() + timedelta(days=30),
+                     created_by_pk=self.created_by.id_as_str,
+                     target_nodes_pk=[self.recipient.id_as_str],
+                     query='{}',
+                     percentage=100,
+                     allowed_actions=[Permission.Action.VIEW],
+                     share_name=share.name,
+                     share_pk=share.id_as_str,
+                     file_pks=file_pks,
+                     project_pk=self.project.id_as_str,
+                     term_pks=list(self.project.codesystem.codes.values_list('id', flat=True)),
+                     extra_data_applications=[EXTRA_DATA_APPLICATION],
+                     initial_file_list_id=file_pks,
+                     send=False)
+        share.refresh_from_db()
+        return share
+
+    def import_share(self, share: Share):
+        '''
+        Imports `share` by reference as if it was sent by another node. The identifiers of the package are moved to a
+        random identifier system, so every row is imported as new row into the same project.
+        '''
+        system = f'benchmark-{uuid.uuid4().hex[:8]}'
+        package = rewrite_package(share.package, settings.IDENTIFIER, system)
+        content = {'identifier': str(share.identifier).replace(settings.IDENTIFIER, system, 1),
+                   PACKAGE_REFERENCE_KEY: build_reference(package)}
+        sender = create_node_profile(system)
+        message = Message(from_=sender.identifier, to=self.created_by.identifier,
+                          object=ShareObject(content=content, sender=sender.identifier,
+                                             recipient=self.created_by.identifier))
+        inbox_message = InboxMessage.objects.create(sender=sender, recipient=self.created_by,
+                                                    message=json.loads(message.model_dump_json(by_alias=True)))
+        Share.import_share(message=message, inbox_message=inbox_message)
+        return Share.objects.get(identifier=content['identifier'])
+
+
+def create_node_profile(system: str) -> Profile:
+    '''
+    Creates the profile of another node like `setup_node` does for this node.
+    '''
+    node = Node.objects.create(identifier=system, did=uuid.uuid4().hex, human_readable=system)
+    return Profile.objects.create(identifier=system, identity=uuid.uuid4().hex, human_readable=system, node=node)
+
+
+def rewrite_package(manifest, old_system: str, new_system: str):
+    '''
+    Copies the package of `manifest` and replaces the identifier system `old_system` in all sections but the project.
+    :return: the manifest of the content addressed copy
+    '''
+    reader = PackageReader(get_package_path(manifest['path']), manifest)
+    old, new = f'{old_system}#', f'{new_system}#'
+    with PackageWriter(get_package_path(f'{uuid.uuid4()}.pkg')) as writer:
+        writer.metadata.update({k: v.replace(old, new) for k, v in manifest.get('metadata', {}).items()})
+        for key, section in reader.sections.items():
+            with reader.open_text(key) as source, writer.section(key, section['format']) as sink:
+                for line in source:
+                    sink.write(line if key == 'project' else line.replace(old, new))
+            if 'rows' in section:
+                writer.sections[key]['rows'] = section['rows']
+    return store_content_addressed(writer.manifest)
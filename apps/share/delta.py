@@ -0,0 +1,106 @@
+import csv
+import hashlib
+import logging
+import shutil
+
+from apps.share.package import PackageReader, PackageWriter
+
+# columns that identify a row of a csv section. rows of sections that are not listed are identified by all columns.
+SECTION_KEYS = {
+    'files': ['identifier'],
+    'cases': ['identifier'],
+    'codesystems': ['uri'],
+    'codes': ['file', 'code', 'codesystem'],
+    'permissions': ['object_identifier', 'action'],
+    'extra-data': ['identifier'],
+}
+# csv sections that are copied as they are. permissions are not imported as part of a share, so the recipient could
+# not revoke removed ones anyway.
+FULL_SECTIONS = ['permissions']
+REMOVED_SUFFIX = '-removed'
+DELTA_KEY = 'delta'
+
+
+class DeltaException(Exception):
+    pass
+
+
+def _hash_row(row):
+    return hashlib.sha1('\x1f'.join(row).encode('utf-8')).digest()
+
+
+def _key_indices(header, key):
+    columns = SECTION_KEYS.get(key)
+    if columns is None or not set(columns).issubset(header):
+        return list(range(len(header)))
+    return [header.index(c) for c in columns]
+
+
+def _read_hashes(reader: PackageReader, key):
+    '''
+    Returns the header and a dict row key -> hash of the row for the csv section `key`.
+    Only the hashes are kept in memory, not the rows.
+    '''
+    if key not in reader:
+        return [], {}
+    with reader.open_text(key) as f:
+        rows = csv.reader(f)
+        header = next(rows, [])
+        indices = _key_indices(header, key)
+        return header, {tuple(row[i] for i in indices): _hash_row(row) for row in rows}
+
+
+def write_section_delta(package: PackageWriter, current: PackageReader, previous: PackageReader, key):
+    '''
+    Writes the rows of the csv section `key` that were added or changed since `previous` into the section `key`
+    and the keys of the removed rows into the section `key-removed`.
+    :return: the key columns of the section
+    '''
+    previous_header, previous_hashes = _read_hashes(previous, key)
+    if key in current:
+        with current.open_text(key) as f, package.section(key) as sink:
+            rows = csv.reader(f)
+            header = next(rows, [])
+            indices = _key_indices(header, key)
+            if header != previous_header:
+                # different columns: every row counts as changed but removed rows are still detected by their key
+                previous_hashes = dict.fromkeys(previous_hashes)
+            writer = csv.writer(sink)
+            writer.writerow(header)
+            for row in rows:
+                row_key = tuple(row[i] for i in indices)
+                if previous_hashes.pop(row_key, None) != _hash_row(row):
+                    writer.writerow(row)
+    else:
+        # the section is gone, so all of its rows were removed
+        header = previous_header
+        indices = _key_indices(header, key)
+
+    key_columns = [header[i] for i in indices]
+    with package.section(key + REMOVED_SUFFIX) as sink:
+        writer = csv.writer(sink)
+        writer.writerow(key_columns)
+        writer.writerows(previous_hashes.keys())
+    return key_columns
+
+
+def write_delta(package: PackageWriter, current: PackageReader, previous: PackageReader, previous_identifier: str):
+    '''
+    Writes the difference between the full packages `previous` and `current` into `package`.
+    Json sections and FULL_SECTIONS are copied as they are, csv sections only contain the added and changed rows.
+    '''
+    logging.info('[start] writing delta against %s', previous_identifier)
+    keys = {}
+    for key in current.keys():
+        if current.sections[key]['format'] == PackageWriter.FORMAT_JSON:
+            package[key] = current.read(key)
+    csv_keys = {k for r in [current, previous] for k in r.keys()
+                if r.sections[k]['format'] == PackageWriter.FORMAT_CSV}
+    for key in sorted(csv_keys):
+        if key not in FULL_SECTIONS:
+            keys[key] = write_section_delta(package, current, previous, key)
+        elif key in current:
+            with current.open(key) as f, package.section(key) as sink:
+                shutil.copyfileobj(f, sink)
+    package[DELTA_KEY] = {'previous-identifier': previous_identifier, 'keys': keys}
+    logging.info('[end] writing delta against %s', previous_identifier)
@@ -0,0 +1,126 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, List
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from apps.core import db_utils
+from apps.share.metrics import Metrics
+
+
+class ImportStep:
+
+    def __init__(self, name: str, fn: Callable, depends_on: List[str], keys: List[str]):
+        self.name = name
+        self.fn = fn
+        self.depends_on = depends_on
+        self.keys = keys
+
+
+class ImportGraph:
+    '''
+    Imports the sections of a share as a small DAG of steps. Every step writes into its own staging tables
+    (see db_utils.Staging) in a short transaction. If concurrent, steps whose dependencies are done run in parallel,
+    each on its own db connection. The staged rows are not visible in the destination tables until `publish` is
+    called in the final transaction. Steps must not create rows through the orm, which are not staged and could be
+    created twice by concurrent steps. Such rows (e.g. profiles) are created before the graph runs.
+    If a `checkpoint` is given, it is called with the state of the staging after every completed step. A graph
+    created with that state skips the completed steps, so a failed import can be resumed.
+    '''
+
+    def __init__(self, metrics: Metrics, content, sections=None, checkpoint: Callable[[dict], None] = None,
+                 state: dict = None):
+        self.metrics = metrics
+        self.content = content
+        self.sections = sections
+        self.steps = {}
+        self.checkpoint = checkpoint
+        self.staging = db_utils.Staging.from_state(state) if state else db_utils.Staging()
+        self._checkpoint_lock = threading.Lock()
+
+    def add(self, name: str, fn: Callable, depends_on: List[str] = None, keys: List[str] = None):
+        '''
+        :param fn: imports the step. is called without arguments.
+        :param depends_on: steps whose rows must be staged before this step runs
+        :param keys: the sections of the content the step imports. only used for metrics.
+        '''
+        for dependency in depends_on or []:
+            if dependency not in self.steps:
+                raise ValueError(f'Step {name} depends on unknown step {dependency}.')
+        self.steps[name] = ImportStep(name, fn, depends_on or [], keys or [])
+        return self
+
+    def run(self, concurrent: bool | None = None):
+        '''
+        :param concurrent: run independent steps in a thread pool. defaults to settings.SHARE_IMPORT_CONCURRENT.
+        '''
+        if concurrent is None:
+            concurrent = settings.SHARE_IMPORT_CONCURRENT
+        if concurrent and connection.in_atomic_block:
+            # other connections would not see the uncommitted rows of the caller
+            logging.warning('Cannot import share sections concurrently inside a transaction. Importing sequentially.')
+            concurrent = False
+        if self.staging.completed:
+            logging.info('Resuming import. Skipping completed steps %s.', ', '.join(sorted(self.staging.completed)))
+        try:
+            if concurrent:
+                self._run_concurrently()
+            else:
+                # steps can only depend on steps that were added before, so the order of adding is a valid order
+                for step in self.steps.values():
+                    if step.name not in self.staging.completed:
+                        self._run_step(step)
+        except Exception:
+            if self.checkpoint is None:
+                self.staging.drop()
+            # otherwise the staging tables of the completed steps are kept for the retry
+            raise
+
+    def publish(self):
+        '''
+        Publishes the staged rows of all steps. Should run in a transaction.
+        '''
+        logging.info('[start] publish staged share sections')
+        with self.metrics.measure('publish') as step:
+            step['rows'] = self.staging.publish()
+        logging.info('[end] publish staged share sections')
+
+    def _run_step(self, step: ImportStep):
+        logging.info('[start] import %s', step.name)
+        try:
+            with self.metrics.measure_content(step.name, self.content, step.keys, self.sections), \
+                    self.staging.activate(step.name), transaction.atomic():
+                step.fn()
+        except Exception:
+            # the staging tables were created in the rolled back transaction
+            self.staging.discard(step.name)
+            raise
+        self.staging.complete(step.name)
+        if self.checkpoint is not None:
+            # steps complete concurrently. the lock keeps an older state from overwriting a newer one.
+            with self._checkpoint_lock:
+                self.checkpoint(self.staging.state())
+        logging.info('[end] import %s', step.name)
+
+    def _run_step_in_thread(self, step: ImportStep):
+        try:
+            self._run_step(step)
+        finally:
+            # connections are per thread and are not closed by django outside the request cycle
+            connection.close()
+
+    def _run_concurrently(self):
+        done, running = set(self.staging.completed), {}
+        with ThreadPoolExecutor(max_workers=settings.SHARE_IMPORT_MAX_WORKERS) as executor:
+            while len(done) < len(self.steps):
+                for step in self.steps.values():
+                    if step.name not in done and step.name not in running and set(step.depends_on) <= done:
+                        running[step.name] = executor.submit(self._run_step_in_thread, step)
+                finished, _ = wait(running.values(), return_when=FIRST_COMPLETED)
+                for name, future in list(running.items()):
+                    if future in finished:
+                        del running[name]
+                        future.result()
+                        done.add(name)
@@ -0,0 +1,41 @@
+import json
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from apps.share.benchmark import CODES, FILES_PER_CASE, SIZES, ShareBenchmark
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks building, creating and importing shares of synthetic projects. ' \
+           'Writes a lot of data that is not removed, only run it against a throwaway database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=SIZES, help='number of files per project')
+        parser.add_argument('--files-per-case', type=int, default=FILES_PER_CASE)
+        parser.add_argument('--codes', type=int, default=CODES)
+        parser.add_argument('--output', type=Path, default=Path('share_benchmark.json'))
+
+    def handle(self, *args, **options):
+        results = {
+            'started_at': timezone.now().isoformat(),
+            'settings': {
+                'SHARE_BUILD_CONCURRENT': settings.SHARE_BUILD_CONCURRENT,
+                'SHARE_IMPORT_CONCURRENT': settings.SHARE_IMPORT_CONCURRENT,
+                'SHARE_SEND_BY_REFERENCE': settings.SHARE_SEND_BY_REFERENCE,
+                'BULK_WRITER_BATCH_SIZE': settings.BULK_WRITER_BATCH_SIZE,
+                'IMPORTER_CHUNK_SIZE': settings.IMPORTER_CHUNK_SIZE,
+            },
+            'results': [],
+        }
+        for size in options['sizes']:
+            benchmark = ShareBenchmark(size, files_per_case=options['files_per_case'], codes=options['codes'])
+            results['results'].append(benchmark.run())
+            # written after every size so the results of the smaller projects survive if a larger one fails
+            with options['output'].open('w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f'{size} files: ' + ', '.join(
+                f'{name} {step["duration"]}s' for name, step in benchmark.metrics.steps.items()))
+        self.stdout.write(self.style.SUCCESS(f'Results written to {options["output"]}'))
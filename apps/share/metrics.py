@@ -0,0 +1,77 @@
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+
+
+class _QueryCounter:
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class Metrics:
+    '''
+    Collects duration, rows, bytes and number of db queries for each step of a share build or import.
+    Queries are counted on the connection of the current thread only. Rows and bytes are set by the step itself.
+    '''
+
+    def __init__(self):
+        self.steps = {}
+        self.started_at = time.perf_counter()
+
+    @contextmanager
+    def measure(self, name):
+        step = {'duration': 0.0, 'rows': 0, 'bytes': 0, 'queries': 0}
+        counter = _QueryCounter()
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(counter):
+                yield step
+        finally:
+            step['duration'] = round(time.perf_counter() - start, 4)
+            step['queries'] = counter.count
+            self.steps[name] = step
+
+    @contextmanager
+    def measure_content(self, name, content, keys, sections=None):
+        '''
+        Measures a step that consumes the csv sections `keys` of the share content. Rows and bytes are taken from the
+        package manifest if the share was sent as package, else counted from the content.
+        '''
+        if sections is None:
+            sections = {}
+        with self.measure(name) as step:
+            for key in keys:
+                value = content.get(key)
+                if key in sections:
+                    step['rows'] += sections[key].get('rows', 0)
+                    step['bytes'] += sections[key]['size']
+                elif isinstance(value, str):
+                    step['rows'] += max(value.count('\n') - 1, 0)
+                    step['bytes'] += len(value)
+            yield step
+
+    def add(self, name, step):
+        self.steps[name] = step
+
+    def as_dict(self):
+        total = {k: sum(s[k] for s in self.steps.values()) for k in ['rows', 'bytes', 'queries']}
+        total['duration'] = round(time.perf_counter() - self.started_at, 4)
+        return {'total': total, 'steps': self.steps}
+
+
+def count_sections(step, before, after):
+    '''
+    Adds rows and bytes of all sections in `after` that were written since `before` to `step`.
+    :param before: the sections of the package before the step
+    :param after: the sections of the package after the step
+    '''
+    for key, section in after.items():
+        if before.get(key) is not section:
+            step['rows'] += section.get('rows', 0)
+            step['bytes'] += section['size']
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.9 on 2026-10-17 22:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('share', '0014_remove_share_unique_share_name_per_project_and_user'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='share',
+            name='package',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.9 on 2026-10-17 23:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('share', '0015_share_package'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='share',
+            name='metrics',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -1,26 +1,47 @@
+import csv
+import io
 import logging
+from functools import partial
 
-from django.db import models, transaction
+from django.db import models, transaction, connection
 
 from apps.challenge.challenge_dataset.models import Dataset, EvaluationCode
 from apps.challenge.challenge_targetmetric.models import TargetMetric
 from apps.challenge.models import Challenge
 from apps.computing.models import ComputingPipeline
-from apps.core import identifier
+from apps.core import identifier, db_utils
 from apps.core.models import Base, IdentifieableMixin, CreatedByMixin, OriginMixin
 from apps.event.models import Event
 from apps.federation.inbox.models import InboxMessage
 from apps.federation.messages import Message, RetractShareMessageContent
 from apps.node.models import Node
-from apps.project.models import Project
+from apps.project.models import Project, FilePermission
 from apps.project.project_case.models import Case
 from apps.project.project_ground_truth.models import GroundTruthSchema
+from apps.share.delta import DELTA_KEY, REMOVED_SUFFIX, DeltaException
+from apps.share.importer import ImportGraph
+from apps.share.metrics import Metrics
+from apps.share.package import PackageReader, get_package_path, PACKAGE_REFERENCE_KEY, build_reference, \
+    fetch_package, CsvSection
 from apps.storage.extra_data.models import ExtraData
 from apps.storage.models import File
 from apps.terminology.models import Code, CodeSystem
 from apps.user.user_profile.models import Profile
 from apps.utils import get_user_node, get_node_origin
 
+# csv section -> many-to-many field of Share, model and field the removed rows are looked up by.
+# the links of these sections are carried over from the previous share when a delta is imported.
+DELTA_LINKS = {
+    'files': ('files', File, 'identifier'),
+    'cases': ('cases', Case, 'identifier'),
+    'codesystems': ('codesystem', CodeSystem, 'uri'),
+    # removed codes only remove the code from a file, the code itself stays part of the share
+    'codes': ('codes', Code, None),
+    'extra-data': ('extra_data', ExtraData, 'identifier'),
+}
+# csv sections of a fetched package that are read in chunks by their import function instead of being loaded at once
+STREAMED_SECTIONS = ['cases', 'files', 'codes', 'extra-data']
+
 
 class ShareableMixin:
 
@@ -37,6 +58,10 @@ class Share(CreatedByMixin, OriginMixin, IdentifieableMixin, Base):
     #     ]
 
     content = models.JSONField(default=dict)
+    # manifest of the package file this share was built into. empty for shares that store the content inline.
+    package = models.JSONField(default=dict, blank=True)
+    # duration, rows, bytes and queries of every step of building or importing this share
+    metrics = models.JSONField(default=dict, blank=True)
     files = models.ManyToManyField("storage.File", related_name="shares")
     challenges = models.ManyToManyField("challenge.Challenge", related_name="shares")
     codes = models.ManyToManyField('terminology.Code', related_name='shares')
@@ -70,6 +95,36 @@ class Share(CreatedByMixin, OriginMixin, IdentifieableMixin, Base):
     def __str__(self):
         return f'{self.name} ({self.identifier})'
 
+    @property
+    def has_package(self):
+        return len(self.package.get('sections', {})) > 0
+
+    def open_package(self) -> PackageReader:
+        return PackageReader(get_package_path(self.package['path']), self.package)
+
+    def open_snapshot(self) -> PackageReader:
+        '''
+        Returns the full package of this share. A delta share only sends the changes but keeps the full package
+        as snapshot.
+        '''
+        manifest = self.package.get('snapshot', self.package)
+        return PackageReader(get_package_path(manifest['path']), manifest)
+
+    def get_reference(self):
+        '''
+        Returns the content that references the package of this share by its hash instead of embedding it.
+        '''
+        return {'identifier': str(self.identifier), **self.package.get('metadata', {}),
+                PACKAGE_REFERENCE_KEY: build_reference(self.package)}
+
+    def get_content(self):
+        '''
+        Returns the content of this share as dict. Reads the package file if the share was built into a package.
+        '''
+        if self.has_package:
+            return self.open_package().to_dict()
+        return self.content
+
     @staticmethod
     def import_share(**kwargs):
         # TODO maybe create an informational inboxmessageinfo class and object that states what is contained in that message (challenge, cases, projects, files)
@@ -83,7 +138,19 @@ class Share(CreatedByMixin, OriginMixin, IdentifieableMixin, Base):
         else:
             created_by = get_user_node()
 
+        metrics = Metrics()
         content = message.object.content
+        package = {}
+        reference = content.get(PACKAGE_REFERENCE_KEY)
+        if reference is not None:
+            # the package was sent by reference. it is fetched once and shared by all shares with the same hash.
+            with metrics.measure('fetch') as step:
+                reader = fetch_package(reference)
+                package = reader.manifest
+                # the metadata of the share, e.g. its identifier, is sent with the reference
+                content = {**{k: v for k, v in content.items() if k != PACKAGE_REFERENCE_KEY},
+                           **reader.to_dict(streamed=STREAMED_SECTIONS)}
+                step['bytes'] = reference['size']
         origin = Profile.objects.get_by_identifier(message.object.sender)
         logging.info('[start] importing share from %s', origin.identifier)
         # parse files first
@@ -95,60 +162,104 @@ class Share(CreatedByMixin, OriginMixin, IdentifieableMixin, Base):
         share_type = content.get('type')
         ident = identifier.from_string(content.get('identifier'))
 
-        share = Share.objects.create(origin=origin,
-                                     name=content.get('name', ''),
-                                     description=content.get('description', ''),
-                                     identifier=ident,
-                                     content=content,
-                                     project=project,
-                                     created_by=created_by)
+        delta = content.get(DELTA_KEY)
+        if delta is not None and not Share.objects.filter(identifier=delta['previous-identifier']).exists():
+            # the unchanged rows are only linked from the previous share, so the share would be incomplete
+            raise DeltaException(f'Previous share {delta["previous-identifier"]} of share {ident} not found.')
+
+        checkpoint = inbox_message.checkpoint if inbox_message is not None else {}
+        share = Share.objects.filter(pk=checkpoint['share']).first() if 'share' in checkpoint else None
+        if share is not None:
+            # a previous import of this message failed. it is resumed with the share created then.
+            logging.info('Resuming import of share %s', share.identifier)
+        else:
+            # sections that are streamed from a payload (see apps.federation.payload) are only imported, not stored
+            stored = {k: v for k, v in content.items() if not isinstance(v, CsvSection)} if reference is None else {}
+            share = Share.objects.create(origin=origin,
+                                         name=content.get('name', ''),
+                                         description=content.get('description', ''),
+                                         identifier=ident,
+                                         content=stored,
+                                         package=package,
+                                         project=project,
+                                         created_by=created_by)
+            if inbox_message is not None:
+                inbox_message.save_checkpoint(share=share.id_as_str)
         ground_truth_schema_identifier = content.get('ground_truth_schema')
         if ground_truth_schema_identifier is not None:
             share.ground_truth_schema = GroundTruthSchema.objects.get_by_identifier(ground_truth_schema_identifier)
 
-        with transaction.atomic():
-            logging.info('[start] import cases')
-            Case.import_case(cases=content.get('cases'),
-                             project=project,
-                             created_by=created_by,
-                             origin=origin,
-                             share=share)
-            logging.info('[end] import cases')
-            # file contains the case identifier, so import cases first.
-            logging.info('[start] import files')
-            File.import_file(files=content.get('files'),
-                             project=project,
-                             created_by=created_by,
-                             origin=origin,
-                             share=share,
-                             for_user=inbox_message.recipient)
-            logging.info('[end] import files')
-
-            logging.info('[start] import codesystems')
+        sections = package.get('sections')
+        # codesystems are few and the codes look them up by uri, so they are imported before the other sections
+        logging.info('[start] import codesystems')
+        with transaction.atomic(), metrics.measure_content('codesystems', content, ['codesystems'], sections):
             CodeSystem.import_codesystem(data=content.get('codesystems'), share=share)
-            logging.info('[end] import codesystems')
-
-            logging.info('[start] import codes')
-            Code.import_codes(codes=content.get('codes'),
-                              project=project,
-                              created_by=created_by,
-                              origin=origin,
-                              share=share)
-            logging.info('[end] import codes')
+        logging.info('[end] import codesystems')
+
+        # writes through the orm are not staged, so the profiles, code systems and the code set the sections refer to
+        # are created once before the sections are staged. the steps then only resolve them.
+        logging.info('[start] import profiles')
+        with transaction.atomic(), metrics.measure('profiles'):
+            Profile.objects.resolve_or_create({v for key in ['cases', 'files']
+                                               for v in db_utils.read_csv_values(content.get(key), 'origin')})
+            Code.prepare_import(codes=content.get('codes'), project=project, created_by=created_by, origin=origin)
+        logging.info('[end] import profiles')
+
+        # the large sections are staged as a DAG. file contains the case identifier, so import cases first.
+        graph = ImportGraph(metrics, content, sections,
+                            checkpoint=(lambda state: inbox_message.save_checkpoint(staging=state))
+                            if inbox_message is not None else None,
+                            state=checkpoint.get('staging'))
+        # the existing rows of a delta were changed since the previous share
+        graph.add('cases', partial(Case.import_case, cases=content.get('cases'),
+                                   update=delta is not None,
+                                   project=project,
+                                   created_by=created_by,
+                                   origin=origin,
+                                   share=share), keys=['cases'])
+        graph.add('files', partial(File.import_file, files=content.get('files'),
+                                   update=delta is not None,
+                                   project=project,
+                                   created_by=created_by,
+                                   origin=origin,
+                                   share=share,
+                                   for_user=inbox_message.recipient), depends_on=['cases'], keys=['files'])
+        graph.add('codes', partial(Code.import_codes, codes=content.get('codes'),
+                                   project=project,
+                                   created_by=created_by,
+                                   origin=origin,
+                                   share=share), depends_on=['files'], keys=['codes'])
+        graph.add('extra-data', partial(ExtraData.import_extra_data, share=share,
+                                        project=project,
+                                        for_user=inbox_message.recipient,
+                                        extra_data=content.get('extra-data')), depends_on=['files'],
+                  keys=['extra-data'])
+        graph.run()
+
+        with transaction.atomic():
+            graph.publish()
+            if inbox_message is not None:
+                # the staging tables are gone after publishing, so the checkpoint is cleared in the same transaction
+                inbox_message.save_checkpoint()
             logging.info('[start] import challenges')
-            Challenge.import_challenge(challenge=content.get('challenge'), share=share)
+            with metrics.measure('challenge'):
+                Challenge.import_challenge(challenge=content.get('challenge'), share=share)
             logging.info('[end] import challenges')
             logging.info('[start] import challenge datasets')
-            Dataset.import_datasets(share=share, datasets=content.get('datasets'),
-                                    datasets_files=content.get('datasets_files'),
-                                    datasets_cases=content.get('datasets_cases'))
+            with metrics.measure_content('datasets', content, ['datasets', 'datasets_files', 'datasets_cases'],
+                                         sections):
+                Dataset.import_datasets(share=share, datasets=content.get('datasets'),
+                                        datasets_files=content.get('datasets_files'),
+                                        datasets_cases=content.get('datasets_cases'))
             logging.info('[end] import challenge datasets')
             logging.info('[start] import challenge target metrics')
-            TargetMetric.import_metric(share=share, target_metrics=content.get('target_metrics'))
+            with metrics.measure_content('target_metrics', content, ['target_metrics'], sections):
+                TargetMetric.import_metric(share=share, target_metrics=content.get('target_metrics'))
             logging.info('[end] import challenge target metrics')
 
             logging.info('[start] import evaluation code')
-            EvaluationCode.import_evaluation_code(share=share, data=content.get('evaluation-code'))
+            with metrics.measure('evaluation-code'):
+                EvaluationCode.import_evaluation_code(share=share, data=content.get('evaluation-code'))
             logging.info('[end] import evaluation code')
 
             pipeline = content.get('challenge_pipeline')
@@ -171,16 +282,53 @@ class Share(CreatedByMixin, OriginMixin, IdentifieableMixin, Base):
                 # TODO import the full computing pipeline here bc the identifiers of the computing job definitions are needed for the data files
                 # computing pipeline is always a yaml
 
-        logging.info('[start] import extra data')
-        ExtraData.import_extra_data(share=share,
-                                    project=project,
-                                    for_user=inbox_message.recipient,
-                                    extra_data=content.get('extra-data'))
-        logging.info('[end] import extra data')
+        if delta is not None:
+            logging.info('[start] apply delta against %s', delta['previous-identifier'])
+            with metrics.measure('delta'):
+                share.apply_delta(delta, content, for_user=inbox_message.recipient)
+            logging.info('[end] apply delta against %s', delta['previous-identifier'])
+
+        share.metrics = {'import': metrics.as_dict()}
+        share.save(update_fields=['metrics'])
 
         Event.create(origin, Event.Verb.SHARE_RECEIVE, project, get_node_origin())
         logging.info('[end] importing share from %s', origin.identifier)
 
+    def apply_delta(self, delta, content, for_user=None):
+        '''
+        Links everything of the previous share that was not removed to this share. The added and changed rows
+        of the delta were already imported like a full share.
+        :param delta: the `delta` section of the share content
+        :raises DeltaException: if the previous share does not exist
+        '''
+        previous = Share.objects.filter(identifier=delta['previous-identifier']).exclude(pk=self.pk).first()
+        if previous is None:
+            raise DeltaException(f'Previous share {delta["previous-identifier"]} of share {self.identifier} '
+                                 f'not found.')
+
+        for key, (field, model, lookup) in DELTA_LINKS.items():
+            removed = set()
+            if lookup is not None and content.get(key + REMOVED_SUFFIX):
+                removed = {row[lookup] for row in csv.DictReader(io.StringIO(content.get(key + REMOVED_SUFFIX)))}
+            m2m = Share._meta.get_field(field)
+            through = m2m.remote_field.through._meta.db_table
+            column, reverse_column = m2m.m2m_column_name(), m2m.m2m_reverse_name()
+            with db_utils.temp_table_from_values(removed, 'text') as removed_tbl, connection.cursor() as cursor:
+                cursor.execute(f'''
+                    insert into {through} ({column}, {reverse_column})
+                    select %s, l.{reverse_column} from {through} l
+                    where l.{column} = %s and l.{reverse_column} not in (
+                        select m.id from {model._meta.db_table} m
+                        join {removed_tbl} r on r.id = m.{lookup or 'id'}::text
+                    )
+                    on conflict do nothing
+                ''', [self.id, previous.id])
+
+            if field == 'files' and len(removed) > 0 and self.project is not None and for_user is not None:
+                # removed files are no longer part of the project of the recipient
+                FilePermission.objects.filter(project=self.project, user=for_user,
+                                              file__in=File.objects.filter_by_identifiers(list(removed))).delete()
+
     @staticmethod
     def retract_share(**kwargs):
         logging.info('[start] retract share')
@@ -0,0 +1,344 @@
+import hashlib
+import io
+import json
+import logging
+import zlib
+from pathlib import Path
+
+import httpx
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+# wbits=31 creates and reads the gzip format (header + trailer) instead of a raw zlib stream
+GZIP_WBITS = 31
+CHUNK_SIZE = 1024 * 1024
+# key of the share content that references a package instead of embedding it
+PACKAGE_REFERENCE_KEY = 'package-reference'
+
+
+class PackageException(Exception):
+    pass
+
+
+class _SectionSink:
+    '''
+    File-like object that compresses everything written to it into the underlying package file.
+    '''
+
+    def __init__(self, writer: 'PackageWriter'):
+        self.writer = writer
+        self.compressor = zlib.compressobj(wbits=GZIP_WBITS)
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.sha256.update(data)
+        self.size += len(data)
+        self.writer._write(self.compressor.compress(data))
+        return len(data)
+
+    def close(self):
+        self.writer._write(self.compressor.flush())
+
+
+class PackageWriter:
+    '''
+    A share package is a single file that consists of one gzip member per section (files, cases, codes, ...).
+    Sections are written one after another, so handlers can stream their `COPY ... TO STDOUT` output directly into the
+    package without holding it in memory. The manifest records offset, compressed length, uncompressed size and sha256
+    of every section so a single section can be read without decompressing the whole package.
+    `metadata` (e.g. the identifier of the share) is only kept in the manifest and not written into the file, so the
+    packages of shares with the same content have the same hash, see store_content_addressed.
+    '''
+    FORMAT_CSV = 'csv'
+    FORMAT_JSON = 'json'
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.sections = {}
+        self.metadata = {}
+        self._fh = None
+        self._sha256 = hashlib.sha256()
+        self._size = 0
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        if exc_type is not None:
+            self.path.unlink(missing_ok=True)
+
+    def open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._fh = self.path.open('wb')
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def _write(self, data: bytes):
+        if len(data) == 0:
+            return
+        self._sha256.update(data)
+        self._size += len(data)
+        self._fh.write(data)
+
+    def section(self, key: str, format: str = FORMAT_CSV) -> '_Section':
+        '''
+        Returns a context manager that yields a writable file-like object for the section `key`.
+        Can be passed directly to `cursor.copy_expert`. Writing a section twice replaces the previous one.
+        '''
+        return _Section(self, key, format)
+
+    def __setitem__(self, key, value):
+        self.write_json(key, value)
+
+    def __contains__(self, key):
+        return key in self.sections
+
+    def write_json(self, key: str, value):
+        with self.section(key, PackageWriter.FORMAT_JSON) as sink:
+            sink.write(json.dumps(value, cls=DjangoJSONEncoder))
+
+    def append(self, path: Path, manifest):
+        '''
+        Copies all sections of the package at `path` into this package without recompressing them.
+        Used to merge packages that were written concurrently into separate part files.
+        '''
+        with Path(path).open('rb') as fh:
+            for key, section in manifest.get('sections', {}).items():
+                offset = self._size
+                fh.seek(section['offset'])
+                remaining = section['length']
+                while remaining > 0:
+                    chunk = fh.read(min(CHUNK_SIZE, remaining))
+                    if len(chunk) == 0:
+                        raise PackageException(f'Unexpected end of package file {path}.')
+                    remaining -= len(chunk)
+                    self._write(chunk)
+                self.sections[key] = {**section, 'offset': offset}
+
+    @property
+    def manifest(self):
+        return {
+            'path': self.path.name,
+            'size': self._size,
+            'sha256': self._sha256.hexdigest(),
+            'sections': self.sections,
+            'metadata': self.metadata,
+        }
+
+
+class _Section:
+
+    def __init__(self, writer: PackageWriter, key: str, format: str):
+        self.writer = writer
+        self.key = key
+        self.format = format
+        self.offset = None
+        self.sink = None
+
+    def __enter__(self) -> _SectionSink:
+        self.offset = self.writer._size
+        self.sink = _SectionSink(self.writer)
+        return self.sink
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.sink.close()
+        if exc_type is not None:
+            return
+        self.writer.sections[self.key] = {
+            'format': self.format,
+            'offset': self.offset,
+            'length': self.writer._size - self.offset,
+            'size': self.sink.size,
+            'sha256': self.sink.sha256.hexdigest(),
+        }
+
+
+class _SectionSource(io.RawIOBase):
+    '''
+    Reads and decompresses exactly one section of a package file.
+    '''
+
+    def __init__(self, fh, offset: int, length: int):
+        self.fh = fh
+        self.fh.seek(offset)
+        self.remaining = length
+        self.decompressor = zlib.decompressobj(wbits=GZIP_WBITS)
+        self.buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self.buffer) == 0:
+            if self.remaining == 0:
+                self.buffer = self.decompressor.flush()
+                if len(self.buffer) == 0:
+                    return 0
+                break
+            chunk = self.fh.read(min(CHUNK_SIZE, self.remaining))
+            if len(chunk) == 0:
+                raise PackageException('Unexpected end of package file.')
+            self.remaining -= len(chunk)
+            self.buffer = self.decompressor.decompress(chunk)
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def close(self):
+        self.fh.close()
+        super().close()
+
+
+class CsvSection:
+    '''
+    A csv section of a package that is not read yet. Passed to the import functions instead of the content of the
+    section, which read it in chunks with `db_utils.read_csv_chunks`.
+    '''
+
+    def __init__(self, reader: 'PackageReader', key: str):
+        self.reader = reader
+        self.key = key
+
+    def __len__(self):
+        return self.reader.sections[self.key]['size']
+
+    def open(self) -> io.TextIOWrapper:
+        return self.reader.open_text(self.key)
+
+
+class PackageReader:
+
+    def __init__(self, path: Path, manifest):
+        self.path = Path(path)
+        self.manifest = manifest
+
+    @property
+    def sections(self):
+        return self.manifest.get('sections', {})
+
+    def __contains__(self, key):
+        return key in self.sections
+
+    def keys(self):
+        return self.sections.keys()
+
+    def open(self, key: str) -> io.BufferedReader:
+        '''
+        Opens a binary stream of the uncompressed section `key`.
+        '''
+        section = self.sections.get(key)
+        if section is None:
+            raise KeyError(key)
+        return io.BufferedReader(_SectionSource(self.path.open('rb'), section['offset'], section['length']),
+                                 buffer_size=CHUNK_SIZE)
+
+    def open_text(self, key: str) -> io.TextIOWrapper:
+        return io.TextIOWrapper(self.open(key), encoding='utf-8', newline='')
+
+    def read(self, key: str, verify: bool = True):
+        section = self.sections[key]
+        with self.open(key) as stream:
+            data = stream.read()
+        if verify and hashlib.sha256(data).hexdigest() != section['sha256']:
+            raise PackageException(f'Checksum mismatch for section {key} in {self.path}.')
+        data = data.decode('utf-8')
+        if section['format'] == PackageWriter.FORMAT_JSON:
+            return json.loads(data)
+        return data
+
+    def get(self, key: str, default=None):
+        if key not in self:
+            return default
+        return self.read(key)
+
+    def to_dict(self, streamed=()):
+        '''
+        Materializes the whole package and its metadata as the dict that used to be stored in `Share.content`.
+        :param streamed: keys of csv sections that are returned as CsvSection instead of being read into memory
+        '''
+        return {**self.manifest.get('metadata', {}),
+                **{key: CsvSection(self, key) if key in streamed else self.read(key) for key in self.keys()}}
+
+
+def get_package_path(name: str) -> Path:
+    return settings.SHARE_PACKAGE_DIR / name
+
+
+def store_content_addressed(manifest):
+    '''
+    Renames the package file to the sha256 of its content. Identical packages, e.g. of shares with the same content,
+    are stored once and can be referenced and fetched by their hash.
+    :return: the manifest with the new path
+    '''
+    name = f'{manifest["sha256"]}.pkg'
+    if manifest['path'] != name:
+        get_package_path(manifest['path']).replace(get_package_path(name))
+    return {**manifest, 'path': name}
+
+
+def build_reference(manifest):
+    '''
+    Returns the small reference that is sent to recipients instead of the package itself.
+    '''
+    return {
+        'sha256': manifest['sha256'],
+        'size': manifest['size'],
+        'sections': manifest['sections'],
+        'url': f'{settings.CDN_ADDRESS}?package={manifest["sha256"]}',
+    }
+
+
+def fetch_package(reference) -> PackageReader:
+    '''
+    Downloads the package of `reference` into the package directory unless a package with the same hash is already
+    stored there.
+    '''
+    name = f'{reference["sha256"]}.pkg'
+    manifest = {'path': name, 'size': reference['size'], 'sha256': reference['sha256'],
+                'sections': reference['sections']}
+    path = get_package_path(name)
+    if path.exists():
+        if get_file_sha256(path) == reference['sha256']:
+            logging.info('Package %s is already stored. Skipping download.', reference['sha256'])
+            return PackageReader(path, manifest)
+        logging.warning('Stored package %s is corrupt. Downloading it again.', reference['sha256'])
+
+    logging.info('[start] downloading package %s from %s', reference['sha256'], reference['url'])
+    headers = {}
+    if settings.DOWNLOADER_DEBUG:
+        headers.update(settings.MY_DEV_CREDENTIALS)
+    tmp_path = path.with_name(name + '.download')
+    sha256 = hashlib.sha256()
+    try:
+        with httpx.Client(verify=settings.VERIFY_TLS,
+                          cert=(settings.DSF_CERTIFICATE, settings.DSF_CERTIFICATE_PRIVATE_KEY)) as client, \
+                client.stream('GET', reference['url'], headers=headers, timeout=30) as response, \
+                tmp_path.open('wb') as f:
+            response.raise_for_status()
+            for chunk in response.iter_bytes(CHUNK_SIZE):
+                sha256.update(chunk)
+                f.write(chunk)
+        if sha256.hexdigest() != reference['sha256']:
+            raise PackageException(f'Checksum mismatch for downloaded package {reference["sha256"]}.')
+        tmp_path.replace(path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    logging.info('[end] downloading package %s', reference['sha256'])
+    return PackageReader(path, manifest)
+
+
+def get_file_sha256(path: Path) -> str:
+    sha256 = hashlib.sha256()
+    with path.open('rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            sha256.update(chunk)
+    return sha256.hexdigest()
@@ -0,0 +1,131 @@
+import json
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction, OperationalError
+from psycopg2.errors import QueryCanceled
+
+from apps.share.models import Share
+from apps.share.package import PackageWriter
+
+EXPORT_SUFFIX = '-export'
+
+
+class PlanTimeout(Exception):
+    pass
+
+
+class PackagePlan:
+    '''
+    Is passed to the handlers instead of a PackageWriter to plan a share. The handlers run their usual export queries,
+    but csv sections are only estimated from the query plan (EXPLAIN) of the export and nothing is written.
+    '''
+
+    def __init__(self):
+        self.sections = {}
+        self.metadata = {}
+
+    def __setitem__(self, key, value):
+        self.sections[key] = {
+            'format': PackageWriter.FORMAT_JSON,
+            'rows': 0,
+            'size': len(json.dumps(value, cls=DjangoJSONEncoder)),
+        }
+
+    def __contains__(self, key):
+        return key in self.sections
+
+    def estimate(self, key, sql):
+        '''
+        Estimates rows and uncompressed size of the csv section `key` without running `sql`.
+        '''
+        with connection.cursor() as cursor:
+            cursor.execute(f'explain (format json) {sql}')
+            plan = cursor.fetchone()[0][0]['Plan']
+        rows = int(plan['Plan Rows'])
+        # plan width is the average width of a row in bytes. +1 for the line break of each csv row.
+        self.sections[key] = {
+            'format': PackageWriter.FORMAT_CSV,
+            'rows': rows,
+            'size': rows * (plan['Plan Width'] + 1),
+        }
+
+
+@contextmanager
+def statement_timeout(milliseconds: int = None):
+    '''
+    Cancels every query in the block that runs longer than `milliseconds`, so a share can be planned within a web
+    request. The block runs in a transaction and the previous timeout is restored afterwards.
+    :param milliseconds: defaults to settings.SHARE_PLAN_STATEMENT_TIMEOUT
+    :raises PlanTimeout: if a query was cancelled
+    '''
+    if milliseconds is None:
+        milliseconds = settings.SHARE_PLAN_STATEMENT_TIMEOUT
+    try:
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute('show statement_timeout')
+                previous = cursor.fetchone()[0]
+                cursor.execute('set local statement_timeout = %s', [milliseconds])
+            yield
+            # set local lasts until the end of the outer transaction, e.g. of the request
+            with connection.cursor() as cursor:
+                cursor.execute('set local statement_timeout = %s', [previous])
+    except OperationalError as e:
+        if isinstance(e.__cause__, QueryCanceled):
+            raise PlanTimeout(f'Planning the share took longer than {milliseconds} ms.') from e
+        raise
+
+
+def seconds_per_row(history: int = None):
+    '''
+    Returns the build duration per exported row of every handler, measured over the last `history` built shares.
+    '''
+    if history is None:
+        history = settings.SHARE_PLAN_HISTORY
+    durations, rows = defaultdict(float), defaultdict(int)
+    qs = Share.objects.filter(metrics__has_key='build').order_by('-date_created')
+    for metrics in qs.values_list('metrics', flat=True)[:history]:
+        for name, step in metrics['build']['steps'].items():
+            # exports of concurrent builds are measured apart from `set` but belong to the same handler
+            name = name.removesuffix(EXPORT_SUFFIX)
+            durations[name] += step['duration']
+            rows[name] += step['rows']
+    return {name: durations[name] / rows[name] for name in durations if rows[name] > 0}
+
+
+def estimate_duration(handlers):
+    '''
+    Estimates the build duration in seconds from the estimated rows of every handler and past metrics.
+    :param handlers: dict handler name -> {'rows': ..., 'bytes': ...}
+    :return: the duration or None if none of the handlers was measured before
+    '''
+    rates = seconds_per_row()
+    measured = [name for name in handlers if name in rates]
+    if len(measured) == 0:
+        return None
+    return round(sum(handlers[name]['rows'] * rates[name] for name in measured), 1)
+
+
+def check_plan(plan):
+    '''
+    Compares a share plan against the configured limits.
+    :return: tuple (errors, warnings). the share should not be created if there are errors.
+    '''
+    errors, warnings = [], []
+    rows = plan['rows'] + plan.get('permissions', 0)
+    duration = plan.get('duration')
+    if rows > settings.SHARE_PLAN_MAX_ROWS:
+        errors.append(f'The share would contain about {rows:,} rows. At most {settings.SHARE_PLAN_MAX_ROWS:,} rows '
+                      f'can be shared at once.')
+    elif rows > settings.SHARE_PLAN_WARN_ROWS:
+        warnings.append(f'The share contains about {rows:,} rows and may take a while to be created.')
+    if duration is not None:
+        if duration > settings.SHARE_PLAN_MAX_DURATION:
+            errors.append(f'Creating the share would take about {duration / 3600:.1f} hours, which is longer than '
+                          f'the allowed {settings.SHARE_PLAN_MAX_DURATION / 3600:.1f} hours.')
+        elif duration > settings.SHARE_PLAN_WARN_DURATION:
+            warnings.append(f'Creating the share will take about {duration / 3600:.1f} hours.')
+    return errors, warnings
@@ -10,3 +10,11 @@ class ShareSerializer(serializers.ModelSerializer):
     class Meta:
         model = Share
         fields = ('content', 'origin', 'name', 'identifier', 'description')
+
+
+class ShareMetricsSerializer(serializers.ModelSerializer):
+    identifier = serializers.StringRelatedField(read_only=True)
+
+    class Meta:
+        model = Share
+        fields = ('identifier', 'name', 'metrics')
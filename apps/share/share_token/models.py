@@ -1,5 +1,6 @@
 from datetime import datetime
 
+from django.conf import settings
 from django.db import models
 from django.utils import timezone
 
@@ -79,8 +80,17 @@ class ShareToken(IdentifieableMixin, Base):
         def __init__(self, *args):
             super().__init__(*args)
 
-    def send_to_node(self):
-        data = self.share.content
+    def send_to_node(self, by_reference: bool | None = None):
+        '''
+        :param by_reference: only send the hash and fetch url of the share package. the recipient downloads the
+        package. defaults to settings.SHARE_SEND_BY_REFERENCE.
+        '''
+        if by_reference is None:
+            by_reference = settings.SHARE_SEND_BY_REFERENCE
+        if by_reference and self.share.has_package:
+            data = self.share.get_reference()
+        else:
+            data = self.share.get_content()
         message_object = ShareObject(content=data)
         om = OutboxMessage.create(recipient=self.recipient,
                                   sender=self.created_by,
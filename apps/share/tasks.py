@@ -74,8 +74,17 @@ def create_share(
     ground_truth_pk=None,
     file_pks=None,
     extra_data_applications=None,
-    initial_file_list_id=None
+    initial_file_list_id=None,
+    previous_share_pk=None,
+    dry_run=False,
+    send=True
 ):
+    '''
+    :param dry_run: only plan the share. nothing is created and the estimate of ShareBuilder.plan is returned together
+    with the estimated number of permissions that would be created.
+    :param send: send the share to the recipients. if False, the share tokens are created but nothing is sent.
+    :raises PlanTimeout: if planning the share exceeds settings.SHARE_PLAN_STATEMENT_TIMEOUT
+    '''
     # TODO percentage is ignored for now.
     created_by = Profile.objects.get(pk=created_by_pk)
     if project_pk is None:
@@ -95,7 +104,6 @@ def create_share(
 
     model_is_file = model.lower() == 'file'
     file_qs = None
-    codes = []
     codesystem_ids = []
     case_ids = []
     file_identifiers = []
@@ -115,7 +123,6 @@ def create_share(
         # file_qs = File.objects.filter(projects__id=project.pk, id__in=qs.values_list('files__id', flat=True))
         # file_terms = {t for t in file_qs.values_list('codes', 'id') if t is not None}
         # term_ids = term_ids.union(file_terms)
-        codes = file_qs.values_list('codes', 'id', named=True)
         codesystem_ids = file_qs.values_list('codes__codesystem_id', flat=True).distinct()
     # else:
     #     file_qs = translate_file_query(model, query)
@@ -129,27 +136,24 @@ def create_share(
 
     if file_pks is not None and len(file_pks) > 0:
         file_qs = project.files_for_user(created_by).filter(id__in=file_pks)
-        codes = file_qs.values_list('id', 'codes', named=True)
         codesystem_ids = file_qs.values_list('codes__codesystem_id', flat=True).distinct()
         file_identifiers = file_qs.values_list('identifier', flat=True)
         case_ids = file_qs.values_list('case_id', flat=True).distinct()
 
     # delete the terms that are selected
     # the file that have this term will still be included in this share
-    terms_selected = [c for c in codes if str(c.codes) in term_pks]
+    # the (file, code) pairs of the selected terms. the codes are filtered before they are selected, so both use the
+    # same join and the pairs are selected by the database, see CodesHandler.pairs
+    if file_qs is not None and term_pks:
+        terms_selected = file_qs.filter(codes__in=term_pks).values_list('id', 'codes', named=True)
+    else:
+        terms_selected = []
 
     codesystem_qs = CodeSystem.objects.filter(id__in=codesystem_ids)
     case_qs = Case.objects.filter(id__in=case_ids)
 
     extra_data = project.extra_data_for_user(created_by).filter(application_identifier__in=extra_data_applications, file_id__in=initial_file_list_id)
 
-    for n in recipients:
-        for action in allowed_actions:
-            Permission.create_permissions(identifiers=file_identifiers,
-                                          permission=Permission.Permission.ALLOW,
-                                          action=action,
-                                          user_id=n.user.id_as_str,
-                                          created_by_id=created_by_pk)
     builder = ShareBuilder(share_pk, share_name, created_by=created_by, origin=created_by, project=project,
                            file_query=query)
     builder.add_type_handler(data='data-release')
@@ -159,11 +163,29 @@ def create_share(
     builder.add_codesystem_handler(data=codesystem_qs)
     builder.add_codes_handler(data=terms_selected, handler_init_kwargs={
         '__name__': CodesHandler.name_files if model_is_file else CodesHandler.name_cases})
-    builder.add_permission_handler(data=','.join(list(map(lambda e: f'\'{e}\'', file_identifiers))))
+    builder.add_permission_handler(data=file_identifiers)
     builder.add_extra_data_handler(data=extra_data)
 
     if ground_truth_pk is not None:
         builder.set_ground_truth(GroundTruth.objects.get(pk=ground_truth_pk))
+    if previous_share_pk is not None:
+        # only send what changed since the previous release to the same recipients
+        builder.set_previous_share(Share.objects.get(pk=previous_share_pk), recipients=[n.user for n in recipients])
+
+    if dry_run:
+        plan = builder.plan()
+        # every shared file gets a permission per recipient and action. the files section holds a row per file.
+        n_files = plan['sections'].get('files', {}).get('rows', 0)
+        plan['permissions'] = n_files * recipients.count() * len(allowed_actions)
+        return plan
+
+    for n in recipients:
+        for action in allowed_actions:
+            Permission.create_permissions(identifiers=file_identifiers,
+                                          permission=Permission.Permission.ALLOW,
+                                          action=action,
+                                          user_id=n.user.id_as_str,
+                                          created_by_id=created_by_pk)
     # FIXME TypeError: Cannot create distinct fields once a slice has been taken.
     share = builder.build(project_identifier)
 
@@ -179,15 +201,16 @@ def create_share(
 
     logging.info('Done creating share.')
 
-    send_share_to_sharetokens(share_pk)
+    if send:
+        send_share_to_sharetokens(share_pk)
 
 
 @celery_app.task
-def send_share_to_sharetokens(share_pk):
+def send_share_to_sharetokens(share_pk, by_reference=None):
     logging.info('[start] send share to sharetoken.')
     tokens = ShareToken.objects.filter(share_id=share_pk)
     for t in tokens:
-        t.send_to_node()
+        t.send_to_node(by_reference=by_reference)
     logging.info('[end] send share to sharetoken.')
 
 
@@ -0,0 +1,7 @@
+from django.urls import path
+
+from apps.share import views
+
+urlpatterns = [
+    path('<uuid:pk>/metrics/', views.ShareMetricsView.as_view(), name='api-share-metrics'),
+]
@@ -8,8 +8,11 @@ from django.contrib.auth.mixins import LoginRequiredMixin
 from django.shortcuts import get_object_or_404, redirect
 from django.utils import timezone
 from django.views.generic import FormView
+from rest_framework.generics import RetrieveAPIView
 
 from apps.share import forms, tasks
+from apps.share.models import Share
+from apps.share.serializers import ShareMetricsSerializer
 from apps.study_management.tile_management.models import TileSet
 
 
@@ -93,3 +96,13 @@ class CreateShareDialogView(LoginRequiredMixin, FormView):
             int(data.get('percentage'))
         )
         return redirect(self.request.META['HTTP_REFERER'])
+
+
+class ShareMetricsView(RetrieveAPIView):
+    '''
+    Returns duration, rows, bytes and db queries of every step of building or importing a share.
+    '''
+    serializer_class = ShareMetricsSerializer
+
+    def get_queryset(self):
+        return Share.objects.filter(created_by=self.request.user.profile)
@@ -1,10 +1,8 @@
 import csv
 import logging
 import uuid
-from io import StringIO
 
 from django.conf import settings
-from django.db import connection
 from django.utils import timezone
 import logging
 from rest_framework import status, serializers, mixins, viewsets
@@ -15,6 +13,7 @@ from rest_framework.views import APIView
 
 from apps.computing.computing_executions.models import ComputingJobExecution
 from apps.core import identifier
+from apps.core.db_utils import BulkWriter
 from apps.core.serializers import IdentifierField
 from apps.storage.models import File
 from apps.utils import get_node_origin, get_user_node
@@ -58,12 +57,12 @@ class CreateFileAPI(APIView):
         flush_interval = 50_000  # 50_000
         R = []
 
-        with StringIO() as memory_file:
-            writer = csv.writer(memory_file)
-            csv_header = ['id', 'name', 'content_type', 'case_id', 'created_by_id', 'identifier', 'origin_id',
-                          'originating_from_id', 'original_filename', 'original_path', 'size', 'date_created',
-                          'last_modified', 'imported']
-            writer.writerow(csv_header)
+        csv_header = ['id', 'name', 'content_type', 'case_id', 'created_by_id', 'identifier', 'origin_id',
+                      'originating_from_id', 'original_filename', 'original_path', 'size', 'date_created',
+                      'last_modified', 'imported']
+        # the files are new, so they are copied straight into the file table in batches of flush_interval
+        with BulkWriter(File.objects.model._meta.db_table, csv_header, mode='copy',
+                        batch_size=flush_interval) as writer:
             total = len(data)
             created_by = request.user.profile
             created_by_id = created_by.id_as_str
@@ -97,27 +96,22 @@ class CreateFileAPI(APIView):
                 # if not qs_file_exists.exists():
                 id = identifier.create_random('file')
                 pk = uuid.uuid4()
-                writer.writerow(
-                    [pk, name, content_type, 'null' if src_file is None else str(src_file.case_id), created_by_id, id,
+                writer.write(
+                    [pk, name, content_type, None if src_file is None else str(src_file.case_id), created_by_id, id,
                      origin.id_as_str,
-                     'null' if src_file is None else src_file.id_as_str, name, original_path, size, now, now, False])
+                     None if src_file is None else src_file.id_as_str, name, original_path, size, now, now, False])
                 # else:
                 #     pk = qs_file_exists.first().pk
                 R.append(str(pk))
 
             logging.info('Adding %s files.', len(R))
-            memory_file.seek(0)
-            with connection.cursor() as cursor:
-                cursor.copy_expert(f'copy storage_file({",".join(csv_header)}) from stdin csv header NULL as \'null\'',
-                                   memory_file)
-            memory_file.close()
-            logging.info('Adding done.')
-
-            # TODO stream the response as a list of file ids
-            if not return_identifiers:
-                tmpfile = settings.TMP_DIR / f'{uuid.uuid4()}'
-                with tmpfile.open('w') as f:
-                    f.write("\n".join(R))
-            R = R if return_identifiers else str(tmpfile.relative_to(settings.TMP_DIR))
-            return Response(status=status.HTTP_201_CREATED, data=R)
+        logging.info('Adding done.')
+
+        # TODO stream the response as a list of file ids
+        if not return_identifiers:
+            tmpfile = settings.TMP_DIR / f'{uuid.uuid4()}'
+            with tmpfile.open('w') as f:
+                f.write("\n".join(R))
+        R = R if return_identifiers else str(tmpfile.relative_to(settings.TMP_DIR))
+        return Response(status=status.HTTP_201_CREATED, data=R)
 
@@ -1,7 +1,5 @@
-import io
 import uuid
 
-import pandas
 from django.db import models
 from django.utils import timezone
 
@@ -44,95 +42,52 @@ class ExtraData(CreatedByMixin, OriginMixin, IdentifieableMixin, BaseResource):
         if data is None:
             return
 
-        df = pandas.read_csv(io.StringIO(data))
-        now = timezone.now().isoformat()
-        df = df.rename(columns={'origin': 'origin_id',
-                                'file': 'file_id',
-                                'created_by': 'created_by_id'})
-        df['created_by_id'] = for_user.id_as_str
-        # replace origins
-        origin_cache = {}
-
-        def fn(e):
-            if e not in origin_cache:
-                origin_cache[e] = Profile.objects.get_by_identifier(e).id_as_str
-            return origin_cache[e]
-
-        df['origin_id'] = df['origin_id'].apply(fn)
-
-        # replace file ids
-        file_cache = {}
-
-        def fn(e):
-            if e not in file_cache:
-                file_cache[e] = File.objects.get_by_identifier(e).id_as_str
-            return file_cache[e]
-
-        df['file_id'] = df['file_id'].apply(fn)
-
-        # replace created_by ids
-        created_by_cache = {}
-
-        def fn(e):
-            if e not in created_by_cache:
-                try:
-                    profile = Profile.objects.get_by_identifier(e)
-                except Profile.DoesNotExist:
-                    profile = Profile.objects.create_and_return(e)
-                created_by_cache[e] = profile.id_as_str
-            return created_by_cache[e]
-
-        df['created_by_id'] = df['created_by_id'].apply(fn)
-        # filter out existing rows
-        identifiers = df['identifier'].to_list()
-        qs = ExtraData.objects.filter_by_identifiers(identifiers).distinct()
-        existing_files = {e[0]: e[1] for e in qs.values_list('identifier', 'id')}
-        existing_rows = df['identifier'].isin(existing_files.keys())
-
-        df['existing'] = existing_rows
-        def fn_set_id(e):
-            if not e['existing']: return str(uuid.uuid4())
-            return existing_files[e['identifier']]
-
-        df['id'] = df.apply(fn_set_id, axis=1)
-
-        df['date_created'] = now
-        df['last_modified'] = now
-        df_org = df
-        df = df_org[~existing_rows]
-        df_existing = df_org[existing_rows]
-        df = df.drop(columns=['existing'])
-        df_existing = df_existing.drop(columns=['existing'])
-
-        dest_tbl_name = ExtraData.objects.model._meta.db_table
-        db_utils.insert_with_copy_from_and_tmp_table(df, dest_tbl_name)
-        db_utils.update_from_tmp_table(df_existing, dest_tbl_name,
-                                       f"data = x.data, description = x.description",
-                                       f"{dest_tbl_name}.identifier = x.identifier")
-
-        # add to share
-        if 'share' in kwargs:
-            df_id = df[['id']]
-            df_id['share_id'] = kwargs.get('share').id_as_str
-            df_id = df_id.rename(columns={'id': 'extradata_id'})
-            from apps.share.models import Share
-            db_utils.insert_with_copy_from_and_tmp_table(df_id,
-                                                         Share.extra_data.through.objects.model._meta.db_table,
-                                                         insert_columns='extradata_id, share_id')
-        if project is not None and for_user is not None:
-            # file,identifier,data,application_identifier,description,created_by,origin
-            df_proj = df[['id']]
-            df_proj = df_proj.rename(columns={'id': 'extra_data_id'})
-            def fn_set_id(e):
-                return str(uuid.uuid4())
-
-            df_proj['id'] = df_proj.apply(fn_set_id, axis=1)
-            df_proj['project_id'] = project.id_as_str
-            df_proj['imported'] = True
-            df_proj['user_id'] = for_user.id_as_str
+        for df in db_utils.read_csv_chunks(data, name='extra data'):
             now = timezone.now().isoformat()
-            df_proj['date_created'] = now
-            df_proj['last_modified'] = now
-            db_utils.insert_with_copy_from_and_tmp_table(df_proj,
-                                                         ProjectExtraData.objects.model._meta.db_table,
-                                                         insert_columns='date_created, last_modified, id, imported, extra_data_id, project_id, user_id')
+            df = df.rename(columns={'origin': 'origin_id',
+                                    'file': 'file_id',
+                                    'created_by': 'created_by_id'})
+            df['created_by_id'] = for_user.id_as_str
+            # replace the identifiers of origins, files and creators with their ids
+            df['origin_id'] = df['origin_id'].map(Profile.objects.resolve_identifiers(df['origin_id'].unique()))
+            df['file_id'] = df['file_id'].map(File.objects.resolve_identifiers(df['file_id'].unique()))
+            df['created_by_id'] = df['created_by_id'].map(
+                Profile.objects.resolve_or_create(df['created_by_id'].unique()))
+            # existing rows keep their id and are updated by the merge
+            new_rows = db_utils.assign_ids(df, ExtraData.objects.all())
+            df['date_created'] = now
+            df['last_modified'] = now
+
+            with db_utils.BulkWriter(ExtraData.objects.model._meta.db_table, df.columns, mode='merge',
+                                     key=['identifier'],
+                                     update_columns=['data', 'description', 'last_modified']) as writer:
+                writer.write_df(df)
+            # only the new rows are added to the share and the project
+            df = df[new_rows]
+
+            # add to share
+            if 'share' in kwargs:
+                df_id = df[['id']]
+                df_id['share_id'] = kwargs.get('share').id_as_str
+                df_id = df_id.rename(columns={'id': 'extradata_id'})
+                from apps.share.models import Share
+                db_utils.insert_with_copy_from_and_tmp_table(df_id,
+                                                             Share.extra_data.through.objects.model._meta.db_table,
+                                                             insert_columns='extradata_id, share_id')
+            if project is not None and for_user is not None:
+                # file,identifier,data,application_identifier,description,created_by,origin
+                df_proj = df[['id']]
+                df_proj = df_proj.rename(columns={'id': 'extra_data_id'})
+                def fn_set_id(e):
+                    return str(uuid.uuid4())
+
+                df_proj['id'] = df_proj.apply(fn_set_id, axis=1)
+                df_proj['project_id'] = project.id_as_str
+                df_proj['imported'] = True
+                df_proj['user_id'] = for_user.id_as_str
+                now = timezone.now().isoformat()
+                df_proj['date_created'] = now
+                df_proj['last_modified'] = now
+                db_utils.insert_with_copy_from_and_tmp_table(df_proj,
+                                                             ProjectExtraData.objects.model._meta.db_table,
+                                                             insert_columns='date_created, last_modified, id, imported, extra_data_id, project_id, user_id')
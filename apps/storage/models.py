@@ -1,10 +1,7 @@
-import io
-import math
 import uuid
 from pathlib import Path
 from typing import Optional
 
-import pandas
 from django.conf import settings
 from django.db import models
 from django.utils import timezone
@@ -40,6 +37,10 @@ class File(CreatedByMixin, OriginMixin, IdentifieableMixin, BaseResource):
     path = models.CharField(max_length=1000, null=True, default=None, blank=True)
     size = models.BigIntegerField(default=-1)
 
+    # the columns of existing files that are updated by the import of a delta share
+    IMPORT_UPDATE_COLUMNS = ['name', 'content_type', 'size', 'original_filename', 'original_path', 'case_id',
+                             'origin_id', 'last_modified']
+
     @property
     def as_path(self) -> Path | None:
         if self.path is None:
@@ -71,92 +72,68 @@ class File(CreatedByMixin, OriginMixin, IdentifieableMixin, BaseResource):
 
         if files is None or len(files) == 0:
             return
-        df = pandas.read_csv(io.StringIO(files))
-        now = timezone.now().isoformat()
-        df = df.rename(columns={'origin': 'origin_id', 'case': 'case_id'})
-        df['imported'] = False
-        profile_cache = {}
-
-        def fn(e):
-            if e not in profile_cache:
-                try:
-                    profile = Profile.objects.get_by_identifier(e)
-                except Profile.DoesNotExist:
-                    # TODO use Profile.create_user here also at all other places of imports
-                    profile = Profile.objects.create_and_return(e)
-                profile_cache[e] = profile.id_as_str
-            return profile_cache.get(e)
-
-        df['origin_id'] = df['origin_id'].apply(fn)
-        if created_by is not None:
-            df['created_by_id'] = created_by.id_as_str
-
-
-        # filter out files that are already existing in database
-        identifiers = df['identifier'].to_list()
-        qs = File.objects.filter_by_identifiers(identifiers).distinct()
-        existing_files = {e[0]: e[1] for e in qs.values_list('identifier', 'id')}
-        existing_rows = df['identifier'].isin(existing_files.keys())
-        df['existing'] = existing_rows
-
-        def fn_set_id(e):
-            if not e['existing']: return str(uuid.uuid4())
-            return existing_files[e['identifier']]
-
-        df['id'] = df.apply(fn_set_id, axis=1)  # df.apply(lambda e: str(uuid.uuid4()), axis=1)
-
-        df_id = df[['id']]
-
-        # filter out existing files
-        df = df[~existing_rows]
-        df = df.drop(columns=['existing'])
-        if 'case_id' in df.columns:
-            case_cache = {}
-
-            def fn(e):
-                if not isinstance(e, str) and math.isnan(e):
-                    return None
-                if e not in case_cache:
-                    # case should exist here as it was already imported
-                    case_cache[e] = Case.objects.filter_by_identifier(e).first().id_as_str
-                return case_cache.get(e)
-
-            df['case_id'] = df['case_id'].apply(fn)
-        df['date_created'] = now
-        df['last_modified'] = now
-        db_utils.insert_with_copy_from_and_tmp_table(df, File.objects.model._meta.db_table)
-
-        if 'share' in kwargs:
-            # add to share
-            df_id['share_id'] = kwargs.get('share').id_as_str
-            df_id = df_id.rename(columns={'id': 'file_id'})
-            from apps.share.models import Share
-            db_utils.insert_with_copy_from_and_tmp_table(df_id, Share.files.through.objects.model._meta.db_table,
-                                                         insert_columns='file_id, share_id')
-
-        # add to project
-        for_user = kwargs.get('for_user')
-        project = kwargs.get('project')
-        if project is not None and for_user is not None:
-            df_id['project_id'] = project.id_as_str
-            df_id = df_id.drop(columns=['share_id'])
-            df_id = df_id.rename(columns={'id': 'file_id'})
-            df_id['user_id'] = for_user.id_as_str
+        # the files are imported in chunks so memory does not grow with the size of the share
+        for df in db_utils.read_csv_chunks(files, name='files'):
             now = timezone.now().isoformat()
-            df_id['date_created'] = now
-            df_id['last_modified'] = now
-            df_id['imported'] = False
-
-            def fn_set_id(e):
-                return str(uuid.uuid4())
-
-            df_id['id'] = df_id.apply(fn_set_id, axis=1)
-
-            # TODO set imported = True if the recipient has download permission and the file is imported on the client
-
-            from apps.project.models import Project
-            db_utils.insert_with_copy_from_and_tmp_table(df_id, Project.files.through.objects.model._meta.db_table,
-                                                         insert_columns='id, imported, file_id, project_id, user_id, date_created, last_modified')
+            df = df.rename(columns={'origin': 'origin_id', 'case': 'case_id'})
+            df['imported'] = False
+
+            df['origin_id'] = df['origin_id'].map(Profile.objects.resolve_or_create(df['origin_id'].unique()))
+            if created_by is not None:
+                df['created_by_id'] = created_by.id_as_str
+
+            # files that are already existing in database keep their id and are not inserted again
+            new_rows = db_utils.assign_ids(df, File.objects.all())
+
+            df_id = df[['id']]
+
+            if 'case_id' in df.columns:
+                # cases should exist here as they were already imported
+                df['case_id'] = df['case_id'].map(Case.objects.resolve_identifiers(df['case_id'].unique()))
+            df['date_created'] = now
+            df['last_modified'] = now
+            if kwargs.get('update') and not new_rows.all():
+                # the existing files of a delta share were changed since the previous share
+                columns = [c for c in File.IMPORT_UPDATE_COLUMNS if c in df.columns]
+                with db_utils.BulkWriter(File.objects.model._meta.db_table, ['id'] + columns, mode='update',
+                                         key=['id']) as writer:
+                    writer.write_df(df[~new_rows])
+
+            # filter out existing files
+            df = df[new_rows]
+            db_utils.insert_with_copy_from_and_tmp_table(df, File.objects.model._meta.db_table)
+
+            if 'share' in kwargs:
+                # add to share
+                df_id['share_id'] = kwargs.get('share').id_as_str
+                df_id = df_id.rename(columns={'id': 'file_id'})
+                from apps.share.models import Share
+                db_utils.insert_with_copy_from_and_tmp_table(df_id, Share.files.through.objects.model._meta.db_table,
+                                                             insert_columns='file_id, share_id')
+
+            # add to project
+            for_user = kwargs.get('for_user')
+            project = kwargs.get('project')
+            if project is not None and for_user is not None:
+                df_id['project_id'] = project.id_as_str
+                df_id = df_id.drop(columns=['share_id'])
+                df_id = df_id.rename(columns={'id': 'file_id'})
+                df_id['user_id'] = for_user.id_as_str
+                now = timezone.now().isoformat()
+                df_id['date_created'] = now
+                df_id['last_modified'] = now
+                df_id['imported'] = False
+
+                def fn_set_id(e):
+                    return str(uuid.uuid4())
+
+                df_id['id'] = df_id.apply(fn_set_id, axis=1)
+
+                # TODO set imported = True if the recipient has download permission and the file is imported on the client
+
+                from apps.project.models import Project
+                db_utils.insert_with_copy_from_and_tmp_table(df_id, Project.files.through.objects.model._meta.db_table,
+                                                             insert_columns='id, imported, file_id, project_id, user_id, date_created, last_modified')
 
     def remove_file(self):
         if not self.imported:
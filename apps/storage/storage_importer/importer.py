@@ -1,20 +1,18 @@
 import csv
-import io
 import json
 import logging
 import os
-import random
 import shutil
-import string
 import uuid
 from pathlib import Path
 
 import magic
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db import transaction, connection
+from django.db import transaction
 
 from apps.core import identifier
+from apps.core.db_utils import BulkWriter
 from apps.core.models import Annotation
 from apps.project.models import Project, FilePermission
 from apps.project.project_case.models import Case
@@ -158,20 +156,13 @@ class FileImporter:
             # iterate over file and check if announced files are actually there and register them
             directories = []
 
-            # create pg tmp table to write data in
-            # then import data into tmp table with copy from csv
-            # then update file table with new data
+            # the found files are copied into a tmp table in batches and the registered files of the folder are
+            # updated from it.
             # TODO set content type if null
-            cursor = connection.cursor()
-            tbl_name = ''.join(random.choice(string.ascii_uppercase) for _ in range(5))
-
-            cursor.execute(
-                f'create temp table {tbl_name} (original_path text, path text, size int8, content_type text)')
-
-            memory_file = io.StringIO()
-            writer = csv.writer(memory_file)
-            csv_header = ['original_path', 'path', 'size', 'content_type']
-            writer.writerow(csv_header)
+            writer = BulkWriter(File.objects.model._meta.db_table,
+                                ['original_path', 'path', 'size', 'content_type', 'imported'], mode='update',
+                                key=['original_path'],
+                                filters={'imported': False, 'import_folder_id': folder.id_as_str})
             INTERVAL = 10_000
             for idx, file in enumerate(self.walk(folder.import_dir)):
                 if file.absolute() == folder.import_dir.absolute():
@@ -201,7 +192,7 @@ class FileImporter:
                         logging.info(f'{file} fall back to shutil.move')
                         shutil.move(file, new_path)
                     kw['path'] = str(new_path.relative_to(settings.STORAGE_DATA_DIR))
-                    writer.writerow([s, kw['path'], new_path.stat().st_size, mimetype])
+                    writer.write([s, kw['path'], new_path.stat().st_size, mimetype, True])
                 except shutil.Error as e:
                     logging.error('File %s could not be imported.', file)
                     logging.exception(e)
@@ -213,16 +204,7 @@ class FileImporter:
                     continue
 
             # do not catch exceptions here. transaction will be rolled back if any exception is thrown
-            memory_file.seek(0)
-            cursor.copy_expert(f'copy {tbl_name}({",".join(csv_header)}) from stdin csv header NULL as \'null\'',
-                               memory_file)
-            memory_file.close()
-
-            # do the update
-            sql = f'update storage_file set imported = true, path = {tbl_name}.path, content_type = {tbl_name}.content_type, size = {tbl_name}.size from {tbl_name} where storage_file.imported = %s and storage_file.import_folder_id = %s and {tbl_name}.original_path = storage_file.original_path'
-            a = cursor.execute(sql, (False, folder.id_as_str,))
-            cursor.execute(f'drop table {tbl_name};')
-            cursor.close()
+            writer.flush()
 
             if not_imported_folder_tmp.exists():
                 logging.debug('Moving file %s to %s', not_imported_folder_tmp, folder.not_imported_folder)
@@ -1,17 +1,16 @@
 import abc
 import csv
-import io
 import logging
 import uuid
 from pathlib import Path
 from typing import Dict
 
 import pandas as pd
-from django.db import connection
 from django.db.models import QuerySet
 from django.utils import timezone
 
 from apps.core import identifier
+from apps.core.db_utils import BulkWriter
 from apps.core.models import Annotation
 from apps.project.project_case.models import Case
 from apps.storage.fileset.models import FileSet
@@ -47,13 +46,8 @@ class StudyArmHandler(AbstractImportHandler):
             df = df.drop(df[df.case_id == q.id_as_str].index)  # TODO use pd isin ?
         if len(df.index) > 0:
             df = df.rename(columns={'id': 'file_id'})
-            with io.StringIO() as buffer:
-                df.to_csv(buffer, index=False)
-                buffer.seek(0)
-                with connection.cursor() as cursor:
-                    cursor.copy_expert(
-                        f'copy study_management_studyarm_files({",".join(df.columns)}) from stdin csv header',
-                        buffer)
+            with BulkWriter('study_management_studyarm_files', df.columns, mode='copy') as writer:
+                writer.write_df(df)
         logging.info('Files added to studyarm %s', self.study_arm)
 
     def handle_concept(self, df):
@@ -65,14 +59,8 @@ class StudyArmHandler(AbstractImportHandler):
         for q in qs:
             df = df.drop(df[df.code_id == q.id_as_str].index)
         if len(df.index) > 0:
-            with io.StringIO() as buffer:
-                df.to_csv(buffer, index=False)
-                buffer.seek(0)
-                with connection.cursor() as cursor:
-                    # study_management_study_concepts
-                    cursor.copy_expert(
-                        f'copy {Study.codes.through.objects.model._meta.db_table}({",".join(df.columns)}) from stdin csv header',
-                        buffer)
+            with BulkWriter(Study.codes.through.objects.model._meta.db_table, df.columns, mode='copy') as writer:
+                writer.write_df(df)
             logging.info('Terms added to study %s', self.study_arm.study)
 
 
@@ -85,14 +73,8 @@ class TileSetHandler(AbstractImportHandler):
         df['tileset_id'] = self.tileset.id_as_str
         df = df.drop_duplicates()
 
-        with io.StringIO() as buffer:
-            df.to_csv(buffer, index=False)
-            buffer.seek(0)
-            with connection.cursor() as cursor:
-                # tile_management_tileset_terms
-                cursor.copy_expert(
-                    f'copy {TileSet.terms.through.objects.model._meta.db_table}({",".join(df.columns)}) from stdin csv header',
-                    buffer)
+        with BulkWriter(TileSet.terms.through.objects.model._meta.db_table, df.columns, mode='copy') as writer:
+            writer.write_df(df)
         logging.info('Terms added to study %s', self.tileset)
 
     def handle(self, df):
@@ -100,14 +82,8 @@ class TileSetHandler(AbstractImportHandler):
         df = df.rename(columns={'id': 'file_id'})
         df['fileset_id'] = self.tileset.id_as_str
 
-        with io.StringIO() as buffer:
-            df.to_csv(buffer, index=False)
-            buffer.seek(0)
-            with connection.cursor() as cursor:
-                # fileset_fileset_files
-                cursor.copy_expert(
-                    f'copy {FileSet.files.through.objects.model._meta.db_table}({",".join(df.columns)}) from stdin csv header',
-                    buffer)
+        with BulkWriter(FileSet.files.through.objects.model._meta.db_table, df.columns, mode='copy') as writer:
+            writer.write_df(df)
         logging.info('Files added to tileset %s', self.tileset)
 
 
@@ -154,25 +130,17 @@ class MetadataImporter:
         if len(cases) != len(self.case_cache):
             diff = set(cases).difference(set(self.case_cache.keys()))
             diff = list(filter(lambda e: len(str(e).strip()) > 0, diff))
-            with io.StringIO() as buffer:
-                fieldnames = ['id', 'date_created', 'last_modified', 'identifier', 'name', 'created_by_id', 'origin_id']
-                writer = csv.writer(buffer)
-                writer.writerow(fieldnames)
+            fieldnames = ['id', 'date_created', 'last_modified', 'identifier', 'name', 'created_by_id', 'origin_id']
+            with BulkWriter(Case.objects.model._meta.db_table, fieldnames, mode='copy') as writer:
                 created_by_id = self.created_by.id_as_str
                 origin_id = self.origin.id_as_str
-                writer.writerows(
-                    [[str(uuid.uuid4()), self.now, self.now, identifier.create_random('case'), str(d), created_by_id,
-                      origin_id] for d
-                     in diff])
-                buffer.seek(0)
-                with connection.cursor() as cursor:
-                    cursor.copy_expert(
-                        f'copy {Case.objects.model._meta.db_table}({",".join(fieldnames)}) from stdin csv header NULL as \'null\'',
-                        buffer
-                    )
-                # add new cases to cache
-                for case in Case.objects.filter(name__in=cases):
-                    self.case_cache[case.name] = case
+                writer.write_rows(
+                    [str(uuid.uuid4()), self.now, self.now, identifier.create_random('case'), str(d), created_by_id,
+                     origin_id] for d
+                    in diff)
+            # add new cases to cache
+            for case in Case.objects.filter(name__in=cases):
+                self.case_cache[case.name] = case
 
     def map_originating_from_id(self):
         if not 'originating_from_id' in self.df.columns: return
@@ -261,15 +229,9 @@ class MetadataImporter:
 
         terms['codes'] = terms['codes'].apply(fn)
 
-        with io.StringIO() as buffer:
-            terms = terms.rename(columns={'codes': 'code_id', 'id': 'file_id'})
-            terms.to_csv(buffer, index=False)
-            buffer.seek(0)
-            with connection.cursor() as cursor:
-                cursor.copy_expert(
-                    f'copy {File.codes.through.objects.model._meta.db_table}({",".join(terms.columns)}) from stdin csv header NULL as \'null\'',
-                    buffer
-                )
+        terms = terms.rename(columns={'codes': 'code_id', 'id': 'file_id'})
+        with BulkWriter(File.codes.through.objects.model._meta.db_table, terms.columns, mode='copy') as writer:
+            writer.write_df(terms)
 
         for handler in self.handlers:
             handler.handle_concept(terms)
@@ -283,28 +245,22 @@ class MetadataImporter:
     def create_files(self):
         # TODO if row already has an identifier, do not import that row
         # TODO cut out any field that is no column to prevent errors
-        with io.StringIO() as buffer:
-            # only use the rows that do not have an identifier = should be inserted
-            df = self.drop_with_identifier(self.df)
-            # add identifier here after dropping all rows that already contain an identifier provided by the user
-            if len(df.index) > 0:
-                if not 'identifier' in self.df.columns:
-                    self.df['identifier'] = [identifier.create_random('file') for _ in range(len(self.df.index))]
-                else:
-                    cond = ~(df['identifier'].str.len() > 0 | df['identifier'].notna())
-                    self.df['identifier'][cond] = self.df['identifier'][cond].apply(
-                        lambda e: identifier.create_random('file'))
-
-                df['identifier'] = self.df['identifier']
-                df['import_folder_id'] = self.import_folder.id_as_str
-                # TODO add importfolder here?
-                df.to_csv(buffer, index=False, na_rep='null')
-                buffer.seek(0)
-                with connection.cursor() as cursor:
-                    cursor.copy_expert(
-                        f'copy {File.objects.model._meta.db_table}({",".join(self.df.columns)}) from stdin csv header NULL as \'null\'',
-                        buffer
-                    )
+        # only use the rows that do not have an identifier = should be inserted
+        df = self.drop_with_identifier(self.df)
+        # add identifier here after dropping all rows that already contain an identifier provided by the user
+        if len(df.index) > 0:
+            if not 'identifier' in self.df.columns:
+                self.df['identifier'] = [identifier.create_random('file') for _ in range(len(self.df.index))]
+            else:
+                cond = ~(df['identifier'].str.len() > 0 | df['identifier'].notna())
+                self.df['identifier'][cond] = self.df['identifier'][cond].apply(
+                    lambda e: identifier.create_random('file'))
+
+            df['identifier'] = self.df['identifier']
+            df['import_folder_id'] = self.import_folder.id_as_str
+            # TODO add importfolder here?
+            with BulkWriter(File.objects.model._meta.db_table, df.columns, mode='copy') as writer:
+                writer.write_df(df)
 
     def prepare_date_columns(self):
         self.df['date_created'] = self.now
@@ -334,28 +290,14 @@ class MetadataImporter:
         df = df.drop(['metadata', 'file_id'], axis=1)
         if not 'system' in df.columns:
             return
-        with io.StringIO() as buffer:
-            if len(df.index) > 0:
-                df.to_csv(buffer, index=False, na_rep='null')
-                buffer.seek(0)
-                with connection.cursor() as cursor:
-                    cursor.copy_expert(
-                        f'copy {Annotation.objects.model._meta.db_table}({",".join(df.columns)}) from stdin csv header NULL as \'null\'',
-                        buffer
-                    )
+        with BulkWriter(Annotation.objects.model._meta.db_table, df.columns, mode='copy') as writer:
+            writer.write_df(df)
 
         df = df[['id']]
         df = df.rename(columns={'id': 'annotation_id'})
         df['file_id'] = col_file_id
-        with io.StringIO() as buffer:
-            if len(df.index) > 0:
-                df.to_csv(buffer, index=False, na_rep='null')
-                buffer.seek(0)
-                with connection.cursor() as cursor:
-                    cursor.copy_expert(
-                        f'copy {File.annotations.through.objects.model._meta.db_table}({",".join(df.columns)}) from stdin csv header NULL as \'null\'',
-                        buffer
-                    )
+        with BulkWriter(File.annotations.through.objects.model._meta.db_table, df.columns, mode='copy') as writer:
+            writer.write_df(df)
 
     def run(self, file: Path):
         df = pd.read_csv(file, na_filter=False)
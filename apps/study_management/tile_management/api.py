@@ -1,8 +1,5 @@
-import csv
-import io
-
 from django.conf import settings
-from django.db import connection, transaction
+from django.db import transaction
 from django.http import JsonResponse
 from django.utils.decorators import method_decorator
 import logging
@@ -11,7 +8,9 @@ from rest_framework.generics import get_object_or_404
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from apps.core.db_utils import BulkWriter
 from apps.core.serializers import IdentifierField
+from apps.storage.fileset.models import FileSet
 from apps.storage.models import File
 from apps.study_management.models import Study
 from apps.study_management.tile_management.models import TileSet
@@ -54,20 +53,9 @@ class AddFileToTileSet(APIView):
                 files = f.readlines()
                 files = list(map(lambda e: e.strip(), files))
 
-        memory_file = io.StringIO()
-        writer = csv.writer(memory_file)
-        csv_header = ['fileset_id', 'file_id']
-        writer.writerow(csv_header)
-        # with transaction.atomic():
-            # qs = File.objects.filter(id__in=files, created_by=created_by).values_list('pk', flat=True)
-        writer.writerows([[tileset.id_as_str, str(f)] for f in files])
-        memory_file.seek(0)
-        # with transaction.atomic():
-        with connection.cursor() as cursor:
-            cursor.copy_expert(
-                f'copy fileset_fileset_files({",".join(csv_header)}) from stdin csv header', memory_file
-            )
-            # cursor.commit()
-        memory_file.close()
+        # qs = File.objects.filter(id__in=files, created_by=created_by).values_list('pk', flat=True)
+        with BulkWriter(FileSet.files.through.objects.model._meta.db_table, ['fileset_id', 'file_id'],
+                        mode='copy') as writer:
+            writer.write_rows([tileset.id_as_str, str(f)] for f in files)
         logging.info('Done adding tiles to tileset.')
         return Response(status=status.HTTP_200_OK)
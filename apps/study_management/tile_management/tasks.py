@@ -114,7 +114,7 @@ def create_tileset_share(tileset_pk, project_identifier, valid_from, valid_until
     builder.add_file_handler(data=files_qs)
     builder.add_case_handler(data=case_ids)
     builder.add_codes_handler(data=file_concepts, handler_init_kwargs={'__name__': CodesHandler.name_files})
-    builder.add_permission_handler(data=','.join(list(map(lambda e: f'\'{e}\'', file_identifiers))))
+    builder.add_permission_handler(data=file_identifiers)
     share = builder.build(project_identifier)
 
     ShareToken.objects.create(project_identifier=project_identifier,
@@ -128,7 +128,7 @@ def create_tileset_share(tileset_pk, project_identifier, valid_from, valid_until
     logging.info('Done creating tileset share.')
 
     recipient = Profile.objects.get(pk=target_node_pk)
-    object = ShareObject(content=share.content)
+    object = ShareObject(content=share.get_content())
     OutboxMessage.create(
         sender=created_by,
         recipient=recipient,
@@ -112,6 +112,20 @@ class Code(CreatedByMixin, OriginMixin, Base):
     def get_machine_rep(self) -> str:
         return f'{self.codesystem.uri}#{self.code}'
 
+    @staticmethod
+    def prepare_import(**kwargs):
+        '''
+        Creates the code systems of `codes` that do not exist yet and the code set of `project`. `import_codes` runs as
+        a staged step of a share import, whose writes through the orm would not be staged, see db_utils.Staging.
+        '''
+        project = kwargs.get('project')
+        for uri in db_utils.read_csv_values(kwargs.get('codes'), 'codesystem'):
+            CodeSystem.objects.get_or_create(uri=uri, defaults={'created_by': kwargs.get('created_by'),
+                                                                'origin': kwargs.get('origin')})
+        if project is not None and project.codeset is None and kwargs.get('codes'):
+            project.codeset = CodeSet.objects.create()
+            project.save(update_fields=['codeset'])
+
     @staticmethod
     def import_codes(**kwargs):
         # TODO check if codes get imported if they already exist.
@@ -128,20 +142,6 @@ class Code(CreatedByMixin, OriginMixin, Base):
         created_by = kwargs.get('created_by')
         origin = kwargs.get('origin')
 
-        df = pandas.read_csv(io.StringIO(codes))
-        df = df.drop(columns=['file'])
-        now = timezone.now().isoformat()
-        df['date_created'] = now
-        df['last_modified'] = now
-        # df['created_by_id'] = kwargs.get('created_by').id_as_str
-        # df['id'] = df.apply(lambda e: str(uuid.uuid4()), axis=1)
-
-        # remove codes that do not have an origin. those are codes than come pre-installed with centauron.
-        # df = df.apply(lambda e: e['origin'] is not None, axis=1)
-        # df = df.dropna() # TODO test if this is not dropping too much.
-
-        # drop duplicates
-        df = df.drop_duplicates()
         profile_cache = {}
 
         def from_profile_cache(e):
@@ -169,79 +169,69 @@ class Code(CreatedByMixin, OriginMixin, Base):
                 codesystem_cache[e] = pandas.Series(data={'codesystem_id': cs.id_as_str, 'codesystem_name': cs.name})
             return codesystem_cache[e]
 
-        # first create code system or get id
-        logging.info(df)
-        # then import codes
-        # filter out files that are already existing in database
-        qs = Code.objects.filter(code__in=df['code'].to_list(),
-                                 codesystem__uri__in=df['codesystem'].to_list()).distinct()
-        existing_files = {f'{e[0]},{e[1]}': e[2] for e in qs.values_list('code', 'codesystem__uri', 'id')}
-        # existing_rows = df['identifier'].isin(existing_files.keys())
-        existing_codes = list(map(lambda e: e.split(',')[0], existing_files.keys()))
-        existing_codesystems = list(map(lambda e: e.split(',')[1], existing_files.keys()))
-        existing_rows = (df['code'].isin(existing_codes) & df['codesystem'].isin(existing_codesystems))
-        df['existing'] = existing_rows
-
-        def fn_set_id(e):
-            if not e['existing']: return str(uuid.uuid4())
-            return existing_files[f'{e["code"]},{e["codesystem"]}']
-
-        df['id'] = df.apply(fn_set_id, axis=1)  # df.apply(lambda e: str(uuid.uuid4()), axis=1)
-
-        # filter out existing files
-        df = df[~existing_rows]
-        df = df.drop(columns=['existing'])
-        # for all rows that are not existing yet.
-        if len(df.index) > 0:
-            df = df.rename(columns={'origin': 'origin_id', 'codesystem': 'codesystem_id'})
-            # df['origin_id'] = df['origin_id'].apply(from_profile_cache) # TODO fix this.
-            df[['codesystem_id', 'codesystem_name']] = df.apply(from_codesystem_cache, axis=1)
-            db_utils.insert_with_copy_from_and_tmp_table(df, Code.objects.model._meta.db_table)
-
-        # add the codes to files
-        df = pandas.read_csv(io.StringIO(codes))
-        df = df.rename(columns={'file': 'file_id'})
-        file_cache = {}
-
-        def fn(e):
-            if e not in file_cache:
-                file_cache[e] = File.objects.filter_by_identifier(e).first().id_as_str
-            return file_cache.get(e)
-
-        df['file_id'] = df['file_id'].apply(fn)
-
-        # get all codes from db as some concept may already have existed in database
-        code_cache = {}
-
-        def fn(e):
-            k = f'{e.codesystem}#{e.code}'
-            if k not in code_cache:
-                code_cache[k] = Code.objects.filter(codesystem__uri=e.codesystem, code=e.code).first().id_as_str
-            return code_cache[k]
-
-        df['code_id'] = df.apply(fn, axis=1)
-        df = df.drop(columns=['origin', 'code', 'codesystem'])
-        # add codes to files
-        db_utils.insert_with_copy_from_and_tmp_table(df, File.codes.through.objects.model._meta.db_table,
-                                                     insert_columns='file_id, code_id')
-        # add codes to share
-        df = df.drop(columns=['file_id'])
-        df['share_id'] = kwargs.get('share').id_as_str
-        db_utils.insert_with_copy_from_and_tmp_table(df, Share.codes.through.objects.model._meta.db_table,
-                                                     insert_columns='share_id, code_id')
-
-        # add codes to project
-        df = df.drop_duplicates()
-        df = df.drop(columns=['share_id'])
-        project = kwargs.get('project')
-        # add to project
-        if project is not None:
-            if project.codeset is None:
-                project.codeset = CodeSet.objects.create()
-                project.save(update_fields=['codeset'])
-            df['codeset_id'] = project.codeset.id_as_str
-            db_utils.insert_with_copy_from_and_tmp_table(df, CodeSet.codes.through.objects.model._meta.db_table,
-                                                         insert_columns='code_id, codeset_id')
+        # codes are strings. otherwise numeric codes would not match the existing codes of a previous chunk.
+        for chunk in db_utils.read_csv_chunks(codes, name='codes', dtype={'code': str}):
+            df = chunk.drop(columns=['file'])
+            now = timezone.now().isoformat()
+            df['date_created'] = now
+            df['last_modified'] = now
+            # df['created_by_id'] = kwargs.get('created_by').id_as_str
+            # df['id'] = df.apply(lambda e: str(uuid.uuid4()), axis=1)
+
+            # remove codes that do not have an origin. those are codes than come pre-installed with centauron.
+            # df = df.apply(lambda e: e['origin'] is not None, axis=1)
+            # df = df.dropna() # TODO test if this is not dropping too much.
+
+            # drop duplicates
+            df = df.drop_duplicates()
+
+            # first create code system or get id
+            logging.info(df)
+            # then import codes
+            # filter out codes that are already existing in database or were imported by a previous chunk
+            new_rows = db_utils.assign_ids(df, Code.objects.all(), columns=['codesystem', 'code'],
+                                           fields=['codesystem__uri', 'code'])
+
+            # filter out existing codes
+            df = df[new_rows]
+            # for all rows that are not existing yet.
+            if len(df.index) > 0:
+                df = df.rename(columns={'origin': 'origin_id', 'codesystem': 'codesystem_id'})
+                # df['origin_id'] = df['origin_id'].apply(from_profile_cache) # TODO fix this.
+                df[['codesystem_id', 'codesystem_name']] = df.apply(from_codesystem_cache, axis=1)
+                db_utils.insert_with_copy_from_and_tmp_table(df, Code.objects.model._meta.db_table)
+
+            # add the codes to files
+            df = chunk.rename(columns={'file': 'file_id'})
+            df['file_id'] = df['file_id'].map(File.objects.resolve_identifiers(df['file_id'].unique()))
+
+            # get all codes from db as some concept may already have existed in database
+            code_keys = list(zip(df['codesystem'], df['code']))
+            resolved_codes = db_utils.resolve_identifiers(Code.objects.all(), set(code_keys),
+                                                          fields=['codesystem__uri', 'code'])
+            df['code_id'] = [resolved_codes.get(k) for k in code_keys]
+            df = df.drop(columns=['origin', 'code', 'codesystem'])
+            # add codes to files
+            db_utils.insert_with_copy_from_and_tmp_table(df, File.codes.through.objects.model._meta.db_table,
+                                                         insert_columns='file_id, code_id')
+            # add codes to share
+            df = df.drop(columns=['file_id'])
+            df['share_id'] = kwargs.get('share').id_as_str
+            db_utils.insert_with_copy_from_and_tmp_table(df, Share.codes.through.objects.model._meta.db_table,
+                                                         insert_columns='share_id, code_id')
+
+            # add codes to project
+            df = df.drop_duplicates()
+            df = df.drop(columns=['share_id'])
+            project = kwargs.get('project')
+            # add to project
+            if project is not None:
+                if project.codeset is None:
+                    project.codeset = CodeSet.objects.create()
+                    project.save(update_fields=['codeset'])
+                df['codeset_id'] = project.codeset.id_as_str
+                db_utils.insert_with_copy_from_and_tmp_table(df, CodeSet.codes.through.objects.model._meta.db_table,
+                                                             insert_columns='code_id, codeset_id')
 
 
 class CodeSet(Base):
@@ -14,3 +14,13 @@ class ProfileManager(BaseManager):
         except Profile.DoesNotExist:
             user, _ = User.objects.get_or_create(username=str(identifier))
             return self.create(identifier=identifier, user=user)
+
+    def resolve_or_create(self, identifiers):
+        '''
+        Like `resolve_identifiers` but creates a profile for every identifier that does not exist yet.
+        '''
+        resolved = self.resolve_identifiers(identifiers, missing='ignore')
+        for e in set(identifiers) - resolved.keys():
+            if isinstance(e, str):
+                resolved[e] = self.create_and_return(e).id_as_str
+        return resolved
@@ -461,8 +461,35 @@ STORAGE_DATA_DIR.mkdir(parents=True, exist_ok=True)
 STORAGE_EXPORT_DIR: Path = Path(env.str('STORAGE_EXPORT_DIR', '/export/')).absolute()
 STORAGE_EXPORT_DIR.mkdir(parents=True, exist_ok=True)
 
+# share packages are written as compressed files into this directory instead of the database
+SHARE_PACKAGE_DIR: Path = Path(env.str('SHARE_PACKAGE_DIR', str(STORAGE_DATA_DIR / 'shares'))).absolute()
+SHARE_PACKAGE_DIR.mkdir(parents=True, exist_ok=True)
+# run independent share handler exports in a thread pool on separate db connections
+SHARE_BUILD_CONCURRENT = env.bool('SHARE_BUILD_CONCURRENT', False)
+SHARE_BUILD_MAX_WORKERS = env.int('SHARE_BUILD_MAX_WORKERS', 4)
+# send recipients the hash and fetch url of a share package instead of embedding the package in each message.
+# shares without a package (built before packages existed) are always embedded.
+SHARE_SEND_BY_REFERENCE = env.bool('SHARE_SEND_BY_REFERENCE', True)
+# limits for the estimated size and build duration (seconds) of a share before it is queued.
+# the max duration is the soft time limit of the create_share task.
+SHARE_PLAN_WARN_ROWS = env.int('SHARE_PLAN_WARN_ROWS', 1_000_000)
+SHARE_PLAN_MAX_ROWS = env.int('SHARE_PLAN_MAX_ROWS', 100_000_000)
+SHARE_PLAN_WARN_DURATION = env.int('SHARE_PLAN_WARN_DURATION', 60 * 60)
+SHARE_PLAN_MAX_DURATION = env.int('SHARE_PLAN_MAX_DURATION', 60 * 60 * 24)
+# number of previous shares whose metrics are used to estimate the build duration
+SHARE_PLAN_HISTORY = env.int('SHARE_PLAN_HISTORY', 50)
+# the share is planned in the web request. every query of the plan is cancelled after this many milliseconds.
+SHARE_PLAN_STATEMENT_TIMEOUT = env.int('SHARE_PLAN_STATEMENT_TIMEOUT', 5000)
+# import independent sections of a received share in a thread pool on separate db connections
+SHARE_IMPORT_CONCURRENT = env.bool('SHARE_IMPORT_CONCURRENT', False)
+SHARE_IMPORT_MAX_WORKERS = env.int('SHARE_IMPORT_MAX_WORKERS', 4)
+
 CLEAN_UP_OLD_FILES_DAYS_THRESHOLD = env.int('STORAGE_CLEAN_UP_OLD_FILES_DAYS_THRESHOLD', 5)
 IMPORTER_FLUSH_EVERY = env.int('STORAGE_IMPORTER_FLUSH_EVERY', 500_000)
+# number of csv rows of a received share that are imported at once
+IMPORTER_CHUNK_SIZE = env.int('STORAGE_IMPORTER_CHUNK_SIZE', 50_000)
+# number of rows that db_utils.BulkWriter buffers before it copies them into the database
+BULK_WRITER_BATCH_SIZE = env.int('BULK_WRITER_BATCH_SIZE', 50_000)
 
 CA_DIR = Path(env.str('CA_DIR', 'ca_certs/'))
 
@@ -486,6 +513,9 @@ MY_DEV_CREDENTIALS = {
     'X-FORWARDED-TLS-CLIENT-CERT-INFO': f'Subject%3D%22CN%3DCOMMON_NAME%22'.replace('COMMON_NAME',
                                                                                     COMMON_NAME)}  # example how traefik forwards the cn: Subject%3D%22CN%3Dak-demo%22
 
+# number of transfer items a worker claims at once and after how many seconds the claim of a worker expires
+FILE_TRANSFER_BATCH_SIZE = env.int('FILE_TRANSFER_BATCH_SIZE', 100)
+FILE_TRANSFER_CLAIM_TIMEOUT = env.int('FILE_TRANSFER_CLAIM_TIMEOUT', 15 * 60)
 DOWNLOADER_TMP_DIR = Path(env.str('DOWNLOADER_TMP_DIR', '/downloads'))
 DOWNLOADER_SECRET = env.str('DOWNLOADER_SECRET')
 DOWNLOADER_ADDRESS = env.str('DOWNLOADER_ADDRESS')
@@ -564,6 +594,65 @@ DSF_CERTIFICATE_PRIVATE_KEY = env.str('DSF_CERTIFICATE_PRIVATE_KEY',
 
 DECENTRALIZED_BACKEND = env.str('DECENTRALIZED_BACKEND', 'apps.federation.outbox.backends.CentauronAdapter')
 BROADCAST_BACKEND = env.str('BROADCAST_BACKEND', 'apps.federation.outbox.backends.FireflyAdapter')
+# number of pending inbox messages a worker of process_inbox_messages claims at once
+FEDERATION_INBOX_BATCH_SIZE = env.int('FEDERATION_INBOX_BATCH_SIZE', 10)
+# profiles and nodes of received messages are cached in each process for this many seconds
+FEDERATION_INBOX_CACHE_TTL = env.int('FEDERATION_INBOX_CACHE_TTL', 5 * 60)
+FEDERATION_INBOX_CACHE_SIZE = env.int('FEDERATION_INBOX_CACHE_SIZE', 10_000)
+# received messages are processed by one worker per shard. the messages of a sender are in the same shard.
+FEDERATION_INBOX_SHARDS = env.int('FEDERATION_INBOX_SHARDS', 16)
+# processing latency in the inbox metrics is measured over the messages processed in the last seconds
+FEDERATION_INBOX_METRICS_WINDOW = env.int('FEDERATION_INBOX_METRICS_WINDOW', 60 * 60)
+# max number of messages in one request to the batch inbox
+FEDERATION_INBOX_MAX_BATCH = env.int('FEDERATION_INBOX_MAX_BATCH', 1000)
+# a worker processes the messages of a shard for at most this many seconds, long enough for a share import
+FEDERATION_INBOX_TIME_LIMIT = env.int('FEDERATION_INBOX_TIME_LIMIT', 6 * 60 * 60)
+# a claimed inbox message is processed again after this many seconds, in case its worker was killed
+FEDERATION_INBOX_CLAIM_TIMEOUT = env.int('FEDERATION_INBOX_CLAIM_TIMEOUT', FEDERATION_INBOX_TIME_LIMIT + 5 * 60)
+# inbox messages that failed this many times are not processed again
+FEDERATION_INBOX_MAX_TRIES = env.int('FEDERATION_INBOX_MAX_TRIES', 10)
+# number of outbox messages that are sent to a node before their status is written back
+FEDERATION_OUTBOX_BATCH_SIZE = env.int('FEDERATION_OUTBOX_BATCH_SIZE', 100)
+# the http clients to other nodes are kept per node and use http/2 if the node supports it
+FEDERATION_OUTBOX_HTTP2 = env.bool('FEDERATION_OUTBOX_HTTP2', True)
+FEDERATION_OUTBOX_MAX_CONNECTIONS = env.int('FEDERATION_OUTBOX_MAX_CONNECTIONS', 10)
+# failed outbox messages are sent again by process_outbox_messages with exponential backoff (in seconds)
+FEDERATION_OUTBOX_MAX_TRIES = env.int('FEDERATION_OUTBOX_MAX_TRIES', 10)
+FEDERATION_OUTBOX_RETRY_DELAY = env.int('FEDERATION_OUTBOX_RETRY_DELAY', 30)
+FEDERATION_OUTBOX_RETRY_MAX_DELAY = env.int('FEDERATION_OUTBOX_RETRY_MAX_DELAY', 60 * 60)
+# a claimed outbox message is sent again after this many seconds, in case its worker was killed
+FEDERATION_OUTBOX_CLAIM_TIMEOUT = env.int('FEDERATION_OUTBOX_CLAIM_TIMEOUT', CELERY_TASK_TIME_LIMIT + 5 * 60)
+# delivery to a node is paused after this many failed attempts in a row, for FEDERATION_NODE_PAUSE seconds at first
+FEDERATION_NODE_FAILURE_THRESHOLD = env.int('FEDERATION_NODE_FAILURE_THRESHOLD', 3)
+FEDERATION_NODE_PAUSE = env.int('FEDERATION_NODE_PAUSE', 60)
+# celery queues of the message lanes, see apps.federation.models.Message.get_priority. a worker that only consumes
+# the control queue keeps acks and invitation responses fast while shares are imported.
+FEDERATION_QUEUE_CONTROL = env.str('FEDERATION_QUEUE_CONTROL', 'federation_control')
+FEDERATION_QUEUE_DEFAULT = env.str('FEDERATION_QUEUE_DEFAULT', 'celery')
+FEDERATION_QUEUE_BULK = env.str('FEDERATION_QUEUE_BULK', 'federation_bulk')
+FEDERATION_CONTROL_MESSAGE_TYPES = env.list('FEDERATION_CONTROL_MESSAGE_TYPES', default=[
+    'ack', 'project-invitation', 'project-invitation-response', 'leaderboard', 'retract-share', 'submission-result'])
+FEDERATION_BULK_MESSAGE_TYPES = env.list('FEDERATION_BULK_MESSAGE_TYPES', default=['share', 'submission'])
+# messages with a body of at least this many bytes are put into the bulk lane whatever their type
+FEDERATION_BULK_MIN_SIZE = env.int('FEDERATION_BULK_MIN_SIZE', 1024 * 1024)
+# the payload of processed messages older than this many days is moved into compressed files in the archive dir
+FEDERATION_MESSAGE_RETENTION_DAYS = env.int('FEDERATION_MESSAGE_RETENTION_DAYS', 30)
+FEDERATION_ARCHIVE_BATCH_SIZE = env.int('FEDERATION_ARCHIVE_BATCH_SIZE', 1000)
+FEDERATION_ARCHIVE_DIR: Path = Path(env.str('FEDERATION_ARCHIVE_DIR', str(STORAGE_DATA_DIR / 'federation_archive'))) \
+    .absolute()
+FEDERATION_ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
+# content encodings of message bodies this node accepts and sends, in order of preference (zstd, gzip)
+FEDERATION_CONTENT_ENCODINGS = env.list('FEDERATION_CONTENT_ENCODINGS', default=['zstd', 'gzip'])
+# message bodies smaller than this are sent uncompressed
+FEDERATION_COMPRESS_MIN_SIZE = env.int('FEDERATION_COMPRESS_MIN_SIZE', 1024)
+# messages with a body of at least this many bytes are stored as files and fetched by the recipient node, see
+# apps.federation.payload. the files are removed after FEDERATION_MESSAGE_RETENTION_DAYS.
+FEDERATION_PAYLOAD_MIN_SIZE = env.int('FEDERATION_PAYLOAD_MIN_SIZE', 8 * 1024 * 1024)
+FEDERATION_PAYLOAD_DIR: Path = Path(env.str('FEDERATION_PAYLOAD_DIR', str(STORAGE_DATA_DIR / 'federation_payloads'))) \
+    .absolute()
+FEDERATION_PAYLOAD_DIR.mkdir(parents=True, exist_ok=True)
+# attempts to download a payload within one try of the message. every attempt resumes where the last one stopped.
+FEDERATION_PAYLOAD_DOWNLOAD_TRIES = env.int('FEDERATION_PAYLOAD_DOWNLOAD_TRIES', 3)
 
 API_ADDRESS = env.str('API_ADDRESS')
 
@@ -4,7 +4,7 @@ from django.contrib import admin
 from django.urls import include, path
 from django.views import defaults as default_views
 
-from apps.federation.inbox.views import InboxView
+from apps.federation.inbox.views import InboxBatchView, InboxMetricsView, InboxView
 
 
 urlpatterns = [
@@ -13,10 +13,13 @@ urlpatterns = [
                   # # Django Admin, use {% url 'admin:index' %}
                   path('api/storage/', include('apps.storage.urls_api'), name='api-storage'),
                   path('api/study/', include('apps.study_management.urls_api')),
+                  path('api/share/', include('apps.share.urls_api')),
                   path(settings.ADMIN_URL, admin.site.urls),
                   path('federation/', include(('apps.federation.urls', 'federation'))),
                   path('user/', include(('apps.user.urls', 'user'))),
                   path('api/inbox/', InboxView.as_view(), name='inbox'),
+                  path('api/inbox/batch/', InboxBatchView.as_view(), name='inbox-batch'),
+                  path('api/inbox/metrics/', InboxMetricsView.as_view(), name='inbox-metrics'),
                   # User management
                   # path("users/", include("centauron.users.urls", namespace="users")),
                   # path("accounts/", include("django.contrib.auth.urls")),
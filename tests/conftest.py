@@ -7,6 +7,8 @@ from django.contrib.auth.models import User
 from django.core.management import call_command
 
 from apps.core import identifier
+from apps.federation.inbox import cache
+from apps.node.models import Node
 from apps.project.models import Project
 from apps.study_management.import_data.models import ImportJob
 from apps.study_management.import_data.tasks import run_importer
@@ -23,6 +25,28 @@ def project(user, setup):
                                  origin=node)
 
 
+@pytest.fixture
+def remote_profile():
+    '''
+    Returns a factory for profiles of other nodes. The fields of the node can be passed e.g. common_name='sender'.
+    '''
+
+    def create(**node):
+        node = Node.objects.create(**{'identifier': uuid.uuid4().hex, 'did': uuid.uuid4().hex,
+                                      'common_name': uuid.uuid4().hex,
+                                      'api_address': f'https://{uuid.uuid4().hex}.test/api/inbox/', **node})
+        return Profile.objects.create(identifier=node.identifier, identity=uuid.uuid4().hex, node=node)
+
+    return create
+
+
+@pytest.fixture(autouse=True)
+def inbox_cache():
+    # the cached profiles of a test are rolled back with its transaction
+    yield
+    cache.clear()
+
+
 @pytest.fixture
 def setup():
     call_command('setup_node')
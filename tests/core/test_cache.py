@@ -0,0 +1,26 @@
+from unittest import mock
+
+from apps.core.cache import TTLCache
+
+
+def test_ttl_cache():
+    cache = TTLCache(ttl=10, max_size=2)
+    load = mock.Mock(return_value='a')
+    assert cache.get_or_set('a', load) == 'a'
+    assert cache.get_or_set('a', load) == 'a'
+    load.assert_called_once()
+
+    # none is not cached
+    assert cache.get_or_set('b', lambda: None) is None
+    assert len(cache) == 1
+
+    # the oldest entry is dropped
+    cache.set('b', 'b')
+    cache.set('c', 'c')
+    assert cache.get('a') is None and cache.get('c') == 'c'
+
+    with mock.patch('apps.core.cache.time.monotonic', return_value=10 ** 9):
+        assert cache.get('c') is None
+    assert len(cache) == 1
+    cache.clear()
+    assert len(cache) == 0
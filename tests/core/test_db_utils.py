@@ -0,0 +1,181 @@
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas
+import pytest
+from django.db import connection, transaction
+from django.utils import timezone
+
+from apps.core import db_utils
+from apps.node.models import Node
+
+
+@pytest.mark.django_db
+def test_temp_table_from_values():
+    values = {uuid.uuid4() for _ in range(1000)}
+    with db_utils.temp_table_from_values(values) as tmp_tbl_name:
+        with connection.cursor() as cursor:
+            cursor.execute(f'select id from {tmp_tbl_name}')
+            assert {r[0] for r in cursor.fetchall()} == values
+
+    with connection.cursor() as cursor:
+        cursor.execute('select count(*) from pg_class where relname = %s', [tmp_tbl_name])
+        assert cursor.fetchone()[0] == 0
+
+
+@pytest.mark.django_db
+def test_queryset_as_sql():
+    nodes = [Node.objects.create(identifier=uuid.uuid4().hex, did=uuid.uuid4().hex,
+                                  human_readable=f"node '{i}'") for i in range(3)]
+    qs = Node.objects.filter(human_readable__in=[n.human_readable for n in nodes[:2]])
+
+    for subquery in [db_utils.queryset_as_sql(qs, 'id'),
+                     db_utils.queryset_as_sql(qs.values_list('id', flat=True))]:
+        with connection.cursor() as cursor:
+            cursor.execute(f'select count(*) from {Node.objects.model._meta.db_table} where id in ({subquery})')
+            assert cursor.fetchone()[0] == 2
+
+
+def test_read_csv_chunks():
+    data = 'a,b\n' + ''.join(f'{i},{i * 2}\n' for i in range(5))
+    chunks = list(db_utils.read_csv_chunks(data, chunk_size=2))
+    assert [len(df.index) for df in chunks] == [2, 2, 1]
+    assert chunks[-1]['b'].to_list() == [8]
+    assert list(db_utils.read_csv_chunks('')) == []
+    assert list(db_utils.read_csv_chunks(None)) == []
+    assert db_utils.read_csv_values('a,b\n1,x\n2,x\n3,\n', 'b') == {'x'}
+    assert db_utils.read_csv_values(data, 'c') == set()
+
+
+@pytest.mark.django_db
+def test_resolve_identifiers():
+    nodes = [Node.objects.create(identifier=uuid.uuid4().hex, did=uuid.uuid4().hex,
+                                 human_readable=f'node {i}') for i in range(3)]
+    identifiers = [n.identifier for n in nodes]
+
+    resolved = Node.objects.resolve_identifiers(identifiers + [float('nan')])
+    assert resolved == {n.identifier: n.id_as_str for n in nodes}
+
+    resolved = db_utils.resolve_identifiers(Node.objects.filter(pk=nodes[0].pk), [(n.identifier, n.human_readable)
+                                                                                  for n in nodes],
+                                            fields=['identifier', 'human_readable'], missing='ignore')
+    assert resolved == {(nodes[0].identifier, 'node 0'): nodes[0].id_as_str}
+
+    with pytest.raises(db_utils.UnresolvedIdentifiersError) as e:
+        Node.objects.resolve_identifiers(identifiers + ['unknown-1', 'unknown-2'])
+    assert set(e.value.identifiers) == {'unknown-1', 'unknown-2'}
+    assert Node.objects.resolve_identifiers(['unknown'], missing='log') == {}
+
+    # staged rows are resolved as well and the conditions of the queryset apply to them
+    staging = db_utils.Staging()
+    with staging.activate('nodes'), transaction.atomic():
+        staged = uuid.uuid4()
+        with db_utils.BulkWriter(Node.objects.model._meta.db_table, [
+            'id', 'date_created', 'last_modified', 'identifier', 'did', 'human_readable', 'cdn_address',
+            'address_centauron', 'common_name', 'capabilities', 'delivery_failures']) as writer:
+            writer.write([staged, timezone.now(), timezone.now(), 'staged', 'did', 'staged', '', '', '', {}, 0])
+        assert Node.objects.resolve_identifiers(['staged', nodes[0].identifier]) == {
+            'staged': str(staged), nodes[0].identifier: nodes[0].id_as_str}
+        assert db_utils.resolve_identifiers(Node.objects.exclude(human_readable='staged'), ['staged'],
+                                            missing='ignore') == {}
+        staging.drop()
+    assert not Node.objects.filter(identifier='staged').exists()
+
+
+@pytest.mark.django_db
+def test_bulk_writer():
+    table = Node.objects.model._meta.db_table
+    columns = ['id', 'date_created', 'last_modified', 'identifier', 'did', 'human_readable', 'cdn_address',
+               'address_centauron', 'common_name', 'api_address', 'capabilities', 'delivery_failures']
+    now = timezone.now()
+
+    def row(i, name=None):
+        return [uuid.uuid4(), now, now, f'node-{i}', f'did-{i}', name or f'node {i}', '', '', '', None, {}, 0]
+
+    with db_utils.BulkWriter(table, columns, mode='copy', batch_size=2) as writer:
+        writer.write_rows(row(i) for i in range(5))
+    assert writer.rows == 5
+    # empty strings stay empty strings and None is null
+    node = Node.objects.get(identifier='node-0')
+    assert node.cdn_address == '' and node.api_address is None
+
+    # duplicates are ignored
+    with db_utils.BulkWriter(table, columns, batch_size=2) as writer:
+        writer.write_rows(row(i) for i in range(3, 7))
+    assert Node.objects.count() == 7
+
+    df = pandas.DataFrame([row(i, name=f'upserted {i}') for i in [6, 6, 7]], columns=columns)
+    with db_utils.BulkWriter(table, columns, mode='upsert', key=['identifier'],
+                             update_columns=['human_readable']) as writer:
+        writer.write_df(df)
+    assert Node.objects.count() == 8
+    assert Node.objects.get(identifier='node-6').human_readable == 'upserted 6'
+
+    # merge does not need a unique constraint on the key
+    with db_utils.BulkWriter(table, columns, mode='merge', key=['human_readable'],
+                             update_columns=['cdn_address']) as writer:
+        writer.write_rows([row(8, name='upserted 6')[:6] + ['merged'] + row(8)[7:], row(9)])
+    assert Node.objects.count() == 9
+    assert Node.objects.get(identifier='node-6').cdn_address == 'merged'
+
+    with db_utils.BulkWriter(table, ['identifier', 'human_readable'], mode='update', key=['identifier'],
+                             filters={'cdn_address': ''}) as writer:
+        writer.write_rows([[f'node-{i}', f'updated {i}'] for i in range(2)])
+    assert Node.objects.get(identifier='node-1').human_readable == 'updated 1'
+
+    with pytest.raises(ValueError):
+        db_utils.BulkWriter(table, columns, mode='update')
+
+
+@pytest.mark.django_db
+def test_assign_ids():
+    node = Node.objects.create(identifier='node-1', did='did-1', human_readable='node 1')
+    df = pandas.DataFrame({'identifier': ['node-1', 'node-2', None], 'name': ['node 1', 'node 2', 'node 3']})
+
+    new_rows = db_utils.assign_ids(df, Node.objects.all())
+    assert new_rows.to_list() == [False, True, True]
+    assert df['id'][0] == node.id_as_str
+    assert df['id'][1] != df['id'][2]
+
+    new_rows = db_utils.assign_ids(df, Node.objects.all(), columns=['identifier', 'name'],
+                                   fields=['identifier', 'human_readable'])
+    assert new_rows.to_list() == [False, True, True]
+
+
+@pytest.mark.django_db
+def test_set_column_compression():
+    table = Node.objects.model._meta.db_table
+    with connection.schema_editor() as schema_editor:
+        db_utils.set_column_compression(schema_editor, table, 'human_readable', method='pglz')
+        # not supported methods are skipped
+        db_utils.set_column_compression(schema_editor, table, 'common_name', method='unknown')
+
+    with connection.cursor() as cursor:
+        cursor.execute('select attname, attcompression from pg_attribute where attrelid = %s::regclass '
+                       "and attname in ('human_readable', 'common_name') order by attname", [table])
+        assert cursor.fetchall() == [('common_name', ''), ('human_readable', 'p')]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_claim_batch():
+    nodes = [Node.objects.create(identifier=uuid.uuid4().hex, did=uuid.uuid4().hex) for _ in range(3)]
+    pending = Node.objects.filter(pk__in=[n.pk for n in nodes], delivery_failures=0).order_by('identifier')
+
+    def claim_in_thread():
+        try:
+            return db_utils.claim_batch(pending, 10, delivery_failures=1)
+        finally:
+            connection.close()
+
+    # a row that another transaction holds is skipped instead of waited for
+    with transaction.atomic():
+        locked = Node.objects.select_for_update().get(pk=nodes[0].pk)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            claimed = executor.submit(claim_in_thread).result()
+    assert {n.pk for n in claimed} == {n.pk for n in nodes[1:]}
+    assert all(n.delivery_failures == 1 for n in claimed)
+
+    # claimed rows no longer match
+    assert db_utils.claim_batch(pending, 10, delivery_failures=1) == [locked]
+    assert db_utils.claim_batch(pending, 10, delivery_failures=1) == []
+    assert Node.objects.filter(pk__in=[n.pk for n in nodes], delivery_failures=1).count() == 3
@@ -1,4 +1,40 @@
+import uuid
+from datetime import timedelta
 
+import pytest
+from django.utils import timezone
+
+from apps.core import identifier
+from apps.federation.file_transfer.models import TransferItem, TransferJob
+from apps.federation.file_transfer.tasks import create_downloads
+from apps.project.models import Project
+from apps.storage.models import File
+from apps.utils import get_user_node
 
 
 # def test_aria2_file_transfer():
+
+
+@pytest.mark.django_db
+def test_create_downloads_claims_items(setup, settings):
+    settings.FILE_TRANSFER_BATCH_SIZE = 2
+    node = get_user_node()
+    project = Project.objects.create(created_by=node, origin=node, name='project',
+                                     identifier=identifier.create_random('project'))
+    job = TransferJob.objects.create(project=project, created_by=node)
+    items = [TransferItem.objects.create(transfer_job=job, created_by=node, download_folder=str(uuid.uuid4()),
+                                         file=File.objects.create(identifier=identifier.create_random('file'),
+                                                                  name=f'{i}', origin=node, size=10))
+             for i in range(5)]
+    # claimed by another worker
+    TransferItem.objects.filter(pk=items[0].pk).update(claimed_at=timezone.now())
+    # claimed by a worker that died
+    TransferItem.objects.filter(pk=items[1].pk).update(
+        claimed_at=timezone.now() - timedelta(seconds=settings.FILE_TRANSFER_CLAIM_TIMEOUT + 1))
+
+    create_downloads()
+
+    # files of this node are not downloaded. the claim is released with the new status.
+    completed = TransferItem.objects.filter(status=TransferItem.Status.COMPLETE, claimed_at__isnull=True)
+    assert set(completed.values_list('pk', flat=True)) == {i.pk for i in items[1:]}
+    assert TransferItem.objects.get(pk=items[0].pk).status == TransferItem.Status.PENDING
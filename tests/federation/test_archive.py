@@ -0,0 +1,59 @@
+from datetime import timedelta
+from unittest import mock
+
+import pytest
+from django.core.management import call_command
+from django.utils import timezone
+
+from apps.federation import archive
+from apps.federation.inbox.models import InboxMessage
+from apps.federation.outbox.models import OutboxMessage
+from apps.federation.tasks import archive_messages
+from apps.utils import get_user_node
+
+
+@pytest.mark.django_db
+def test_archive_messages(setup, settings, tmp_path, remote_profile):
+    settings.FEDERATION_ARCHIVE_DIR = tmp_path
+    settings.FEDERATION_ARCHIVE_BATCH_SIZE = 2
+    settings.FEDERATION_PAYLOAD_DIR = tmp_path / 'payloads'
+    sender, recipient = remote_profile(), get_user_node()
+    messages = [InboxMessage.objects.create(sender=sender, recipient=recipient, processed=processed,
+                                            message={'object': {'type': 'share', 'content': {'i': i}}},
+                                            extra_data={'i': i})
+                for i, processed in enumerate([True, True, True, False])]
+    outbox = OutboxMessage.objects.create(sender=recipient, recipient=sender, processed=True, message={'i': 0},
+                                          response_body='created')
+    recent = InboxMessage.objects.create(sender=sender, recipient=recipient, processed=True, message={'i': 5})
+    now = timezone.now()
+    for i, message in enumerate(messages):
+        InboxMessage.objects.filter(pk=message.pk).update(date_created=now - timedelta(days=100 - i * 40))
+    OutboxMessage.objects.filter(pk=outbox.pk).update(date_created=now - timedelta(days=40))
+
+    assert archive_messages(days=30) == {'inbox.InboxMessage': 2, 'outbox.OutboxMessage': 1, 'payloads': 0}
+
+    # the third message is not old enough, the fourth not processed
+    archived = InboxMessage.objects.filter(archive__isnull=False).order_by('date_created')
+    assert [m.pk for m in archived] == [m.pk for m in messages[:2]]
+    assert all(m.message == {} and m.extra_data is None for m in archived)
+    # partitioned by month
+    assert archived[0].archive.startswith(f'inbox/{(now - timedelta(days=100)):%Y-%m}/')
+    assert len(list(tmp_path.glob('inbox/*/*.jsonl.zst'))) == 2
+    assert InboxMessage.objects.get(pk=recent.pk).message == {'i': 5}
+    outbox.refresh_from_db()
+    assert outbox.is_archived and outbox.response_body is None
+
+    archived[1].restore()
+    restored = InboxMessage.objects.get(pk=messages[1].pk)
+    assert not restored.is_archived
+    assert restored.message == messages[1].message and restored.extra_data == {'i': 1}
+
+    with mock.patch('apps.federation.management.commands.replay_message.send_outbox_message') as send:
+        call_command('replay_message', outbox.id_as_str)
+    send.assert_called_once_with(outbox.id_as_str)
+    outbox.refresh_from_db()
+    assert outbox.message == {'i': 0} and outbox.response_body == 'created'
+
+    (tmp_path / archived[0].archive).unlink()
+    with pytest.raises(archive.ArchivedMessageNotFound):
+        archived[0].restore()
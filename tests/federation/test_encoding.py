@@ -0,0 +1,49 @@
+import io
+import json
+import uuid
+
+import pytest
+import zstandard
+from django.urls import reverse
+
+from apps.federation import encoding
+from apps.federation.inbox.models import InboxMessage
+from apps.node.models import Node
+from apps.user.user_profile.models import Profile
+from apps.utils import get_user_node
+
+
+def test_encode_json(settings):
+    settings.FEDERATION_COMPRESS_MIN_SIZE = 100
+    payload = {'content': 'a,b\n' * 100}
+
+    content, headers = encoding.encode_json(payload, encoding.parse_accept_encoding('gzip;q=1.0, br, zstd;q=0'))
+    assert headers['content-encoding'] == 'gzip'
+    assert json.load(encoding.decompress_stream(io.BytesIO(content), 'gzip')) == payload
+
+    content, headers = encoding.encode_json({'content': 'small'}, ['zstd'])
+    assert 'content-encoding' not in headers and json.loads(content) == {'content': 'small'}
+    _, headers = encoding.encode_json(payload, [])
+    assert 'content-encoding' not in headers
+
+
+@pytest.mark.django_db
+def test_inbox_accepts_compressed_body(setup, client, user):
+    node = Node.objects.create(identifier=uuid.uuid4().hex, did=uuid.uuid4().hex)
+    sender = Profile.objects.create(identifier=node.identifier, identity=uuid.uuid4().hex, node=node)
+    recipient = get_user_node()
+    payload = {'from': node.identifier, 'to': recipient.node.identifier,
+               'object': {'sender': sender.identifier, 'recipient': recipient.identifier,
+                          'content': 'a,b\n' * 1000}}
+    body = zstandard.ZstdCompressor().compress(json.dumps(payload).encode())
+
+    response = client.post(reverse('inbox'), data=body, content_type='application/json', HTTP_CONTENT_ENCODING='zstd')
+    assert response.status_code == 201
+    assert response['Accept-Encoding'] == 'zstd, gzip'
+    assert InboxMessage.objects.get().message == payload
+    # the size of the decoded message, not the compressed content length
+    assert InboxMessage.objects.get().size == len(json.dumps(payload).encode()) > len(body)
+
+    response = client.post(reverse('inbox'), data=body, content_type='application/json', HTTP_CONTENT_ENCODING='br')
+    assert response.status_code == 415
+    assert InboxMessage.objects.count() == 1
@@ -0,0 +1,267 @@
+import uuid
+from datetime import timedelta
+from unittest import mock
+
+import pytest
+from celery.exceptions import SoftTimeLimitExceeded
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from apps.federation.inbox import cache, tasks
+from apps.federation.inbox.models import InboxMessage
+from apps.federation.inbox.views import InboxBatchView
+from apps.federation.models import Message
+from apps.node.models import Node
+from apps.user.user_profile.models import Profile
+from apps.utils import get_user_node
+
+
+def payload(sender, recipient, **object):
+    return {'from': sender.node.identifier, 'to': recipient.node.identifier,
+            'object': {'sender': sender.identifier, 'recipient': recipient.identifier, **object}}
+
+
+@pytest.mark.django_db
+def test_profile_cache(setup, remote_profile):
+    sender = remote_profile()
+    assert cache.get_profile(sender.identifier, sender.node.identifier) == sender
+    with CaptureQueriesContext(connection) as queries:
+        assert cache.get_profile(sender.identifier, sender.node.identifier).node == sender.node
+        assert cache.get_node_by_common_name(sender.node.common_name) == sender.node
+        assert cache.get_node_by_common_name(sender.node.common_name) == sender.node
+    assert len(queries) == 1
+
+    # saving a profile or node clears the cache
+    sender.node.identifier = uuid.uuid4().hex
+    sender.node.save()
+    with pytest.raises(Profile.DoesNotExist):
+        cache.get_profile(sender.identifier, sender.identifier)
+    assert cache.get_profile(sender.identifier, sender.node.identifier) == sender
+    with pytest.raises(Node.DoesNotExist):
+        cache.get_node_by_common_name('unknown')
+
+
+@pytest.mark.django_db
+def test_inbox_batch(setup, client, user, settings, remote_profile):
+    settings.FEDERATION_INBOX_MAX_BATCH = 3
+    sender, recipient = remote_profile(), get_user_node()
+    messages = [payload(sender, recipient, type='ack'), payload(sender, recipient, type='share', content={}),
+                {**payload(sender, recipient), 'from': 'unknown'}]
+
+    with mock.patch.object(InboxMessage, 'process') as process:
+        response = client.post(reverse('inbox-batch'), data=messages, content_type='application/json')
+
+    assert response.status_code == 201
+    results = response.json()['messages']
+    assert [r['status'] for r in results] == [201, 201, 404]
+    assert process.call_count == 2
+    stored = {m.message_type: m for m in InboxMessage.objects.all()}
+    assert set(stored) == {'ack', 'share'}
+    assert stored['ack'].box == Message.Box.INBOX and stored['ack'].priority == Message.Priority.CONTROL
+    assert results[0]['location'].endswith(f'/message/{stored["ack"].id_as_str}')
+    # the same size as if the message was sent alone
+    assert stored['ack'].size == InboxMessage.get_size(messages[0])
+
+    response = client.post(reverse('inbox-batch'), data=messages * 2, content_type='application/json')
+    assert response.status_code == 400
+    response = client.post(reverse('inbox-batch'), data=messages[0], content_type='application/json')
+    assert response.status_code == 400
+
+
+@pytest.mark.django_db
+def test_inbox_duplicate(setup, client, user, remote_profile):
+    sender, recipient = remote_profile(), get_user_node()
+    message = {**payload(sender, recipient, type='share', content={}), 'id': uuid.uuid4().hex}
+
+    with mock.patch.object(InboxMessage, 'process') as process:
+        responses = [client.post(reverse('inbox'), data=message, content_type='application/json',
+                                 HTTP_X_MESSAGE_ID=message['id']) for _ in range(2)]
+        # the id in the header must match the id of the message
+        mismatch = client.post(reverse('inbox'), data=message, content_type='application/json',
+                               HTTP_X_MESSAGE_ID=uuid.uuid4().hex)
+
+        # the ids are unique per sender, so another sender can use the same id
+        other = remote_profile()
+        other_message = {**payload(other, recipient, type='share', content={}), 'id': message['id']}
+        responses.append(client.post(reverse('inbox'), data=other_message, content_type='application/json'))
+
+        # a node can neither replay nor send the messages of another node
+        certificate = f'Subject%3D%22CN%3D{other.node.common_name}%22'
+        forged = APIClient().post(reverse('inbox'), data=message, format='json',
+                                  HTTP_X_FORWARDED_TLS_CLIENT_CERT_INFO=certificate)
+
+    assert [r.status_code for r in responses] == [201, 201, 201]
+    assert [r.get('Idempotent-Replayed') for r in responses] == [None, 'true', None]
+    assert responses[0]['Location'] == responses[1]['Location'] != responses[2]['Location']
+    assert mismatch.status_code == 400
+    assert forged.status_code == 403
+    assert process.call_count == 2
+    assert InboxMessage.objects.filter(message_id=message['id']).count() == 2
+
+
+@pytest.mark.django_db
+def test_inbox_batch_duplicate(setup, client, user, remote_profile):
+    sender, recipient = remote_profile(), get_user_node()
+    ids = [uuid.uuid4().hex for _ in range(3)]
+    received = InboxMessage.objects.create(sender=sender, recipient=recipient, message_id=ids[0],
+                                           message=payload(sender, recipient, type='ack'))
+    messages = [{**payload(sender, recipient, type='ack'), 'id': i} for i in [ids[0], ids[1], ids[1], ids[2]]]
+
+    with mock.patch.object(InboxMessage, 'process'):
+        response = client.post(reverse('inbox-batch'), data=messages, content_type='application/json')
+
+    results = response.json()['messages']
+    assert [r['status'] for r in results] == [201] * 4
+    assert [r.get('replayed', False) for r in results] == [True, False, True, False]
+    assert results[0]['location'].endswith(f'/message/{received.id_as_str}')
+    assert results[1]['location'] == results[2]['location']
+    assert InboxMessage.objects.count() == 3
+
+    # a message that was received concurrently is skipped by the insert
+    race = InboxMessage(sender=sender, recipient=recipient, message_id=ids[2], box=Message.Box.INBOX)
+    InboxMessage.objects.bulk_create([race], ignore_conflicts=True)
+    assert InboxBatchView.get_skipped([race]) == {(sender.pk, ids[2])}
+    assert InboxMessage.objects.count() == 3
+
+
+def create_inbox_messages(sender, recipient, types):
+    return [InboxMessage.objects.create(sender=sender, recipient=recipient, message=payload(sender, recipient, type=t),
+                                        priority=InboxMessage.get_priority({'object': {'type': t}}))
+            for t in types]
+
+
+@pytest.mark.django_db
+def test_process_inbox_shard(setup, settings, remote_profile):
+    settings.FEDERATION_INBOX_BATCH_SIZE = 2
+    recipient = get_user_node()
+    sender = remote_profile()
+    messages = create_inbox_messages(sender, recipient, ['share', 'ack', 'project', 'ack'])
+    shard = InboxMessage.get_shard(sender.pk)
+    assert {m.shard for m in messages} == {shard}
+
+    processed = []
+
+    def process(message, **kwargs):
+        if message.object.type == 'project':
+            raise ValueError('failed')
+        processed.append(kwargs['inbox_message'].pk)
+
+    # the shard is processed by a worker on another connection
+    other = connection.get_new_connection(connection.get_connection_params())
+    try:
+        with other.cursor() as cursor:
+            cursor.execute('select pg_advisory_lock(hashtext(%s), %s)', [tasks.SHARD_LOCK, shard])
+        with mock.patch.object(InboxMessage, 'get_model', return_value=(process, {})):
+            tasks.process_inbox_shard(shard)
+        assert processed == []
+        # closing the connection releases the lock asynchronously
+        with other.cursor() as cursor:
+            cursor.execute('select pg_advisory_unlock(hashtext(%s), %s)', [tasks.SHARD_LOCK, shard])
+    finally:
+        other.close()
+
+    other_sender = remote_profile()
+    others = create_inbox_messages(other_sender, recipient, ['ack'])
+    InboxMessage.objects.filter(pk=others[0].pk).update(shard=shard)
+    with mock.patch.object(InboxMessage, 'get_model', return_value=(process, {})):
+        tasks.process_inbox_shard(shard)
+
+    # in the order they were received. the failed message blocks the following messages of its sender only.
+    assert processed == [messages[0].pk, messages[1].pk, others[0].pk]
+    failed = InboxMessage.objects.get(pk=messages[2].pk)
+    assert not failed.processed and not failed.processing and failed.tries == 1
+    assert not InboxMessage.objects.filter(processing=True).exists()
+
+    # the next run processes the blocked message once the failed one succeeds
+    processed.clear()
+    with mock.patch.object(InboxMessage, 'get_model', return_value=(lambda message, **kwargs: processed.append(
+            kwargs['inbox_message'].pk), {})):
+        tasks.process_inbox_shard(shard)
+    assert processed == [messages[2].pk, messages[3].pk]
+    assert InboxMessage.objects.filter(processed=True, processed_at__isnull=False).count() == 5
+
+
+@pytest.mark.django_db
+def test_process_inbox_shard_gives_up(setup, settings, remote_profile):
+    settings.FEDERATION_INBOX_MAX_TRIES = 2
+    sender = remote_profile()
+    messages = create_inbox_messages(sender, get_user_node(), ['project', 'ack'])
+    shard = messages[0].shard
+    processed = []
+
+    def process(message, **kwargs):
+        if message.object.type == 'project':
+            raise ValueError('failed')
+        processed.append(kwargs['inbox_message'].pk)
+
+    with mock.patch.object(InboxMessage, 'get_model', return_value=(process, {})):
+        tasks.process_inbox_shard(shard)
+        # the failed message blocks the following message until it is given up on
+        assert processed == []
+        tasks.process_inbox_shard(shard)
+        assert processed == [messages[1].pk]
+    assert InboxMessage.objects.get(pk=messages[0].pk).tries == 2
+
+
+@pytest.mark.django_db
+def test_pending_inbox_messages(setup, settings, remote_profile):
+    settings.FEDERATION_INBOX_CLAIM_TIMEOUT = 60
+    settings.FEDERATION_INBOX_MAX_TRIES = 2
+    sender = remote_profile()
+    messages = create_inbox_messages(sender, get_user_node(), ['ack'] * 5)
+    now = timezone.now()
+    InboxMessage.objects.filter(pk=messages[1].pk).update(processing=True, claimed_at=now)
+    # the worker of this claim was killed
+    InboxMessage.objects.filter(pk=messages[2].pk).update(processing=True, claimed_at=now - timedelta(seconds=61))
+    InboxMessage.objects.filter(pk=messages[3].pk).update(tries=2)
+    InboxMessage.objects.filter(pk=messages[4].pk).update(processed=True)
+
+    assert set(InboxMessage.pending().values_list('pk', flat=True)) == {messages[0].pk, messages[2].pk}
+
+    # a worker that hits the time limit releases the rest of its batch
+    def process(message, **kwargs):
+        raise SoftTimeLimitExceeded()
+
+    with mock.patch.object(InboxMessage, 'get_model', return_value=(process, {})), \
+            pytest.raises(SoftTimeLimitExceeded):
+        tasks.process_inbox_shard(InboxMessage.get_shard(sender.pk))
+    released = InboxMessage.objects.get(pk=messages[0].pk)
+    assert not released.processing and released.tries == 1
+    assert set(InboxMessage.pending().values_list('pk', flat=True)) == {messages[0].pk, messages[2].pk}
+
+
+@pytest.mark.django_db
+def test_process_inbox_messages(setup, settings, remote_profile):
+    recipient = get_user_node()
+    senders = [remote_profile() for _ in range(20)]
+    for sender in senders:
+        create_inbox_messages(sender, recipient, ['share'])
+    create_inbox_messages(senders[0], recipient, ['ack'])
+
+    with mock.patch.object(tasks.process_inbox_shard, 'apply_async') as process_shard:
+        tasks.process_inbox_messages()
+
+    calls = [(c.args[0][0], c.kwargs['queue']) for c in process_shard.call_args_list]
+    assert sorted(shard for shard, _ in calls) == sorted({InboxMessage.get_shard(s.pk) for s in senders})
+    assert calls[0] == (InboxMessage.get_shard(senders[0].pk), settings.FEDERATION_QUEUE_CONTROL)
+
+
+@pytest.mark.django_db
+def test_inbox_metrics(setup, admin_client, remote_profile):
+    recipient = get_user_node()
+    sender = remote_profile()
+    messages = create_inbox_messages(sender, recipient, ['ack', 'ack', 'share'])
+    InboxMessage.objects.filter(pk__in=[m.pk for m in messages[:2]]).update(
+        processed=True, processed_at=messages[2].date_created + timedelta(seconds=2))
+
+    metrics = admin_client.get(reverse('inbox-metrics')).json()
+
+    shard = InboxMessage.get_shard(sender.pk)
+    assert [(s['shard'], s['pending']) for s in metrics['shards']] == [(shard, 1)]
+    assert [(s['priority'], s['pending']) for s in metrics['lanes']] == [(Message.Priority.BULK, 1)]
+    latency = metrics['latency']['lanes']
+    assert len(latency) == 1 and latency[0]['priority'] == Message.Priority.CONTROL and latency[0]['processed'] == 2
+    assert 2 <= latency[0]['p50'] <= latency[0]['max'] < 10
@@ -0,0 +1,205 @@
+import json
+import subprocess
+from datetime import timedelta
+from unittest import mock
+
+import httpx
+import pytest
+import zstandard
+from django.utils import timezone
+
+from apps.federation import payload
+from apps.federation.messages import AckObject, ShareObject
+from apps.federation.outbox import backends
+from apps.federation.outbox.models import OutboxMessage
+from apps.federation.outbox.tasks import process_outbox_messages, send_outbox_message, send_outbox_messages_to_node
+from apps.node.models import Node
+from apps.utils import get_user_node
+
+
+@pytest.fixture
+def client_certificate(tmp_path, settings):
+    key, cert = tmp_path / 'key.pem', tmp_path / 'cert.pem'
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', str(key), '-out',
+                    str(cert), '-subj', '/CN=test', '-days', '1'], check=True, capture_output=True)
+    settings.DSF_CERTIFICATE = str(cert)
+    settings.DSF_CERTIFICATE_PRIVATE_KEY = str(key)
+    settings.DECENTRALIZED_BACKEND = 'apps.federation.outbox.backends.CentauronAdapter'
+    yield
+    backends.close_clients()
+
+
+def create_messages(recipient, n):
+    return [OutboxMessage.create(sender=get_user_node(), recipient=recipient,
+                                 message_object=ShareObject(content={'i': i})) for i in range(n)]
+
+
+@pytest.mark.django_db
+def test_send_outbox_messages_to_node(setup, settings, respx_mock, client_certificate, remote_profile):
+    settings.FEDERATION_OUTBOX_BATCH_SIZE = 2
+    recipient = remote_profile()
+    messages = create_messages(recipient, 5)
+    route = respx_mock.post(recipient.node.api_address).mock(
+        side_effect=[httpx.Response(201)] * 2 + [httpx.Response(400, text='invalid')] + [httpx.Response(201)] * 2)
+
+    send_outbox_messages_to_node(recipient.node.id_as_str)
+
+    assert route.call_count == 5
+    # every message carries its id, which is the id of the outbox message
+    assert [call.request.headers['x-message-id'] for call in route.calls] == [m.id_as_str for m in messages]
+    assert [m.message['id'] for m in messages] == [m.id_as_str for m in messages]
+    # all messages to the node share one client
+    assert list(backends._clients) == [recipient.node.id_as_str]
+    failed = OutboxMessage.objects.get(pk=messages[2].pk)
+    assert not failed.processed and not failed.processing
+    assert failed.status_code == 400 and failed.error == 'invalid'
+    assert failed.tries == 1 and failed.next_attempt_at > timezone.now()
+    assert OutboxMessage.objects.filter(processed=True, processing=False, status_code=201).count() == 4
+
+
+@pytest.mark.django_db
+def test_send_outbox_messages_to_unreachable_node(setup, respx_mock, client_certificate, remote_profile):
+    recipient = remote_profile()
+    messages = create_messages(recipient, 3)
+    route = respx_mock.post(recipient.node.api_address).mock(side_effect=httpx.ConnectError('unreachable'))
+
+    send_outbox_messages_to_node(recipient.node.id_as_str)
+
+    # the first message is scheduled for a retry, the others are not tried at all
+    assert route.call_count == 1
+    assert OutboxMessage.objects.filter(processed=False, processing=False).count() == 3
+    failed = OutboxMessage.objects.get(pk=messages[0].pk)
+    assert failed.error == 'unreachable' and failed.tries == 1 and failed.next_attempt_at > timezone.now()
+    assert OutboxMessage.objects.filter(tries=0, next_attempt_at__isnull=True).count() == 2
+
+
+@pytest.mark.django_db
+def test_node_circuit_breaker(setup, settings, respx_mock, client_certificate, remote_profile):
+    settings.FEDERATION_NODE_FAILURE_THRESHOLD = 2
+    recipient = remote_profile()
+    messages = create_messages(recipient, 3)
+    route = respx_mock.post(recipient.node.api_address).mock(
+        side_effect=[httpx.ConnectError('unreachable'), httpx.Response(503), httpx.Response(201)])
+
+    for message in messages:
+        send_outbox_message(message.id_as_str)
+
+    # the second failure pauses the node. the third message is not sent but waits for the end of the pause.
+    assert route.call_count == 2
+    node = Node.objects.get(pk=recipient.node.pk)
+    assert node.is_paused and node.delivery_failures == 2
+    paused = OutboxMessage.objects.get(pk=messages[2].pk)
+    assert paused.tries == 0 and paused.next_attempt_at == node.paused_until
+    assert OutboxMessage.objects.get(pk=messages[1].pk).next_attempt_at >= node.paused_until
+    with mock.patch.object(send_outbox_messages_to_node, 'apply_async') as to_node:
+        process_outbox_messages()
+    to_node.assert_not_called()
+
+    # the pause is over. a successful delivery closes the circuit.
+    OutboxMessage.objects.update(next_attempt_at=None)
+    Node.objects.filter(pk=node.pk).update(paused_until=timezone.now())
+    send_outbox_message(messages[2].id_as_str)
+    node.refresh_from_db()
+    assert node.delivery_failures == 0 and node.paused_until is None
+    assert OutboxMessage.objects.get(pk=messages[2].pk).processed
+
+
+@pytest.mark.django_db
+def test_send_expired_claim(setup, settings, respx_mock, client_certificate, remote_profile):
+    settings.FEDERATION_OUTBOX_CLAIM_TIMEOUT = 60
+    recipient = remote_profile()
+    messages = create_messages(recipient, 2)
+    # the worker that claimed the first message was killed, the second one is being sent
+    OutboxMessage.objects.filter(pk=messages[0].pk).update(processing=True,
+                                                           claimed_at=timezone.now() - timedelta(seconds=61))
+    OutboxMessage.objects.filter(pk=messages[1].pk).update(processing=True, claimed_at=timezone.now())
+    route = respx_mock.post(recipient.node.api_address).mock(return_value=httpx.Response(201))
+
+    send_outbox_messages_to_node(recipient.node.id_as_str)
+
+    assert route.call_count == 1
+    assert [m.processed for m in OutboxMessage.objects.filter(pk__in=[m.pk for m in messages])
+            .order_by('date_created')] == [True, False]
+
+
+@pytest.mark.django_db
+def test_process_outbox_messages(setup, settings, remote_profile):
+    node = get_user_node()
+    recipients = [remote_profile(), remote_profile()]
+    for recipient in recipients:
+        create_messages(recipient, 2)
+    OutboxMessage.create(sender=node, recipient=recipients[0], message_object=AckObject())
+    local = create_messages(node, 1)[0]
+
+    with mock.patch.object(send_outbox_messages_to_node, 'apply_async') as to_node, \
+            mock.patch.object(send_outbox_message, 'apply_async') as single:
+        process_outbox_messages()
+
+    # one task per node and lane, the control lane first
+    calls = [(c.args[0], c.kwargs['queue']) for c in to_node.call_args_list]
+    assert calls[0] == ((recipients[0].node.id_as_str, OutboxMessage.Priority.CONTROL),
+                        settings.FEDERATION_QUEUE_CONTROL)
+    assert set(calls[1:]) == {((r.node.id_as_str, OutboxMessage.Priority.BULK), settings.FEDERATION_QUEUE_BULK)
+                              for r in recipients}
+    single.assert_called_once_with((local.id_as_str,), queue=settings.FEDERATION_QUEUE_BULK)
+
+
+@pytest.mark.django_db
+def test_send_outbox_messages_to_node_lane(setup, respx_mock, client_certificate, remote_profile):
+    recipient = remote_profile()
+    create_messages(recipient, 2)
+    ack = OutboxMessage.create(sender=get_user_node(), recipient=recipient, message_object=AckObject())
+    route = respx_mock.post(recipient.node.api_address).mock(return_value=httpx.Response(201))
+
+    send_outbox_messages_to_node(recipient.node.id_as_str, OutboxMessage.Priority.CONTROL)
+
+    assert route.call_count == 1
+    assert list(OutboxMessage.objects.filter(processed=True)) == [ack]
+
+
+@pytest.mark.django_db
+def test_send_outbox_message_compressed(setup, settings, respx_mock, client_certificate, remote_profile):
+    settings.FEDERATION_COMPRESS_MIN_SIZE = 100
+    recipient = remote_profile()
+    messages = [OutboxMessage.create(sender=get_user_node(), recipient=recipient,
+                                     message_object=ShareObject(content={'files': 'a,b\n' * 1000}))
+                for _ in range(3)]
+    route = respx_mock.post(recipient.node.api_address).mock(side_effect=[
+        httpx.Response(201, headers={'Accept-Encoding': 'zstd, gzip'}),
+        httpx.Response(201, headers={'Accept-Encoding': 'gzip'}),
+        httpx.Response(415, headers={'Accept-Encoding': 'identity'}),
+        httpx.Response(201),
+    ])
+
+    # the first message is sent uncompressed. the node answers with the encodings it accepts.
+    for message in messages:
+        send_outbox_message(message.id_as_str)
+
+    requests = [call.request for call in route.calls]
+    assert [r.headers.get('content-encoding') for r in requests] == [None, 'zstd', 'gzip', None]
+    assert json.loads(zstandard.ZstdDecompressor().decompress(requests[1].content)) == messages[1].message
+    recipient.node.refresh_from_db()
+    assert recipient.node.capabilities == {'content_encodings': []}
+    assert OutboxMessage.objects.filter(processed=True).count() == 3
+
+
+@pytest.mark.django_db
+def test_send_outbox_message_offloaded(setup, settings, respx_mock, client_certificate, tmp_path, remote_profile):
+    settings.FEDERATION_PAYLOAD_DIR = tmp_path
+    settings.FEDERATION_PAYLOAD_MIN_SIZE = 1000
+    recipient = remote_profile()
+    small, large = [OutboxMessage.create(sender=get_user_node(), recipient=recipient,
+                                         message_object=ShareObject(content={'files': 'a' * size}))
+                    for size in [10, 10_000]]
+    route = respx_mock.post(recipient.node.api_address).mock(return_value=httpx.Response(201))
+
+    for message in [small, large]:
+        send_outbox_message(message.id_as_str)
+
+    bodies = [json.loads(call.request.content) for call in route.calls]
+    assert bodies[0] == small.message
+    # the large message is sent as an envelope that references its payload file
+    assert 'content' not in bodies[1]['object'] and bodies[1]['id'] == large.id_as_str
+    large.refresh_from_db()
+    assert bodies[1][payload.PAYLOAD_REFERENCE_KEY]['sha256'] == large.payload
+    assert (tmp_path / payload.get_payload_name(large.payload)).exists()
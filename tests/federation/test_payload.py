@@ -0,0 +1,143 @@
+import uuid
+from unittest import mock
+
+import httpx
+import pytest
+from rest_framework.test import APIRequestFactory
+
+from apps.federation import payload
+from apps.federation.file_transfer.views import FileServeView
+from apps.federation.inbox import tasks
+from apps.federation.inbox.models import InboxMessage
+from apps.federation.messages import ShareObject
+from apps.federation.outbox.models import OutboxMessage
+from apps.share.package import CsvSection, PackageReader
+from apps.utils import get_user_node
+
+
+@pytest.fixture
+def payload_dir(settings, tmp_path):
+    settings.FEDERATION_PAYLOAD_DIR = tmp_path
+    settings.FEDERATION_PAYLOAD_MIN_SIZE = 1000
+    settings.CDN_ADDRESS = 'https://cdn.test/download/'
+    return tmp_path
+
+
+def create_message(recipient, size):
+    return OutboxMessage.create(sender=get_user_node(), recipient=recipient,
+                                message_object=ShareObject(content={
+                                    'files': ''.join(uuid.uuid4().hex for _ in range(size // 32))}))
+
+
+@pytest.mark.django_db
+def test_offload(setup, payload_dir, remote_profile):
+    recipient = remote_profile(common_name='recipient')
+    small = create_message(recipient, 10)
+    assert payload.offload(small) == small.message and small.payload is None
+
+    message = create_message(recipient, 10_000)
+    envelope = payload.offload(message)
+    reference = envelope[payload.PAYLOAD_REFERENCE_KEY]
+    assert message.payload == reference['sha256']
+    assert reference['url'] == f'https://cdn.test/download/?payload={message.payload}'
+    assert envelope['id'] == message.id_as_str
+    assert envelope['object'] == {k: v for k, v in message.message['object'].items() if k != 'content'}
+    path = payload_dir / payload.get_payload_name(message.payload)
+    assert path.stat().st_size == reference['size'] < 10_000
+    assert payload.get_file_sha256(path) == message.payload
+    assert PackageReader(path, reference).to_dict() == message.message['object']['content']
+
+    message.save()
+
+    def get(common_name, **headers):
+        request = APIRequestFactory().get('/download/', {'payload': message.payload},
+                                          HTTP_X_FORWARDED_TLS_CLIENT_CERT_INFO=f'Subject%3D%22CN%3D{common_name}%22',
+                                          **headers)
+        return FileServeView.as_view()(request)
+
+    content = path.read_bytes()
+    response = get('recipient')
+    assert response.status_code == 200
+    assert b''.join(response.streaming_content) == content
+    response = get('recipient', HTTP_RANGE='bytes=10-')
+    assert response.status_code == 206
+    assert response['Content-Range'] == f'bytes 10-{len(content) - 1}/{len(content)}'
+    assert b''.join(response.streaming_content) == content[10:]
+    remote_profile(common_name='other')
+    assert get('other').status_code == 403
+
+
+@pytest.mark.django_db
+def test_fetch_payload(setup, payload_dir, respx_mock, remote_profile):
+    message = create_message(remote_profile(common_name='recipient'), 10_000)
+    envelope = payload.offload(message)
+    reference = envelope[payload.PAYLOAD_REFERENCE_KEY]
+    content = (payload_dir / payload.get_payload_name(message.payload)).read_bytes()
+    # the connection drops after the first 100 bytes, the next attempt requests the rest
+    received = payload_dir / payload.RECEIVED_DIR / f'{payload.get_payload_name(message.payload)}.download'
+    received.parent.mkdir()
+
+    def serve(request):
+        if 'range' not in request.headers:
+            received.write_bytes(content[:100])
+            raise httpx.ReadError('connection lost')
+        offset = int(request.headers['range'][len('bytes='):-1])
+        return httpx.Response(206, content=content[offset:])
+
+    route = respx_mock.get(reference['url']).mock(side_effect=serve)
+
+    with httpx.Client() as client:
+        reader = payload.fetch_payload(envelope, client)
+    assert reader.to_dict() == message.message['object']['content']
+    assert [call.request.headers.get('range') for call in route.calls] == [None, 'bytes=100-']
+    assert not received.exists()
+
+    # a verified payload is not downloaded again, e.g. by the next try of the message
+    with httpx.Client() as client:
+        assert payload.fetch_payload(envelope, client).path == reader.path
+    assert route.call_count == 2
+
+    # a corrupt download is discarded and downloaded again by the next try
+    reader.path.unlink()
+    respx_mock.get(reference['url']).mock(return_value=httpx.Response(200, content=b'corrupt'))
+    with httpx.Client() as client, pytest.raises(payload.PayloadException):
+        payload.fetch_payload(envelope, client)
+    assert not received.exists() and not reader.path.exists()
+
+    # a download that fails before anything was received is retried
+    respx_mock.get(reference['url']).mock(side_effect=httpx.ConnectError('refused'))
+    with httpx.Client() as client, pytest.raises(httpx.ConnectError):
+        payload.fetch_payload(envelope, client)
+
+
+@pytest.mark.django_db
+def test_process_offloaded_message(setup, payload_dir, remote_profile):
+    sender = remote_profile(common_name='sender')
+    message = create_message(get_user_node(), 10_000)
+    envelope = payload.offload(message)
+    inbox_message = InboxMessage.objects.create(sender=sender, recipient=get_user_node(), message=envelope,
+                                                processing=True)
+    process = mock.Mock()
+    received = PackageReader(payload_dir / payload.get_payload_name(message.payload),
+                             envelope[payload.PAYLOAD_REFERENCE_KEY])
+
+    def check_content(**kwargs):
+        # the csv sections of a share are streamed
+        files = kwargs['message'].object.content['files']
+        assert isinstance(files, CsvSection)
+        with files.open() as f:
+            assert f.read() == message.message['object']['content']['files']
+
+    process.side_effect = check_content
+    with mock.patch.object(payload, 'fetch_payload', return_value=received) as fetch_payload, \
+            mock.patch.object(tasks, 'get_client') as get_client, \
+            mock.patch.object(InboxMessage, 'get_model', return_value=(process, {})):
+        assert tasks.process_claimed_inbox_message(inbox_message)
+
+    assert fetch_payload.call_args.args == (envelope, get_client.return_value)
+    assert get_client.call_args.args == (sender.node,)
+    assert process.called
+    # the message stays the envelope and the received payload is removed
+    inbox_message.refresh_from_db()
+    assert inbox_message.processed and inbox_message.message == envelope
+    assert not received.path.exists()
@@ -0,0 +1,50 @@
+from unittest import mock
+
+import pytest
+from django.urls import reverse
+
+from apps.federation.inbox import tasks
+from apps.federation.inbox.models import InboxMessage
+from apps.federation.messages import AckObject, ShareObject
+from apps.federation.models import Message
+from apps.federation.outbox.models import OutboxMessage
+from apps.utils import get_user_node
+
+
+def test_get_priority(settings):
+    settings.FEDERATION_BULK_MIN_SIZE = 1000
+    assert Message.get_priority({'object': {'type': 'ack'}}) == Message.Priority.CONTROL
+    assert Message.get_priority({'object': {'type': 'project-invitation-response'}}) == Message.Priority.CONTROL
+    assert Message.get_priority({'object': {'type': 'share'}}) == Message.Priority.BULK
+    assert Message.get_priority({'object': {'type': 'project'}}) == Message.Priority.DEFAULT
+    assert Message.get_priority({'object': {'type': 'ack'}}, size=1000) == Message.Priority.BULK
+    assert Message.get_priority({'object': 'https://node/object/1'}) == Message.Priority.DEFAULT
+    assert Message.get_queue(Message.Priority.CONTROL) == settings.FEDERATION_QUEUE_CONTROL
+
+
+@pytest.mark.django_db
+def test_outbox_message_priority(setup, settings):
+    node = get_user_node()
+    ack = OutboxMessage.create(sender=node, recipient=node, message_object=AckObject())
+    share = OutboxMessage.create(sender=node, recipient=node, message_object=ShareObject(content={}))
+    assert ack.priority == Message.Priority.CONTROL and share.priority == Message.Priority.BULK
+    assert ack.queue == settings.FEDERATION_QUEUE_CONTROL
+
+
+@pytest.mark.django_db
+def test_inbox_message_lanes(setup, client, user, settings, django_capture_on_commit_callbacks, remote_profile):
+    sender, recipient = remote_profile(), get_user_node()
+
+    def post(object):
+        payload = {'from': sender.node.identifier, 'to': recipient.node.identifier,
+                   'object': {'sender': sender.identifier, 'recipient': recipient.identifier, **object}}
+        with django_capture_on_commit_callbacks(execute=True), \
+                mock.patch.object(tasks.process_inbox_shard, 'apply_async') as apply_async:
+            assert client.post(reverse('inbox'), data=payload, content_type='application/json').status_code == 201
+        return apply_async.call_args.kwargs['queue']
+
+    assert post({'type': 'ack'}) == settings.FEDERATION_QUEUE_CONTROL
+    assert post({'type': 'share', 'content': {}}) == settings.FEDERATION_QUEUE_BULK
+    assert post({'type': 'project'}) == settings.FEDERATION_QUEUE_DEFAULT
+    ack = InboxMessage.objects.filter(priority=Message.Priority.CONTROL).get()
+    assert ack.size > 0
@@ -0,0 +1,33 @@
+import json
+
+import pytest
+from django.core.management import call_command
+
+from apps.federation.outbox.models import OutboxMessage
+from apps.share.models import Share
+from apps.share.share_token.models import ShareToken
+from apps.storage.models import File
+
+
+@pytest.mark.django_db(transaction=True)
+def test_benchmark_shares(tmp_path):
+    call_command('setup_node')
+    output = tmp_path / 'benchmark.json'
+    call_command('benchmark_shares', '--sizes', '25', '--files-per-case', '5', '--codes', '3', '--output',
+                 str(output))
+
+    results = json.loads(output.read_text())['results']
+    assert len(results) == 1
+    result = results[0]
+    assert result['files'] == 25 and result['cases'] == 5
+    assert set(result['steps']) == {'generate', 'build', 'create_share', 'import_share'}
+    for step in result['steps'].values():
+        assert {'duration', 'queries', 'peak_rss_mb'} <= step.keys()
+    assert result['import_share']['steps']['publish']['rows'] > 0
+
+    # built, created and imported share. the import copied every file
+    assert Share.objects.count() == 3
+    assert File.objects.count() == 50
+    # the created share has a token, but nothing was sent
+    assert ShareToken.objects.count() == 1
+    assert not OutboxMessage.objects.exists()
@@ -0,0 +1,116 @@
+import uuid
+from functools import partial
+from unittest.mock import Mock
+
+import pytest
+from django.core.management import call_command
+from django.db import connection, transaction
+
+from apps.core import identifier
+from apps.core.db_utils import UnresolvedIdentifiersError
+from apps.federation.inbox.models import InboxMessage
+from apps.project.project_case.models import Case
+from apps.share.importer import ImportGraph
+from apps.share.metrics import Metrics
+from apps.share.models import Share
+from apps.storage.models import File
+from apps.utils import get_user_node
+
+
+def staging_tables():
+    with connection.cursor() as cursor:
+        cursor.execute("select count(*) from pg_tables where tablename like 'staging\\_%%'")
+        return cursor.fetchone()[0]
+
+
+def csv(origin, cases, files):
+    cases_csv = 'name,identifier,origin\n' + ''.join(f'{uuid.uuid4()},{c},{origin.identifier}\n' for c in cases)
+    files_csv = 'identifier,name,origin,case,size,original_filename,original_path\n' + ''.join(
+        f'{f},{f},{origin.identifier},{case},10,a,b\n' for f, case in files)
+    return cases_csv, files_csv
+
+
+@pytest.mark.django_db(transaction=True)
+def test_import_graph(settings):
+    settings.IMPORTER_CHUNK_SIZE = 2
+    call_command('setup_node')
+    origin = get_user_node()
+    share = Share.objects.create(name='share', origin=origin, created_by=origin)
+    cases = [identifier.create_random('case') for _ in range(3)]
+    files = [(identifier.create_random('file'), cases[i % 3]) for i in range(5)]
+    cases_csv, files_csv = csv(origin, cases, files)
+
+    metrics = Metrics()
+    graph = ImportGraph(metrics, {}) \
+        .add('cases', partial(Case.import_case, cases=cases_csv, share=share)) \
+        .add('files', partial(File.import_file, files=files_csv, share=share), depends_on=['cases']) \
+        .add('nothing', lambda: None)
+    graph.run(concurrent=True)
+
+    # the files resolved the staged cases, but nothing is published yet
+    assert Case.objects.count() == 0
+    assert File.objects.count() == 0
+    with transaction.atomic():
+        graph.publish()
+
+    assert staging_tables() == 0
+    assert metrics.steps['publish']['rows'] > 0
+    assert share.cases.count() == 3
+    assert {(f.identifier, f.case.identifier) for f in share.files.all()} == set(files)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_import_graph_failed_step():
+    call_command('setup_node')
+    origin = get_user_node()
+    share = Share.objects.create(name='share', origin=origin, created_by=origin)
+    cases_csv, files_csv = csv(origin, ['case-1'], [('file-1', 'unknown-case')])
+
+    graph = ImportGraph(Metrics(), {}) \
+        .add('cases', partial(Case.import_case, cases=cases_csv, share=share)) \
+        .add('files', partial(File.import_file, files=files_csv, share=share), depends_on=['cases'])
+    with pytest.raises(UnresolvedIdentifiersError):
+        graph.run(concurrent=True)
+
+    assert staging_tables() == 0
+    assert Case.objects.count() == 0
+
+    with pytest.raises(ValueError):
+        graph.add('codes', lambda: None, depends_on=['unknown'])
+
+
+@pytest.mark.django_db(transaction=True)
+def test_import_graph_resume():
+    call_command('setup_node')
+    origin = get_user_node()
+    share = Share.objects.create(name='share', origin=origin, created_by=origin)
+    inbox_message = InboxMessage.objects.create(sender=origin)
+    cases_csv, files_csv = csv(origin, ['case-1'], [('file-1', 'unknown-case')])
+
+    def build(files):
+        return ImportGraph(Metrics(), {}, checkpoint=lambda state: inbox_message.save_checkpoint(staging=state),
+                           state=InboxMessage.objects.get(pk=inbox_message.pk).checkpoint.get('staging')) \
+            .add('cases', cases) \
+            .add('files', partial(File.import_file, files=files, share=share), depends_on=['cases'])
+
+    cases = Mock(wraps=partial(Case.import_case, cases=cases_csv, share=share))
+    with pytest.raises(UnresolvedIdentifiersError):
+        build(files_csv).run()
+
+    # the staged cases survive the failure and are checkpointed
+    inbox_message.refresh_from_db()
+    assert inbox_message.checkpoint['staging']['completed'] == ['cases']
+    assert staging_tables() > 0
+
+    _, files_csv = csv(origin, [], [('file-1', 'case-1')])
+    graph = build(files_csv)
+    graph.run()
+    with transaction.atomic():
+        graph.publish()
+        inbox_message.save_checkpoint()
+
+    assert cases.call_count == 1
+    assert staging_tables() == 0
+    assert InboxMessage.objects.get(pk=inbox_message.pk).checkpoint == {}
+    assert share.cases.count() == 1
+    assert share.files.get().case.identifier == 'case-1'
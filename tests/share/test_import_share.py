@@ -84,7 +84,7 @@ def test_import_share():
     ExtraData.objects.filter().delete()
 
     message = Message(from_=created_by, to=recipient, hash='',
-                      object=ShareObject(content=share.content))
+                      object=ShareObject(content=share.get_content()))
 
     # import share
     Share.import_share(message=message)
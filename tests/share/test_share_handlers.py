@@ -0,0 +1,37 @@
+import uuid
+
+import pytest
+from django.core.management import call_command
+
+from apps.core import identifier
+from apps.project.project_case.models import Case
+from apps.share.api import Handler
+from apps.share.models import Share
+from apps.storage.models import File
+from apps.utils import get_user_node
+from tests import test_utils
+
+
+@pytest.mark.django_db
+def test_link():
+    call_command('setup_node')
+    created_by = test_utils.create_user('user1').profile
+    origin = get_user_node()
+    case = Case.objects.create(name='100% case', origin=origin, identifier=identifier.create_random('case'))
+    for i in range(5):
+        File.objects.create(case=case, identifier=identifier.create_random('file'), name=f'{i}%', origin=origin,
+                            size=10)
+    share = Share.objects.create(name=str(uuid.uuid4()), created_by=created_by, origin=origin,
+                                 identifier=identifier.create_random('share'))
+
+    handler = Handler()
+    handler.link(share, 'files', File.objects.filter(name__contains='%').exclude(name='0%'))
+    assert share.files.count() == 4
+    # linking again does not duplicate rows
+    handler.link(share, 'files', list(File.objects.all()))
+    assert share.files.count() == 5
+
+    handler.link(share, 'cases', Case.objects.filter(name__startswith='100%').values_list('id', flat=True))
+    handler.link(share, 'cases', [])
+    handler.link(share, 'cases', None)
+    assert list(share.cases.all()) == [case]
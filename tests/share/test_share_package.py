@@ -0,0 +1,432 @@
+import io
+import uuid
+from collections import namedtuple
+from unittest import mock
+
+import httpx
+import pandas
+import pytest
+from django.core.management import call_command
+from django.db import connection
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, APIClient
+
+from apps.core import identifier
+from apps.federation.file_transfer.views import FileServeView
+from apps.federation.outbox.models import OutboxMessage
+from apps.node.models import Node
+from apps.permission.models import Permission
+from apps.project.project_case.models import Case
+from apps.share.api import ShareBuilder, CodesHandler
+from apps.share.delta import DeltaException
+from apps.share.models import Share
+from apps.share.package import PackageWriter, PackageReader, PackageException, PACKAGE_REFERENCE_KEY, \
+    fetch_package, CsvSection
+from apps.share.planner import check_plan, statement_timeout, PlanTimeout
+from apps.share.share_token.models import ShareToken
+from apps.storage.models import File
+from apps.terminology.models import Code, CodeSystem
+from apps.user.user_profile.models import Profile
+from apps.utils import get_user_node
+from tests import test_utils
+
+
+@pytest.fixture
+def package_dir(settings, tmp_path):
+    settings.SHARE_PACKAGE_DIR = tmp_path
+    yield tmp_path
+
+
+def test_package_roundtrip(tmp_path):
+    path = tmp_path / 'test.pkg'
+    rows = ''.join(f'{i},{uuid.uuid4().hex}\n' for i in range(10_000))
+    with PackageWriter(path) as package:
+        package['identifier'] = 'node#share::1'
+        with package.section('files') as section:
+            section.write(b'id,name\n')
+            section.write(rows)
+        package['evaluation-code'] = [{'name': 'abc'}]
+
+    manifest = package.manifest
+    assert set(manifest['sections'].keys()) == {'identifier', 'files', 'evaluation-code'}
+    assert manifest['size'] == path.stat().st_size
+    assert manifest['sections']['files']['size'] == len('id,name\n' + rows)
+
+    reader = PackageReader(path, manifest)
+    assert reader.read('identifier') == 'node#share::1'
+    assert reader.read('evaluation-code') == [{'name': 'abc'}]
+    assert reader.read('files') == 'id,name\n' + rows
+    assert reader.get('cases') is None
+
+    with reader.open_text('files') as f:
+        df = pandas.read_csv(f)
+    assert len(df.index) == 10_000
+
+
+def test_package_checksum_mismatch(tmp_path):
+    path = tmp_path / 'test.pkg'
+    with PackageWriter(path) as package:
+        package['type'] = 'data-release'
+    manifest = package.manifest
+    manifest['sections']['type']['sha256'] = '0' * 64
+
+    with pytest.raises(PackageException):
+        PackageReader(path, manifest).read('type')
+
+
+@pytest.mark.django_db
+def test_build_share_into_package(package_dir):
+    call_command('setup_node')
+    created_by = test_utils.create_user('user1').profile
+    origin = get_user_node()
+    n_cases = 3
+    n_files = 4
+    for _ in range(n_cases):
+        case = Case.objects.create(name=str(uuid.uuid4()), origin=origin, identifier=identifier.create_random('case'))
+        for _ in range(n_files):
+            File.objects.create(case=case, identifier=identifier.create_random('file'), name=str(uuid.uuid4()),
+                                origin=origin, size=10)
+
+    files = File.objects.all()
+    share = ShareBuilder(None, str(uuid.uuid4()), created_by=created_by, type='data-release') \
+        .add_file_handler(data=files) \
+        .add_case_handler(data=Case.objects.all()) \
+        .build()
+
+    assert share.content == {}
+    assert share.has_package
+    assert (package_dir / share.package['path']).exists()
+
+    content = share.get_content()
+    assert content['identifier'] == share.identifier
+    assert content['type'] == 'data-release'
+    assert len(pandas.read_csv(io.StringIO(content['files'])).index) == n_cases * n_files
+    assert len(pandas.read_csv(io.StringIO(content['cases'])).index) == n_cases
+    assert share.files.count() == n_cases * n_files
+
+
+def test_package_append(tmp_path):
+    with PackageWriter(tmp_path / 'part.pkg') as part:
+        with part.section('cases') as section:
+            section.write('name\na\nb\n')
+    with PackageWriter(tmp_path / 'test.pkg') as package:
+        package['identifier'] = 'node#share::1'
+        package.append(part.path, part.manifest)
+
+    reader = PackageReader(package.path, package.manifest)
+    assert reader.read('identifier') == 'node#share::1'
+    assert reader.read('cases') == 'name\na\nb\n'
+    assert package.manifest['size'] == package.path.stat().st_size
+
+
+@pytest.mark.django_db(transaction=True)
+def test_build_share_concurrently(package_dir):
+    call_command('setup_node')
+    created_by = test_utils.create_user('user1').profile
+    origin = get_user_node()
+    for _ in range(3):
+        case = Case.objects.create(name=str(uuid.uuid4()), origin=origin, identifier=identifier.create_random('case'))
+        for _ in range(4):
+            File.objects.create(case=case, identifier=identifier.create_random('file'), name=str(uuid.uuid4()),
+                                origin=origin, size=10)
+
+    def build(concurrent):
+        return ShareBuilder(None, str(uuid.uuid4()), created_by=created_by, type='data-release') \
+            .add_file_handler(data=File.objects.all()) \
+            .add_case_handler(data=list(Case.objects.all())) \
+            .add_permission_handler(data=File.objects.values_list('identifier', flat=True)) \
+            .build(concurrent=concurrent)
+
+    sequential = build(concurrent=False)
+    concurrent = build(concurrent=True)
+
+    content = concurrent.get_content()
+    assert set(content.keys()) == set(sequential.get_content().keys())
+    assert content['cases'] == sequential.get_content()['cases']
+    assert content['files'] == sequential.get_content()['files']
+    assert concurrent.cases.count() == 3
+    assert concurrent.files.count() == 12
+    assert list(package_dir.glob('*.part')) == []
+
+
+@pytest.mark.django_db
+def test_build_share_concurrently_in_transaction(package_dir):
+    call_command('setup_node')
+    created_by = test_utils.create_user('user1').profile
+    origin = get_user_node()
+    file = File.objects.create(identifier=identifier.create_random('file'), name='file', origin=origin, size=10)
+    # the permission is not committed yet, so it would be missing in a snapshot exported to other connections
+    Permission.create_permissions(identifiers=[file.identifier], permission=Permission.Permission.ALLOW,
+                                  action='view', user_id=created_by.id_as_str, created_by_id=created_by.id_as_str)
+
+    share = ShareBuilder(None, 'share', created_by=created_by, type='data-release') \
+        .add_file_handler(data=File.objects.all()) \
+        .add_permission_handler(data=File.objects.values_list('identifier', flat=True)) \
+        .build(concurrent=True)
+
+    assert file.identifier in share.get_content()['permissions']
+    # the build fell back to sequential exports
+    assert not any(name.endswith('-export') for name in share.metrics['build']['steps'])
+
+
+@pytest.mark.django_db
+def test_build_delta_share(package_dir):
+    call_command('setup_node')
+    created_by = test_utils.create_user('user1').profile
+    origin = get_user_node()
+    files = [File.objects.create(identifier=identifier.create_random('file'), name=str(i), origin=origin, size=10,
+                                 original_filename=str(i), original_path=str(i)) for i in range(4)]
+
+    def build(selection, previous=None, recipients=None):
+        builder = ShareBuilder(None, str(uuid.uuid4()), created_by=created_by, type='data-release') \
+            .add_file_handler(data=File.objects.filter(id__in=[f.id for f in selection])) \
+            .add_permission_handler(data=[f.identifier for f in selection])
+        if previous is not None:
+            builder.set_previous_share(previous, recipients=recipients)
+        return builder.build()
+
+    previous = build(files[:3])
+    ShareToken.objects.create(share=previous, recipient=created_by, identifier=identifier.create_random('share_token'),
+                              created_by=created_by, valid_from=timezone.now(), valid_until=timezone.now())
+    files[1].name = 'changed'
+    files[1].save()
+    share = build(files[:2] + files[3:], previous=previous, recipients=[created_by])
+
+    content = share.get_content()
+    assert content['previous-identifier'] == str(previous.identifier)
+    # permissions are sent in full
+    assert content['delta']['keys'] == {'files': ['identifier']}
+    assert 'permissions' in content and 'permissions-removed' not in content
+    assert set(pandas.read_csv(io.StringIO(content['files']))['identifier']) == {files[1].identifier,
+                                                                                 files[3].identifier}
+    assert list(pandas.read_csv(io.StringIO(content['files-removed']))['identifier']) == [files[2].identifier]
+    # the full package is kept for the next delta
+    assert len(pandas.read_csv(share.open_snapshot().open_text('files')).index) == 3
+
+    # the receiver links the unchanged files of the previous share
+    received = Share.objects.create(name='received', created_by=created_by, origin=origin)
+    received.apply_delta(content['delta'], content)
+    assert set(received.files.all()) == {files[0], files[1]}
+
+    # the changed files are updated
+    File.objects.filter(pk=files[1].pk).update(name='1')
+    File.import_file(files=content['files'], update=True, share=received)
+    files[1].refresh_from_db()
+    assert files[1].name == 'changed'
+
+    # a recipient without the previous share gets a full share
+    other = Profile.objects.create(identifier=uuid.uuid4().hex, identity=uuid.uuid4().hex)
+    assert 'delta' not in build(files, previous=share, recipients=[created_by, other]).get_content()
+
+    received.delete()
+    with pytest.raises(DeltaException):
+        Share.objects.create(name='received', created_by=created_by, origin=origin).apply_delta(
+            {'previous-identifier': str(identifier.create_random('share'))}, {})
+
+
+@pytest.mark.django_db
+def test_send_share_by_reference(package_dir, settings, respx_mock):
+    settings.CDN_ADDRESS = 'https://cdn.test/download/'
+    call_command('setup_node')
+    created_by = test_utils.create_user('user1').profile
+    origin = get_user_node()
+    case = Case.objects.create(name=str(uuid.uuid4()), origin=origin, identifier=identifier.create_random('case'))
+    share = ShareBuilder(None, str(uuid.uuid4()), created_by=created_by, type='data-release') \
+        .add_case_handler(data=Case.objects.filter(pk=case.pk)) \
+        .build()
+    sha256 = share.package['sha256']
+    assert share.package['path'] == f'{sha256}.pkg'
+
+    reference = share.get_reference()[PACKAGE_REFERENCE_KEY]
+    assert reference['url'] == f'https://cdn.test/download/?package={sha256}'
+    # the package is already stored, so nothing is downloaded. the identifier is sent with the reference.
+    assert share.get_reference()['identifier'] == str(share.identifier)
+    assert {'identifier': str(share.identifier), **fetch_package(reference).to_dict()} == share.get_content()
+
+    # a share with the same content has the same package
+    other = ShareBuilder(None, str(uuid.uuid4()), created_by=created_by, type='data-release') \
+        .add_case_handler(data=Case.objects.filter(pk=case.pk)) \
+        .build()
+    assert other.package['sha256'] == sha256
+    assert other.get_content()['identifier'] == str(other.identifier)
+
+    # a corrupt stored package is downloaded again
+    content = (package_dir / f'{sha256}.pkg').read_bytes()
+    (package_dir / f'{sha256}.pkg').write_bytes(b'corrupt')
+    respx_mock.get(reference['url']).mock(return_value=httpx.Response(200, content=content))
+    client = httpx.Client
+    # the certificate of the node is not needed
+    with mock.patch.object(httpx, 'Client', lambda **kwargs: client()):
+        assert fetch_package(reference).read('cases') == share.get_content()['cases']
+    assert (package_dir / f'{sha256}.pkg').read_bytes() == content
+
+    node = Node.objects.create(identifier=uuid.uuid4().hex, did=uuid.uuid4().hex, common_name='recipient',
+                               human_readable='recipient')
+    recipient = Profile.objects.create(identifier=uuid.uuid4().hex, identity=uuid.uuid4().hex, node=node)
+    token = ShareToken.create(share=share, recipient=recipient, created_by=created_by, valid_from=timezone.now(),
+                              valid_until=timezone.now())
+
+    def get(common_name, **headers):
+        request = APIRequestFactory().get('/download/', {'package': sha256},
+                                          HTTP_X_FORWARDED_TLS_CLIENT_CERT_INFO=f'Subject%3D%22CN%3D{common_name}%22',
+                                          **headers)
+        return FileServeView.as_view()(request)
+
+    content = (package_dir / f'{sha256}.pkg').read_bytes()
+    response = get('recipient')
+    assert response.status_code == 200
+    assert b''.join(response.streaming_content) == content
+    response = get('recipient', HTTP_RANGE='bytes=0-9')
+    assert response.status_code == 206
+    assert b''.join(response.streaming_content) == content[:10]
+
+    Node.objects.create(identifier=uuid.uuid4().hex, did=uuid.uuid4().hex, common_name='other',
+                        human_readable='other')
+    assert get('other').status_code == 403
+
+    # the reference is sent by default
+    token.created_by = origin
+    with mock.patch.object(OutboxMessage, 'send'):
+        token.send_to_node()
+    assert OutboxMessage.objects.get(recipient=recipient).message['object']['content'] == share.get_reference()
+
+
+@pytest.mark.django_db
+def test_share_metrics(package_dir):
+    call_command('setup_node')
+    user = test_utils.create_user('user1')
+    origin = get_user_node()
+    for _ in range(3):
+        Case.objects.create(name=str(uuid.uuid4()), origin=origin, identifier=identifier.create_random('case'))
+    share = ShareBuilder(None, str(uuid.uuid4()), created_by=user.profile, type='data-release') \
+        .add_case_handler(data=Case.objects.all()) \
+        .build()
+
+    steps = share.metrics['build']['steps']
+    assert steps['case']['rows'] == 3
+    assert steps['case']['bytes'] == share.package['sections']['cases']['size']
+    assert steps['case']['queries'] > 0
+    assert share.metrics['build']['total']['rows'] == 3
+
+    client = APIClient()
+    client.force_authenticate(user)
+    response = client.get(reverse('api-share-metrics', kwargs={'pk': share.pk}))
+    assert response.status_code == 200
+    assert response.json()['metrics'] == share.metrics
+
+
+@pytest.mark.django_db
+def test_plan_share(package_dir, settings):
+    call_command('setup_node')
+    created_by = test_utils.create_user('user1').profile
+    origin = get_user_node()
+    for _ in range(3):
+        Case.objects.create(name=str(uuid.uuid4()), origin=origin, identifier=identifier.create_random('case'))
+
+    def builder():
+        return ShareBuilder(None, str(uuid.uuid4()), created_by=created_by, type='data-release') \
+            .add_type_handler(data='data-release') \
+            .add_case_handler(data=Case.objects.all())
+
+    plan = builder().plan()
+    assert Share.objects.count() == 0
+    assert plan['sections']['cases']['rows'] > 0
+    assert plan['sections']['cases']['size'] > 0
+    assert plan['handlers']['case']['rows'] == plan['sections']['cases']['rows']
+    assert plan['bytes'] >= plan['sections']['type']['size']
+    # no metrics of previous shares yet
+    assert plan['duration'] is None
+
+    builder().build()
+    assert builder().plan()['duration'] is not None
+
+    settings.SHARE_PLAN_WARN_ROWS = 0
+    errors, warnings = check_plan(plan)
+    assert len(errors) == 0 and len(warnings) == 1
+    settings.SHARE_PLAN_MAX_ROWS = 0
+    errors, warnings = check_plan(plan)
+    assert len(errors) == 1
+
+
+@pytest.mark.django_db
+def test_plan_statement_timeout():
+    def show():
+        with connection.cursor() as cursor:
+            cursor.execute('show statement_timeout')
+            return cursor.fetchone()[0]
+
+    previous = show()
+    with statement_timeout(1000):
+        assert show() == '1s'
+    assert show() == previous
+
+    with pytest.raises(PlanTimeout), statement_timeout(10):
+        with connection.cursor() as cursor:
+            cursor.execute('select pg_sleep(1)')
+    # the cancelled query does not break the outer transaction
+    assert show() == previous
+
+
+@pytest.mark.django_db
+def test_import_streamed_section(tmp_path, settings):
+    settings.IMPORTER_CHUNK_SIZE = 2
+    call_command('setup_node')
+    origin = get_user_node()
+    identifiers = [identifier.create_random('case') for _ in range(5)]
+    with PackageWriter(tmp_path / 'cases.pkg') as package:
+        with package.section('cases') as sink:
+            sink.write('name,identifier,origin\n')
+            sink.write(''.join(f'{uuid.uuid4()},{i},{origin.identifier}\n' for i in identifiers))
+
+    content = PackageReader(package.path, package.manifest).to_dict(streamed=['cases'])
+    assert isinstance(content['cases'], CsvSection)
+    share = Share.objects.create(name='share', origin=origin, created_by=origin)
+    Case.import_case(cases=content['cases'], share=share)
+
+    assert set(share.cases.values_list('identifier', flat=True)) == set(identifiers)
+
+
+@pytest.mark.django_db
+def test_codes_handler_set_skips_duplicates():
+    call_command('setup_node')
+    origin = get_user_node()
+    codesystem = CodeSystem.objects.create(name=uuid.uuid4().hex, uri=uuid.uuid4().hex)
+    codes = [Code.objects.create(code=uuid.uuid4().hex, codesystem=codesystem, origin=origin) for _ in range(2)]
+    share = Share.objects.create(origin=origin, created_by=origin, name='share')
+    Pair = namedtuple('Pair', ['id', 'codes'])
+    # both files are coded with the first code
+    data = [Pair(uuid.uuid4(), codes[0].pk), Pair(uuid.uuid4(), codes[0].pk), Pair(uuid.uuid4(), None)]
+    handler = CodesHandler(__name__=CodesHandler.name_files)
+    handler.set(share, data)
+    # the share is already linked to the first code
+    handler.set(share, data + [Pair(uuid.uuid4(), codes[1].pk)])
+    assert set(share.codes.values_list('pk', flat=True)) == {c.pk for c in codes}
+
+
+@pytest.mark.django_db
+def test_codes_handler_queryset(package_dir):
+    call_command('setup_node')
+    created_by = test_utils.create_user('user1').profile
+    origin = get_user_node()
+    codesystem = CodeSystem.objects.create(name=uuid.uuid4().hex, uri=uuid.uuid4().hex)
+    codes = [Code.objects.create(code=uuid.uuid4().hex, codesystem=codesystem, origin=origin) for _ in range(2)]
+    files = [File.objects.create(identifier=identifier.create_random('file'), name=str(i), origin=origin, size=10)
+             for i in range(3)]
+    files[0].codes.add(*codes)
+    files[1].codes.add(codes[0])
+
+    def build(data):
+        return ShareBuilder(None, str(uuid.uuid4()), created_by=created_by, type='data-release') \
+            .add_codes_handler(data=data, handler_init_kwargs={'__name__': CodesHandler.name_files}) \
+            .build()
+
+    # the (codes, id) order of the benchmark and the (id, codes) order of the other callers
+    qs = File.objects.filter(pk__in=[f.pk for f in files])
+    from_list = build(list(qs.values_list('id', 'codes', named=True)))
+    for data in [qs.values_list('codes', 'id', named=True), qs.values_list('id', 'codes', named=True)]:
+        share = build(data)
+        rows = share.get_content()['codes'].splitlines()
+        assert len(rows) == 4
+        assert sorted(rows) == sorted(from_list.get_content()['codes'].splitlines())
+        assert set(share.codes.values_list('pk', flat=True)) == {c.pk for c in codes}
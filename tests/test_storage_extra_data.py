@@ -7,10 +7,11 @@ from rest_framework.authtoken.models import Token
 from rest_framework.test import APIClient
 
 from apps.core.identifier import create_random
+from apps.share.models import Share
 from apps.storage.extra_data.models import ExtraData
 from apps.storage.models import File
 from apps.user.user_profile.models import User
-from apps.utils import get_node_origin
+from apps.utils import get_node_origin, get_user_node
 
 client = APIClient()
 
@@ -101,3 +102,27 @@ def test_create_extra_data_400(setup, token):
             'description': uuid.uuid4().hex}
     R = client.post(reverse('extra_data:create-from-annotation-backend'), data=data, format='json')
     assert R.status_code == 400
+
+
+@pytest.mark.django_db
+def test_reimport_extra_data(setup):
+    origin = get_user_node()
+    file = File.objects.create(name='file', created_by=origin, origin=origin, original_filename='file',
+                               original_path='file', identifier=create_random('file'))
+    share = Share.objects.create(name='share', origin=origin, created_by=origin)
+
+    def csv(value):
+        return 'file,identifier,data,application_identifier,description,created_by,origin\n' + \
+            f'{file.identifier},extra-1,"{{""value"": {value}}}",app,description {value},' \
+            f'{origin.identifier},{origin.identifier}\n'
+
+    ExtraData.import_extra_data(extra_data=csv(1), share=share, for_user=origin)
+    extra_data = ExtraData.objects.get(identifier='extra-1')
+    ExtraData.import_extra_data(extra_data=csv(2), share=share, for_user=origin)
+
+    # the existing row is updated in place
+    updated = ExtraData.objects.get(identifier='extra-1')
+    assert updated.pk == extra_data.pk
+    assert updated.data == {'value': 2}
+    assert updated.description == 'description 2'
+    assert share.extra_data.count() == 1